@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""
+Compare the dense per user and item accessibility rows with sparse access
+grants resolved through the tree, in rows stored and check latency.
+
+A tree of directories with files is shared with a mix of access - some
+directories with everyone, some with half of the users, the rest with
+nobody, and a few files with exceptions. The dense rows are converted by
+the migrate_acl command, and both models answer the same random checks.
+
+    $ python3 benchmarks/bench_acl.py --dirs 200 --files 100 --users 200
+"""
+import argparse
+import random
+import time
+
+from common import setup_django
+
+setup_django(database=True)
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db.transaction import atomic  # noqa: E402
+
+from web import access, tree  # noqa: E402
+from web.models import AccessGrant, ItemAccessibility, ItemType, \
+    SharedItem  # noqa: E402
+
+BATCH_SIZE = 500
+
+
+def make_library(directories, files, users):
+    """
+    :return: Tuple of lists of user ids, directory ids and file ids
+    """
+    User.objects.bulk_create([User(username='user{0}'.format(i))
+                              for i in range(users)])
+    user_ids = list(User.objects.values_list('id', flat=True))
+    directory_type = ItemType.objects.create(type='Directory')
+    file_type = ItemType.objects.create(type='audio/mpeg')
+    items = [SharedItem(name='root', path='/library', type=directory_type,
+                        is_root=True)]
+    for d in range(directories):
+        items.append(SharedItem(name='d{0}'.format(d), type=directory_type,
+                                path='/library/d{0}'.format(d)))
+        items.extend(SharedItem(name='f{0}.mp3'.format(f), type=file_type,
+                                path='/library/d{0}/f{1}.mp3'.format(d, f))
+                     for f in range(files))
+    SharedItem.objects.bulk_create(items, batch_size=BATCH_SIZE)
+    ids = dict(SharedItem.objects.values_list('path', 'id'))
+    through = SharedItem.children.through
+    links = []
+    directory_ids = []
+    file_ids = []
+    for d in range(directories):
+        directory = ids['/library/d{0}'.format(d)]
+        directory_ids.append(directory)
+        links.append(through(from_shareditem_id=ids['/library'],
+                             to_shareditem_id=directory))
+        for f in range(files):
+            item = ids['/library/d{0}/f{1}.mp3'.format(d, f)]
+            file_ids.append(item)
+            links.append(through(from_shareditem_id=directory,
+                                 to_shareditem_id=item))
+    through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+    tree.rebuild()
+    return user_ids, ids['/library'], directory_ids, file_ids
+
+
+def dense_rows(user_ids, root_id, directory_ids, files):
+    """
+    Rows the dense model would hold for the mixed access.
+    """
+    half = set(user_ids[::2])
+    rows = [ItemAccessibility(user_id=user_id, item_id=root_id,
+                              accessible=True) for user_id in user_ids]
+    for d, directory in enumerate(directory_ids):
+        if d % 3 == 0:
+            allowed = set(user_ids)
+        elif d % 3 == 1:
+            allowed = half
+        else:
+            allowed = set()
+        children = list(SharedItem.objects.filter(
+            shareditem=directory).values_list('id', flat=True))
+        for item_id in [directory] + children:
+            item_allowed = allowed
+            if item_id % 50 == 0:
+                # A file shared with one more user than its directory
+                item_allowed = allowed | {user_ids[1]}
+            rows.extend(ItemAccessibility(user_id=user_id, item_id=item_id,
+                                          accessible=user_id in item_allowed)
+                        for user_id in user_ids)
+        if len(rows) > 50000:
+            ItemAccessibility.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+            rows = []
+    ItemAccessibility.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+def timed(label, function, count):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print('{0:<32} {1:>12.1f}'.format(label, elapsed / count * 1e6))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dirs', type=int, default=100,
+                        help='Number of directories')
+    parser.add_argument('--files', type=int, default=100,
+                        help='Number of files per directory')
+    parser.add_argument('--users', type=int, default=100,
+                        help='Number of users')
+    parser.add_argument('--checks', type=int, default=2000,
+                        help='Number of random checks')
+    args = parser.parse_args()
+    with atomic():
+        user_ids, root_id, directory_ids, file_ids = make_library(
+            args.dirs, args.files, args.users)
+        dense_rows(user_ids, root_id, directory_ids, file_ids)
+    users = {user.id: user for user in User.objects.all()}
+    random.seed(1)
+    checks = [(random.choice(user_ids), random.choice(file_ids)) for _ in
+              range(args.checks)]
+    dense = ItemAccessibility.objects.count()
+
+    def dense_check():
+        return [ItemAccessibility.objects.get(user_id=user_id,
+                                              item_id=item_id).accessible
+                for user_id, item_id in checks]
+
+    def sparse_check():
+        return [access.get_resolver(users[user_id]).resolve([item_id])[
+                    item_id] for user_id, item_id in checks]
+
+    print('{0} items, {1} users'.format(len(file_ids) + len(directory_ids) + 1,
+                                        len(user_ids)))
+    print('{0:<32} {1:>12}'.format('model', 'us per check'))
+    expected = timed('dense rows', dense_check, args.checks)
+    start = time.perf_counter()
+    call_command('migrate_acl', keep=True, stdout=open('/dev/null', 'w'))
+    converted = time.perf_counter() - start
+    access._caches.clear()
+    cold = timed('grants, cold cache', sparse_check, args.checks)
+    warm = timed('grants, warm cache', sparse_check, args.checks)
+    listings = [(user_ids[i % len(user_ids)],
+                 list(SharedItem.objects.filter(shareditem=directory)))
+                for i, directory in enumerate(directory_ids)]
+    print('{0:<32} {1:>12}'.format('directory listing', 'us per item'))
+    count = sum(len(children) for _, children in listings)
+    timed('dense rows', lambda: [list(ItemAccessibility.objects.filter(
+        user_id=user_id, item__in=children, accessible=True)) for
+        user_id, children in listings], count)
+    access._caches.clear()
+    timed('grants, cold cache', lambda: [access.accessible_items(
+        users[user_id], children) for user_id, children in listings], count)
+    print('{0:<32} {1:>12}'.format('rows', 'count'))
+    print('{0:<32} {1:>12}'.format('dense rows', dense))
+    print('{0:<32} {1:>12}'.format('grants', AccessGrant.objects.count()))
+    print('Converted in {0:.1f} s, {1} mismatching answers'.format(
+        converted, sum(a != b for a, b in zip(expected, cold)) +
+        sum(a != b for a, b in zip(expected, warm))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Compare the media delivery backends of web/delivery.py.
+
+For every backend a response is built for a temporary file and drained the
+way a WSGI server would - by iterating it for 'stream', with os.sendfile
+for 'file-wrapper' and not at all for the header offload backends, whose bytes
+are sent by the front proxy. The CPU time spent in the worker is what
+limits the number of concurrent streams a worker can serve.
+
+    $ python3 benchmarks/bench_delivery.py --size 512 --concurrency 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import setup_django
+
+setup_django()
+
+from django.test import RequestFactory, override_settings  # noqa: E402
+
+from web.delivery import BACKENDS, deliver_file  # noqa: E402
+
+
+class SendfileWrapper(object):
+    """
+    Stand-in for the wsgi.file_wrapper of a sendfile capable server.
+    """
+
+    def __init__(self, f, block_size=8192):
+        self.f = f
+
+
+def drain(response, sink):
+    if getattr(response, 'file_to_stream', None) is not None:
+        f = response.file_to_stream
+        offset = f.tell()
+        remaining = int(response['Content-Length'])
+        while remaining > 0:
+            sent = os.sendfile(sink, f.fileno(), offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+    elif response.streaming:
+        for data in response.streaming_content:
+            os.write(sink, data)
+    response.close()
+
+
+def deliver(path, rounds, sink, headers):
+    factory = RequestFactory()
+    for _ in range(rounds):
+        request = factory.get('/', **headers)
+        drain(deliver_file(request, path, 'video/mp4'), sink)
+
+
+def run(backend, path, size, rounds, concurrency):
+    sink = os.open(os.devnull, os.O_WRONLY)
+    headers = {'wsgi.file_wrapper': SendfileWrapper}
+    with override_settings(MEDIA_DELIVERY=backend):
+        threads = [threading.Thread(target=deliver,
+                                    args=(path, rounds, sink, headers))
+                   for _ in range(concurrency)]
+        wall, cpu = time.perf_counter(), time.process_time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    os.close(sink)
+    total = size * rounds * concurrency / (1 << 20)
+    print('{0:<18} {1:>10.1f} {2:>12.1f} {3:>14.3f}'.format(
+        backend, wall * 1000, total / wall, cpu / total * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=256,
+                        help='Size of the test file in MiB')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Requests per client')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of concurrent clients')
+    args = parser.parse_args()
+    size = args.size << 20
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
+        block = os.urandom(1 << 20)
+        for _ in range(args.size):
+            f.write(block)
+        f.flush()
+        print('{0} clients x {1} requests of a {2} MiB file'.format(
+            args.concurrency, args.rounds, args.size))
+        print('{0:<18} {1:>10} {2:>12} {3:>14}'.format(
+            'backend', 'wall (ms)', 'MiB/s', 'CPU s per GiB'))
+        for backend in BACKENDS:
+            run(backend, f.name, size, args.rounds, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+Compare MIME detection of a synthetic tree with plain libmagic and with
+web.detection.MimeDetector, cold and with a warm cache.
+
+The tree mixes files with trusted extensions, ambiguous container
+extensions and no extension at all, in the given proportions.
+
+    $ python3 benchmarks/bench_mime.py --files 20000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import setup_django
+
+setup_django(database=True)
+
+import magic  # noqa: E402
+
+from web.detection import MimeDetector  # noqa: E402
+
+HEADERS = {
+    '.mp3': b'ID3\x03\x00\x00\x00\x00\x00\x00',
+    '.wav': b'RIFF\x00\x00\x00\x00WAVEfmt ',
+    '.png': b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR',
+    '.jpg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+    '.webm': b'\x1aE\xdf\xa3\x9fB\x86\x81\x01B\xf7\x81\x01B\xf2\x81\x04B'
+             b'\xf3\x81\x08B\x82\x84webm',
+    '.ogg': b'OggS\x00\x02' + b'\x00' * 22 + b'\x01vorbis',
+    '': b'ID3\x03\x00\x00\x00\x00\x00\x00',
+}
+
+
+def make_tree(root, count, ambiguous):
+    trusted = ['.mp3', '.wav', '.png', '.jpg']
+    other = ['.webm', '.ogg', '']
+    entries = []
+    for i in range(count):
+        directory = os.path.join(root, 'd{0}'.format(i // 500))
+        if i % 500 == 0:
+            os.makedirs(directory)
+        if i % 100 < ambiguous:
+            extension = other[i % len(other)]
+        else:
+            extension = trusted[i % len(trusted)]
+        path = os.path.join(directory, 'f{0}{1}'.format(i, extension))
+        with open(path, 'wb') as f:
+            f.write(HEADERS[extension] + os.urandom(4096))
+        entries.append((path, os.stat(path)))
+    return entries
+
+
+def timed(label, function, count):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print('{0:<28} {1:>10.1f} {2:>12.0f}'.format(label, elapsed * 1000,
+                                                 count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--files', type=int, default=10000,
+                        help='Number of files in the tree')
+    parser.add_argument('--ambiguous', type=int, default=20,
+                        help='Percentage of files libmagic has to look at')
+    args = parser.parse_args()
+    root = tempfile.mkdtemp(prefix='mediavault-mime-')
+    try:
+        entries = make_tree(root, args.files, args.ambiguous)
+        print('{0} files, {1}% with ambiguous or no extension'.format(
+            args.files, args.ambiguous))
+        print('{0:<28} {1:>10} {2:>12}'.format('method', 'time (ms)',
+                                               'files/s'))
+        identifier = magic.Magic(mime=True)
+        timed('libmagic, single handle',
+              lambda: [identifier.from_file(path) for path, _ in entries],
+              args.files)
+        for label in ('detector, cold cache', 'detector, warm cache'):
+            detector = MimeDetector()
+            timed(label, lambda: detector.detect_all(entries), args.files)
+            print('    {0}'.format(detector))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+"""
+Time library searches answered by the FTS5 index of web/search.py and by
+the LIKE fallback used without it.
+
+A library of files named after random words from a small vocabulary, with
+titles, albums and artists, is shared with everyone, indexed, and searched
+for prefixes, whole words and pairs of words.
+
+    $ python3 benchmarks/bench_search.py --items 100000 --samples 50
+"""
+import argparse
+import random
+import time
+
+from common import setup_django
+
+setup_django(database=True)
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db.transaction import atomic  # noqa: E402
+
+from web import search, tree  # noqa: E402
+from web.models import AccessGrant, Album, Artist, ItemType, \
+    SharedItem  # noqa: E402
+
+BATCH_SIZE = 500
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def make_vocabulary(size):
+    random.seed(1)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(random.choice(LETTERS) for _ in range(
+            random.randint(4, 9))))
+    return sorted(words)
+
+
+def make_library(items, words):
+    directory_type = ItemType.objects.create(type='Directory')
+    file_type = ItemType.objects.create(type='audio/mpeg')
+    albums = [Album.objects.create(name=' '.join(random.sample(words, 2)))
+              for _ in range(200)]
+    Artist.objects.bulk_create([Artist(first_name=random.choice(words),
+                                       last_name=random.choice(words))
+                                for _ in range(300)])
+    artist_ids = list(Artist.objects.values_list('id', flat=True))
+    with atomic():
+        root = SharedItem.objects.create(name='library', path='/library',
+                                         type=directory_type, is_root=True)
+        AccessGrant.objects.create(item=root, user=None, allow=True)
+        batch = []
+        for i in range(items):
+            name = '{0} {1} {2}.mp3'.format(*random.sample(words, 3))
+            batch.append(SharedItem(
+                name=name, path='/library/{0}'.format(name), type=file_type,
+                title=' '.join(random.sample(words, 2)),
+                album=random.choice(albums)))
+            if len(batch) == BATCH_SIZE or i == items - 1:
+                SharedItem.objects.bulk_create(batch)
+                batch = []
+        through = SharedItem.children.through
+        file_ids = list(SharedItem.objects.exclude(id=root.id).values_list(
+            'id', flat=True))
+        through.objects.bulk_create(
+            [through(from_shareditem_id=root.id, to_shareditem_id=item_id)
+             for item_id in file_ids], batch_size=BATCH_SIZE)
+        artists = SharedItem.artist.through
+        artists.objects.bulk_create(
+            [artists(shareditem_id=item_id,
+                     artist_id=random.choice(artist_ids))
+             for item_id in file_ids], batch_size=BATCH_SIZE)
+    tree.rebuild()
+
+
+def timed(label, user, queries):
+    elapsed = []
+    found = 0
+    for query in queries:
+        start = time.perf_counter()
+        items, _ = search.search(user, query)
+        elapsed.append(time.perf_counter() - start)
+        found += len(items)
+    elapsed.sort()
+    print('{0:<28} {1:>10.2f} {2:>10.2f} {3:>10.1f}'.format(
+        label, elapsed[len(elapsed) // 2] * 1e3,
+        elapsed[int(len(elapsed) * 0.95)] * 1e3, found / len(queries)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--items', type=int, default=100000,
+                        help='Files in the library')
+    parser.add_argument('--words', type=int, default=20000,
+                        help='Words in the vocabulary of names')
+    parser.add_argument('--samples', type=int, default=50,
+                        help='Queries of each kind')
+    args = parser.parse_args()
+    words = make_vocabulary(args.words)
+    start = time.perf_counter()
+    make_library(args.items, words)
+    print('Added {0} items in {1:.1f} s'.format(
+        args.items, time.perf_counter() - start))
+    start = time.perf_counter()
+    if search.rebuild() is None:
+        print('FTS5 is not available')
+        return
+    print('Indexed them in {0:.1f} s'.format(time.perf_counter() - start))
+    user = User.objects.create_user('user')
+    kinds = [
+        ('prefix', [random.choice(words)[:3] for _ in range(args.samples)]),
+        ('word', [random.choice(words) for _ in range(args.samples)]),
+        ('two words', [' '.join(random.sample(words, 2)) for _ in
+                       range(args.samples)]),
+    ]
+    print('{0:<28} {1:>10} {2:>10} {3:>10}'.format('query', 'median ms',
+                                                   'p95 ms', 'found'))
+    for kind, queries in kinds:
+        timed(kind + ', fts5', user, queries)
+    search._available = False
+    for kind, queries in kinds:
+        timed(kind + ', like', user, queries[:max(1, args.samples // 10)])
+
+
+if __name__ == '__main__':
+    main()
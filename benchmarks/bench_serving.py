@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+"""
+Load test of the servers started by run.py - the Django development server
+(`run.py --dev`, what run.py used to start) and gunicorn with the
+production settings (`run.py`).
+
+Every server serves a temporary library holding a large video file. For
+each number of clients, that many media players stream the video at the
+same time, asking for it in range requests paced at a playback bitrate,
+while a probe keeps browsing a directory through the API. A stream keeps
+up when it received at least 95% of the bytes its playback needed; the
+capacity of a server is the number of streams it keeps up with.
+
+    $ python3 benchmarks/bench_serving.py --clients 8 32 128 --duration 15
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import MEDIAVAULT_DIR, setup_django
+
+setup_django(database=True)
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.contrib.sessions.backends.db import SessionStore  # noqa: E402
+from rest_framework.authtoken.models import Token  # noqa: E402
+
+from web import tree  # noqa: E402
+from web.models import AccessGrant, ItemType, SharedItem  # noqa: E402
+
+RUN = os.path.join(os.path.dirname(MEDIAVAULT_DIR), 'run.py')
+# Settings of the servers, the development or the production ones using
+# the database of the benchmark
+SETTINGS = """from mediavault.{0} import *  # noqa
+DATABASES['default']['NAME'] = {1!r}
+MIGRATION_MODULES = {{'web': None, 'api': None}}
+STATIC_ROOT = {2!r}
+"""
+CHUNK_SIZE = 1 << 20
+
+lock = threading.Lock()
+
+
+def make_library(directory, size):
+    path = os.path.join(directory, 'video.mp4')
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as f:
+        for _ in range(size):
+            f.write(block)
+    directory_type = ItemType.objects.create(type='Directory')
+    video_type = ItemType.objects.create(type='video/mp4')
+    root = SharedItem.objects.create(name='library', path=directory,
+                                     type=directory_type, is_root=True)
+    AccessGrant.objects.create(item=root, user=None, allow=True)
+    video = SharedItem.objects.create(name='video.mp4', path=path,
+                                      type=video_type)
+    root.children.add(video)
+    tree.rebuild()
+    user = User.objects.create_user('user')
+    session = SessionStore()
+    session['username'] = user.username
+    session.create()
+    return root.id, video.id, session.session_key, \
+        Token.objects.get_or_create(user=user)[0].key
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(name, directory, args):
+    """
+    Start a server with run.py.
+    :param name: 'dev', 'gunicorn' or 'asgi'
+    :param args: Command line arguments of gunicorn or uvicorn
+    :return: Tuple of the process and its port
+    """
+    module = 'bench_{0}_settings'.format(name)
+    with open(os.path.join(directory, module + '.py'), 'w') as f:
+        f.write(SETTINGS.format(
+            'settings' if name == 'dev' else 'production',
+            settings.DATABASES['default']['NAME'],
+            os.path.join(directory, 'static')))
+    port = free_port()
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=module,
+               PYTHONPATH=os.pathsep.join([directory, MEDIAVAULT_DIR]),
+               MEDIAVAULT_PIDFILE=os.path.join(directory, 'gunicorn.pid'),
+               MEDIAVAULT_ACCESS_LOG='/dev/null',
+               MEDIAVAULT_CACHE_DIR=os.path.join(directory, 'cache'),
+               # The key the sessions of the benchmark are signed with
+               MEDIAVAULT_SECRET_KEY=settings.SECRET_KEY,
+               MEDIAVAULT_ALLOWED_HOSTS='127.0.0.1,localhost')
+    bind = '127.0.0.1:{0}'.format(port)
+    if name == 'dev':
+        # The reloader is left out so that stopping the server stops it all
+        command = [sys.executable, os.path.join(MEDIAVAULT_DIR, 'manage.py'),
+                   'runserver', '--noreload', bind]
+    elif name == 'asgi':
+        command = [sys.executable, RUN, '--asgi', '--bind', bind] + args
+    else:
+        command = [sys.executable, RUN, '--bind', bind] + args
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{0} server did not start'.format(name))
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def stream(port, url, cookie, size, rate, stop, result):
+    """
+    Play a video like a media player, asking for the next chunk whenever
+    playback gets close to the end of what was received.
+    """
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    start = time.monotonic()
+    received = 0
+    try:
+        while not stop.is_set():
+            ahead = received - (time.monotonic() - start) * rate
+            if ahead > CHUNK_SIZE:
+                time.sleep(min(0.05, (ahead - CHUNK_SIZE) / rate))
+                continue
+            first = received % size
+            last = min(first + CHUNK_SIZE, size) - 1
+            byte_range = 'bytes={0}-{1}'.format(first, last)
+            connection.request('GET', url, headers={'Cookie': cookie,
+                                                    'Range': byte_range})
+            response = connection.getresponse()
+            data = response.read()
+            if response.status != 206:
+                raise RuntimeError(response.status)
+            received += len(data)
+    except (OSError, http.client.HTTPException, RuntimeError):
+        with lock:
+            result['errors'] += 1
+    finally:
+        connection.close()
+    elapsed = time.monotonic() - start
+    with lock:
+        result['received'] += received
+        if received >= 0.95 * elapsed * rate:
+            result['kept_up'] += 1
+
+
+def probe(port, url, stop, latencies):
+    while not stop.is_set():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        start = time.perf_counter()
+        try:
+            connection.request('GET', url)
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start
+                             if response.status == 200 else float('inf'))
+        except (OSError, http.client.HTTPException):
+            latencies.append(float('inf'))
+        finally:
+            connection.close()
+        time.sleep(0.1)
+
+
+def load(port, clients, duration, rate, size, root_id, video_id, session,
+         key):
+    result = {'received': 0, 'kept_up': 0, 'errors': 0}
+    latencies = []
+    stop = threading.Event()
+    url = '/media-get/{0}'.format(video_id)
+    cookie = '{0}={1}'.format(settings.SESSION_COOKIE_NAME, session)
+    threads = [threading.Thread(target=stream, args=(
+        port, url, cookie, size, rate, stop, result)) for _ in range(clients)]
+    threads.append(threading.Thread(target=probe, args=(
+        port, '/api/explore/?key={0}&parent={1}'.format(key, root_id), stop,
+        latencies)))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    if not latencies:
+        latencies = [float('inf')]
+    return (result['kept_up'], result['errors'],
+            result['received'] / duration / (1 << 20),
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[8, 32, 128],
+                        help='Numbers of concurrent streams')
+    parser.add_argument('--duration', type=float, default=15,
+                        help='Seconds each load lasts')
+    parser.add_argument('--bitrate', type=int, default=4000,
+                        help='Playback bitrate of the video in kbit/s')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Size of the video in MiB')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes of gunicorn')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads of each gunicorn worker')
+    args = parser.parse_args()
+    gunicorn_args = []
+    if args.workers:
+        gunicorn_args += ['--workers', str(args.workers)]
+    if args.threads:
+        gunicorn_args += ['--threads', str(args.threads)]
+    rate = args.bitrate * 1000 / 8
+    directory = tempfile.mkdtemp(prefix='mediavault-bench-')
+    library = make_library(directory, args.size)
+    print('Streams of a {0} MiB video at {1} kbit/s for {2} s'.format(
+        args.size, args.bitrate, args.duration))
+    print('{0:<10} {1:>8} {2:>8} {3:>8} {4:>10} {5:>12} {6:>12}'.format(
+        'server', 'streams', 'kept up', 'errors', 'MiB/s', 'probe p50 ms',
+        'probe p95 ms'))
+    for name in ('dev', 'gunicorn'):
+        process, port = start_server(name, directory, gunicorn_args)
+        try:
+            for clients in args.clients:
+                print('{0:<10} {1:>8} {2:>8} {3:>8} {4:>10.1f} {5:>12.1f} '
+                      '{6:>12.1f}'.format(name, clients, *load(
+                          port, clients, args.duration, rate,
+                          args.size << 20, *library)))
+        finally:
+            stop_server(process)
+
+
+if __name__ == '__main__':
+    main()
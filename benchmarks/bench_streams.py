@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+"""
+Measure how many slow media streams a single server process keeps up
+with, served by gunicorn's threads (`run.py`) and by the event loop of the
+ASGI application (`run.py --asgi`).
+
+Every client is a viewer on a slow connection: it asks for a whole video,
+reads it at a playback bitrate through a small receive buffer, and hangs
+up after a while. A stream keeps up when it received at least 95% of the
+bytes its playback needed. Once the clients are gone, the files the server
+still holds open show whether it noticed they left.
+
+    $ python3 benchmarks/bench_streams.py --clients 100 500 1000
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import tempfile
+import time
+
+from bench_serving import make_library, start_server, stop_server
+
+from django.conf import settings
+
+RECEIVE_BUFFER = 64 << 10
+
+
+def process_tree(pid):
+    """
+    :return: List of the ids of a process and of its descendants
+    """
+    pids = [pid]
+    for found in pids:
+        try:
+            with open('/proc/{0}/task/{0}/children'.format(found)) as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def usage(pid):
+    """
+    :return: Tuple of the resident memory in MiB, the threads and the open
+    regular files of a process and its descendants
+    """
+    memory = threads = files = 0
+    for found in process_tree(pid):
+        try:
+            with open('/proc/{0}/status'.format(found)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        memory += int(line.split()[1]) / 1024
+                    elif line.startswith('Threads:'):
+                        threads += int(line.split()[1])
+            directory = '/proc/{0}/fd'.format(found)
+            for fd in os.listdir(directory):
+                if os.path.isfile(os.path.join(directory, fd)):
+                    files += 1
+        except OSError:
+            pass
+    return memory, threads, files
+
+
+async def stream(port, request, rate, duration, result):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    sock.setblocking(False)
+    start = time.monotonic()
+    end = start + duration
+    received = 0
+    writer = None
+    try:
+        await asyncio.get_running_loop().sock_connect(sock,
+                                                      ('127.0.0.1', port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(request)
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                               end - time.monotonic())
+        result['first_byte'].append(time.monotonic() - start)
+        while time.monotonic() < end:
+            wanted = (time.monotonic() - start) * rate - received
+            if wanted <= 0:
+                await asyncio.sleep(0.05)
+                continue
+            data = await asyncio.wait_for(
+                reader.read(int(min(wanted, RECEIVE_BUFFER)) + 1),
+                end - time.monotonic())
+            if not data:
+                break
+            received += len(data)
+    except asyncio.TimeoutError:
+        pass
+    except OSError:
+        result['errors'] += 1
+    finally:
+        if writer is not None:
+            writer.transport.abort()
+        else:
+            sock.close()
+    result['received'] += received
+    if received >= 0.95 * duration * rate:
+        result['kept_up'] += 1
+
+
+async def load(port, clients, rate, duration, video_id, session):
+    request = ('GET /media-get/{0} HTTP/1.1\r\nHost: localhost\r\n'
+               'Cookie: {1}={2}\r\n\r\n').format(
+        video_id, settings.SESSION_COOKIE_NAME, session).encode()
+    result = {'received': 0, 'kept_up': 0, 'errors': 0, 'first_byte': []}
+    streams = []
+    for _ in range(clients):
+        streams.append(asyncio.ensure_future(stream(port, request, rate,
+                                                    duration, result)))
+        # Viewers do not all arrive in the same millisecond
+        await asyncio.sleep(duration / 10 / clients)
+    await asyncio.sleep(duration * 0.8)
+    return result, streams
+
+
+def run(process, port, clients, rate, duration, video_id, session):
+    loop = asyncio.new_event_loop()
+    result, streams = loop.run_until_complete(load(
+        port, clients, rate, duration, video_id, session))
+    memory, threads, _ = usage(process.pid)
+    loop.run_until_complete(asyncio.gather(*streams))
+    loop.close()
+    time.sleep(1)
+    _, _, files = usage(process.pid)
+    first_byte = sorted(result['first_byte']) or [float('inf')]
+    return (result['kept_up'], result['errors'],
+            first_byte[int(len(first_byte) * 0.95) - 1] * 1e3, memory,
+            threads, files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[100, 500, 1000],
+                        help='Numbers of concurrent streams')
+    parser.add_argument('--duration', type=float, default=15,
+                        help='Seconds each viewer watches')
+    parser.add_argument('--bitrate', type=int, default=256,
+                        help='Playback bitrate of the viewers in kbit/s')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Size of the video in MiB')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads of the gunicorn worker')
+    args = parser.parse_args()
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, limit))
+    rate = args.bitrate * 1000 / 8
+    directory = tempfile.mkdtemp(prefix='mediavault-bench-')
+    _, video_id, session, _ = make_library(directory, args.size)
+    servers = [('gunicorn', ['--workers', '1'] + (
+        ['--threads', str(args.threads)] if args.threads else [])),
+        ('asgi', ['--workers', '1'])]
+    print('Viewers of a {0} MiB video at {1} kbit/s for {2} s, one server '
+          'process'.format(args.size, args.bitrate, args.duration))
+    print('{0:<10} {1:>8} {2:>8} {3:>7} {4:>14} {5:>8} {6:>8} {7:>12}'.format(
+        'server', 'streams', 'kept up', 'errors', 'p95 first ms', 'RSS MiB',
+        'threads', 'files after'))
+    for name, server_args in servers:
+        process, port = start_server(name, directory, server_args)
+        try:
+            for clients in args.clients:
+                print('{0:<10} {1:>8} {2:>8} {3:>7} {4:>14.1f} {5:>8.1f} '
+                      '{6:>8} {7:>12}'.format(name, clients, *run(
+                          process, port, clients, rate, args.duration,
+                          video_id, session)))
+        finally:
+            stop_server(process)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+"""
+Compare queries on the tree of shared items walked through the children
+links, a query per item or level, with the same queries answered by the
+tree index of web/tree.py.
+
+A synthetic directory tree of the given depth and fan-out, with files in
+every directory, is added with the library scanner.
+
+    $ python3 benchmarks/bench_tree.py --depth 4 --fanout 6 --files 20
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from common import setup_django
+
+setup_django(database=True)
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from web import tree  # noqa: E402
+from web.models import SharedItem, get_children_recursive  # noqa: E402
+from web.scanner import scan_library  # noqa: E402
+
+
+def make_tree(root, depth, fanout, files):
+    os.makedirs(root)
+    level = [root]
+    for d in range(depth + 1):
+        below = []
+        for directory in level:
+            for f in range(files):
+                with open(os.path.join(directory, 'f{0}.mp3'.format(f)),
+                          'wb') as file:
+                    file.write(b'ID3\x03\x00\x00\x00\x00\x00\x00')
+            if d < depth:
+                for i in range(fanout):
+                    path = os.path.join(directory, 'd{0}'.format(i))
+                    os.mkdir(path)
+                    below.append(path)
+        level = below
+
+
+def walked_subtree(item):
+    found = []
+    for child in item.children.all():
+        found.append(child.id)
+        found.extend(walked_subtree(child))
+    return found
+
+
+def walked_ancestors(item):
+    through = SharedItem.children.through
+    found = []
+    item_id = item.id
+    while True:
+        parent = through.objects.filter(to_shareditem_id=item_id).values_list(
+            'from_shareditem_id', flat=True)
+        if len(parent) == 0:
+            return list(reversed(found))
+        item_id = parent[0]
+        found.append(item_id)
+
+
+def walked_children(parent, user):
+    item = SharedItem.objects.get(id=parent)
+    parent_dict = item.dictify()
+    parent_dict['children'] = [walked_children(child.id, user) for child in
+                               item.children.all()]
+    return parent_dict
+
+
+def timed(label, function, items):
+    results = []
+    elapsed = 0
+    count = 0
+    for item in items:
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            results.append(function(item))
+            elapsed += time.perf_counter() - start
+        count += len(queries)
+    print('{0:<32} {1:>10.2f} {2:>10.1f}'.format(
+        label, elapsed / len(items) * 1e3, count / len(items)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--depth', type=int, default=4,
+                        help='Levels of directories below the root')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='Directories in each directory')
+    parser.add_argument('--files', type=int, default=10,
+                        help='Files in each directory')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='Items each query is timed on')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='mediavault-bench-')
+    try:
+        root = os.path.join(directory, 'library')
+        make_tree(root, args.depth, args.fanout, args.files)
+        user = User.objects.create_superuser('admin', '', 'admin')
+        start = time.perf_counter()
+        count = scan_library(root, user, 'all')
+        print('Added {0} items in {1:.1f} s'.format(
+            count, time.perf_counter() - start))
+        start = time.perf_counter()
+        tree.rebuild()
+        print('Rebuilt the index in {0:.2f} s'.format(
+            time.perf_counter() - start))
+    finally:
+        shutil.rmtree(directory)
+
+    random.seed(1)
+    directories = list(SharedItem.objects.filter(
+        type__type='Directory', depth__lte=1))
+    leaves = random.sample(list(SharedItem.objects.filter(
+        depth=args.depth + 1)), args.samples)
+    tops = random.sample(directories, min(args.samples, len(directories)))
+    print('{0:<32} {1:>10} {2:>10}'.format('query', 'ms', 'queries'))
+    walked = timed('subtree, walked', walked_subtree, tops)
+    indexed = timed('subtree, indexed', tree.descendant_ids, tops)
+    assert [sorted(ids) for ids in walked] == [sorted(ids) for ids in indexed]
+    walked = timed('ancestors, walked', walked_ancestors, leaves)
+    indexed = timed('ancestors, indexed', tree.ancestor_ids, leaves)
+    assert walked == indexed
+    timed('breadcrumbs, indexed', tree.breadcrumbs, leaves)
+    tops = tops[:3]
+    walked = timed('nested listing, walked',
+                   lambda item: walked_children(item.id, user), tops)
+    indexed = timed('nested listing, indexed',
+                    lambda item: get_children_recursive(item.id, user), tops)
+    assert walked == indexed
+
+
+if __name__ == '__main__':
+    main()
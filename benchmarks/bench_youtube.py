@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+Compare the earlier parser of YouTube results pages, slicing the page over
+and over and compiling six patterns per tile, with the single pass parser
+of web/youtube.py, and time searches answered by its cache.
+
+Everything runs offline on the results page saved in fixtures/, repeated
+to make larger pages.
+
+    $ python3 benchmarks/bench_youtube.py --copies 1 10 50 --repeat 20
+"""
+import argparse
+import os
+import re
+import time
+
+from common import setup_django
+
+setup_django()
+
+from web.youtube import YouTubeClient, parse_results  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'fixtures', 'youtube_results.html')
+
+
+def legacy_get_videos(html):
+    first = html.find('yt-lockup-tile')
+    html = html[first + 2:]
+    vid = []
+    while True:
+        pos = html.find('yt-lockup-tile')
+        if pos == -1:
+            vid.append(html)
+            break
+        vid.append(html[:pos + 2])
+        html = html[pos + 3:]
+    return vid
+
+
+def legacy_get_video_attrs(html):
+    result = {}
+    regex = 'yt\\-lockup\\-title.*?href.*?watch\\?v\\=(.*?[^\\"]+)'
+    regex += '.*? title\\=\\"(.*?[^\\"]+)'
+    temp = re.findall(regex, html)
+    if len(temp) and len(temp[0]) == 2:
+        result['id'] = temp[0][0]
+        result['title'] = temp[0][1]
+    temp = re.findall('video\\-time.*?\\>([^\\<]+)', html)
+    if len(temp) > 0:
+        result['length'] = temp[0].strip()
+    temp = re.findall('yt\\-lockup\\-byline.*?\\>.*?\\>([^\\<]+)', html)
+    if len(temp) > 0:
+        result['uploader'] = temp[0].strip()
+    temp = re.findall(
+        'yt\\-lockup\\-meta\\-info.*?\\>.*?\\>([^\\<]+).*?([0-9\\,]+)', html)
+    if len(temp) and len(temp[0]) == 2:
+        result['time'] = temp[0][0]
+        result['views'] = temp[0][1]
+    if 'id' in result:
+        result['thumb'] = 'http://img.youtube.com/vi/%s/0.jpg' % result['id']
+    else:
+        return None
+    temp = re.findall('yt-lockup-description.*?>(.*?)<', html)
+    result['description'] = temp[0] if len(temp) > 0 else ''
+    return result
+
+
+def legacy_parse(html):
+    results = [legacy_get_video_attrs(vid) for vid in legacy_get_videos(html)]
+    return [result for result in results if result]
+
+
+class FixtureResponse(object):
+
+    def __init__(self, text):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+
+class FixtureSession(object):
+    """
+    Stands in for requests.Session, answering every request with a page.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.requests = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.requests += 1
+        return FixtureResponse(self.text)
+
+
+def timed(function, page, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = function(page)
+    return (time.perf_counter() - start) / repeat * 1e3, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--copies', type=int, nargs='+', default=[1, 10, 50],
+                        help='Times the saved page is repeated')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Parses timed for each page')
+    args = parser.parse_args()
+    with open(FIXTURE) as file:
+        fixture = file.read()
+    print('{0:>8} {1:>8} {2:>12} {3:>12}'.format('KiB', 'videos',
+                                                 'legacy ms', 'single ms'))
+    for copies in args.copies:
+        page = fixture * copies
+        legacy_ms, legacy = timed(legacy_parse, page, args.repeat)
+        single_ms, single = timed(parse_results, page, args.repeat)
+        assert [(r['id'], r['title'], r['views']) for r in legacy] == \
+            [(r['id'], r['title'], r['views']) for r in single]
+        print('{0:>8} {1:>8} {2:>12.2f} {3:>12.2f}'.format(
+            len(page) // 1024, len(single), legacy_ms, single_ms))
+
+    session = FixtureSession(fixture)
+    client = YouTubeClient(session=session)
+    start = time.perf_counter()
+    client.search('Live  Music')
+    missed = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        client.search('live music ')
+    cached = (time.perf_counter() - start) / args.repeat
+    print('search, not cached {0:.2f} ms, cached {1:.3f} ms, {2} request(s)'
+          .format(missed * 1e3, cached * 1e3, session.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+Shared setup for the benchmark scripts.
+"""
+import os
+import sys
+import tempfile
+
+MEDIAVAULT_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'mediavault')
+
+
+def setup_django(database=False):
+    """
+    Configure Django for a benchmark.
+    :param database: If True, use a fresh SQLite database in a temporary
+    directory with tables created straight from the models
+    """
+    sys.path.insert(0, MEDIAVAULT_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mediavault.settings')
+    import django
+    from django.conf import settings
+    if database:
+        directory = tempfile.mkdtemp(prefix='mediavault-bench-')
+        settings.DATABASES['default']['NAME'] = os.path.join(directory,
+                                                             'db.sqlite3')
+        settings.MIGRATION_MODULES = {'web': None, 'api': None}
+    django.setup()
+    if database:
+        from django.core.management import call_command
+        call_command('migrate', run_syncdb=True, verbosity=0)
@@ -1,3 +1,177 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from rest_framework.authtoken.models import Token
+
+from web import access
+from web.access import set_grant
+from web.models import SharedItem, bump_generation, delete_items, \
+    touch_listing
+from web.scanner import scan_library
+
+
+def share(test):
+    """
+    Share a directory of files with everyone but one file, hidden from the
+    user of the test.
+    :return: Tuple of the names of the files the user can access and of the
+    API key of the user
+    """
+    cache.clear()
+    root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, root)
+    names = ['{0}.mp3'.format(name) for name in 'abcdefg']
+    for name in names + ['hidden.mp3']:
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(b'ID3' + b'\0' * 100)
+    user = User.objects.create_user('viewer')
+    scan_library(root, user, 'all')
+    set_grant(SharedItem.objects.get(name='hidden.mp3').id, user.id, False)
+    bump_generation(access.GENERATION)
+    return names, Token.objects.get(user=user).key
+
+
+class ExploreTests(TestCase):
+
+    def setUp(self):
+        self.names, self.key = share(self)
+        self.parent = SharedItem.objects.get(is_root=True).id
+
+    def get(self, **params):
+        params.setdefault('key', self.key)
+        params.setdefault('parent', self.parent)
+        return self.client.get('/api/explore/', params)
+
+    def pages(self, **params):
+        """
+        :return: List of the names on each page of a listing
+        """
+        pages = []
+        cursor = None
+        while True:
+            if cursor is not None:
+                params['cursor'] = cursor
+            response = self.get(**params)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content.decode())
+            pages.append([child['name'] for child in data['children']])
+            self.assertEqual(data['number'], len(pages[-1]))
+            cursor = data['next']
+            if cursor is None:
+                return pages
+
+    def test_pages(self):
+        pages = self.pages(sort='name', limit=3)
+        self.assertEqual(pages, [self.names[0:3], self.names[3:6],
+                                 self.names[6:]])
+        pages = self.pages(sort='-name', limit=4)
+        self.assertEqual(pages, [self.names[:2:-1], self.names[2::-1]])
+        self.assertEqual(sum(self.pages(sort='-added', limit=2), []),
+                         sum(self.pages(sort='-id', limit=5), []))
+
+    def test_ties_are_broken_by_id(self):
+        SharedItem.objects.filter(name__in=self.names).update(views=3)
+        self.assertEqual(sorted(sum(self.pages(sort='views', limit=2), [])),
+                         self.names)
+
+    def test_fields(self):
+        data = json.loads(self.get(sort='name', limit=1,
+                                   fields='id,name').content.decode())
+        self.assertEqual(list(data['children'][0]), ['id', 'name'])
+        self.assertEqual(data['children'][0]['name'], 'a.mp3')
+
+    def test_errors(self):
+        self.assertEqual(self.get(sort='size').status_code, 400)
+        self.assertEqual(self.get(fields='id,secret').status_code, 400)
+        self.assertEqual(self.get(cursor='garbage').status_code, 400)
+        self.assertEqual(self.get(key='invalid').status_code, 401)
+        self.assertEqual(self.get(key='').status_code, 401)
+
+
+class TreeExportTests(TransactionTestCase):
+
+    def setUp(self):
+        self.names, self.key = share(self)
+        self.directory = SharedItem.objects.get(is_root=True)
+
+    def export(self, **params):
+        """
+        :return: Tuple of the records of the items and of the summary
+        """
+        params.setdefault('key', self.key)
+        response = self.client.get('/api/tree/', params)
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        records = [json.loads(line) for line in lines]
+        return records[:-1], records[-1]['end']
+
+    def test_full(self):
+        records, end = self.export()
+        self.assertEqual(records[0]['name'], self.directory.name)
+        self.assertEqual(sorted(record['name'] for record in records[1:]),
+                         self.names)
+        self.assertEqual([record['parent'] for record in records],
+                         [None] + [self.directory.id] * len(self.names))
+        self.assertEqual((end['count'], end['full']),
+                         (len(self.names) + 1, True))
+        self.assertNotIn('present', end)
+        records, end = self.export(
+            parent=SharedItem.objects.get(name='a.mp3').id)
+        self.assertEqual([record['name'] for record in records], ['a.mp3'])
+
+    def test_delta(self):
+        since = self.export()[1]['since']
+        records, end = self.export(since=since)
+        self.assertEqual((records, end['full']), ([], False))
+        touch_listing(SharedItem.objects.get(name='c.mp3'))
+        records, end = self.export(since=since)
+        self.assertEqual([record['name'] for record in records],
+                         [self.directory.name, 'c.mp3'])
+        self.assertEqual((end['count'], end['full']), (2, False))
+        self.assertEqual(sorted(end['present']), sorted(
+            SharedItem.objects.exclude(name='hidden.mp3').values_list(
+                'id', flat=True)))
+        # Deletions cannot be told from the modification times
+        since = end['since']
+        delete_items([SharedItem.objects.get(name='g.mp3').id])
+        records, end = self.export(since=since)
+        self.assertTrue(end['full'])
+        self.assertEqual(len(records), len(self.names))
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/api/tree/', {
+            'key': self.key, 'since': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/tree/', {
+            'key': self.key, 'parent': 0}).status_code, 404)
+        self.assertEqual(self.client.get('/api/tree/', {
+            'key': 'invalid'}).status_code, 401)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.names, self.key = share(self)
+
+    def get(self, **params):
+        params.setdefault('key', self.key)
+        return self.client.get('/api/search/', params)
+
+    def test_pages(self):
+        data = json.loads(self.get(q='mp3', limit=4).content.decode())
+        self.assertEqual(data['number'], 4)
+        self.assertIsNotNone(data['next'])
+        names = [result['name'] for result in data['results']]
+        data = json.loads(self.get(q='mp3', limit=4,
+                                   start=data['next']).content.decode())
+        self.assertIsNone(data['next'])
+        names += [result['name'] for result in data['results']]
+        self.assertEqual(sorted(names), self.names)
+
+    def test_errors(self):
+        self.assertEqual(self.get(q='mp3', limit='all').status_code, 400)
+        self.assertEqual(self.get(q='mp3', key='invalid').status_code, 401)
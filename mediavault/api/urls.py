@@ -6,5 +6,7 @@ from . import views
 
 
 urlpatterns = [
-    url(r'^explore/', views.explore)
+    url(r'^explore/', views.explore),
+    url(r'^tree/', views.tree),
+    url(r'^search/', views.search)
 ]
@@ -1,31 +1,262 @@
+import base64
+import hashlib
 import json
 
-from django.http import HttpResponse
-from rest_framework.authtoken.models import Token
-from web.models import get_children
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from web.export import export_tree
+from web.search import search as search_items
+from web.models import SharedItem, get_children, get_generation, \
+    listing_version
+from web.tree import checked_path
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
+# Sort keys of explore and the fields they order by. Ties are broken by id.
+SORT_KEYS = {
+    'id': 'id',
+    'name': 'name',
+    'added': 'time_added',
+    'views': 'views',
+    'score': 'score',
+}
+
+# Sort keys whose order changes without a change of the listing version
+UNVERSIONED_SORT_KEYS = ('views', 'score')
+
+FIELDS = ('id', 'name', 'type', 'path', 'duration', 'title', 'artist',
+          'album', 'year', 'video_codec', 'video_frame_rate',
+          'video_bit_rate', 'height', 'width', 'audio_codec',
+          'audio_channels', 'audio_sample_rate', 'audio_bit_rate',
+          'average_rating', 'number_of_ratings')
+
+
+def error(message, status=400):
+    return HttpResponse(json.dumps({"error": message}), status=status)
+
+
+def encode_cursor(value, item_id):
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(
+        json.dumps([value, item_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    :return: Tuple of the sort value and the id of the last item of the
+    previous page
+    :raise ValueError: If the cursor is not one made by encode_cursor()
+    """
+    try:
+        value, item_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (TypeError, UnicodeError, base64.binascii.Error):
+        raise ValueError(cursor)
+    if not isinstance(item_id, int):
+        raise ValueError(cursor)
+    return value, item_id
+
+
+def page_of(children, sort, cursor, size):
+    """
+    One page of a listing, in the order of the sort key, starting after the
+    item the cursor points at. The page is found by the values of the sort
+    key and of the id of that item rather than by an offset, so pages deep
+    into a large directory cost the same as the first one.
+    :param children: QuerySet of items listed
+    :param sort: Sort key, prefixed with '-' for descending order
+    :param cursor: Cursor returned with the previous page, or None
+    :param size: Number of items on a page
+    :return: Tuple of the list of items and of the cursor of the next page,
+    None on the last page
+    """
+    descending = sort.startswith('-')
+    field = SORT_KEYS[sort.lstrip('-')]
+    order = '-' if descending else ''
+    children = children.order_by(order + field, order + 'id')
+    if cursor is not None:
+        value, item_id = decode_cursor(cursor)
+        if field == 'time_added':
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(cursor)
+        after = '__lt' if descending else '__gt'
+        if field == 'id':
+            children = children.filter(**{'id' + after: item_id})
+        else:
+            children = children.filter(
+                Q(**{field + after: value}) |
+                Q(**{field: value, 'id' + after: item_id}))
+    items = list(children[:size + 1])
+    if len(items) <= size:
+        return items, None
+    items = items[:size]
+    last = items[-1]
+    return items, encode_cursor(getattr(last, field), last.id)
+
+
+def explore_etag(request):
+    """
+    Weak ETag of the explore response, tied to the version of the listing,
+    to the access of users, to the user it is generated for and to the page
+    asked for.
+    """
+    if not request.GET.get('key', None) or request.vault_user is None:
+        return None
+    if request.GET.get('sort', 'id').lstrip('-') in UNVERSIONED_SORT_KEYS:
+        return None
+    version = listing_version(request.GET.get('parent', None))
+    if version is None:
+        return None
+    query = sorted((name, value) for name, value in request.GET.items() if
+                   name != 'key')
+    page = hashlib.md5(json.dumps(query).encode()).hexdigest()[:12]
+    return 'W/"{0}.{1}.{2}.{3}"'.format(version, get_generation('acl'),
+                                        request.vault_user.id, page)
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=explore_etag)
 def explore(request):
     """
-    Return files and folders contained in a location
-    :param request: The request object
+    Return a page of the files and folders contained in a location that the
+    user can access
+    :param request: The request object, with the parameters
+        key: API key of the user
+        parent: Id of the location, the root locations if missing
+        sort: One of SORT_KEYS, prefixed with '-' for descending order
+        cursor: The `next` cursor of the previous page
+        limit: Number of items on a page, up to MAX_PAGE_SIZE
+        fields: Comma separated FIELDS to return, all of them if missing
     :return: JSON response
     """
     key = request.GET.get('key', None)
     if not key:
-        return HttpResponse(json.dumps({"error": "No key provided"}), 401)
-    user = Token.objects.filter(key=key)
-    if len(user) == 0:
-        return HttpResponse(json.dumps({"error": "Invalid key"}), 401)
-    user = user[0].user
+        return error("No key provided", 401)
+    user = request.vault_user
+    if user is None:
+        return error("Invalid key", 401)
     parent = request.GET.get('parent', None)
-    children = get_children(parent, user)
+    sort = request.GET.get('sort', 'id')
+    if sort.lstrip('-') not in SORT_KEYS:
+        return error("Unknown sort key, use one of {0}".format(
+            ', '.join(sorted(SORT_KEYS))))
+    try:
+        limit = int(request.GET.get('limit', getattr(
+            settings, 'EXPLORE_PAGE_SIZE', PAGE_SIZE)))
+    except ValueError:
+        return error("Invalid limit")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    fields = request.GET.get('fields', None)
+    if fields:
+        fields = [field.strip() for field in fields.split(',')]
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            return error("Unknown fields {0}".format(', '.join(unknown)))
+    else:
+        fields = FIELDS
+    children = get_children(parent, user).select_related(
+        'type', 'album', 'video_codec', 'audio_codec')
+    if 'artist' in fields:
+        children = children.prefetch_related('artist')
+    try:
+        children, cursor = page_of(children, sort,
+                                   request.GET.get('cursor', None), limit)
+    except ValueError:
+        return error("Invalid cursor")
     children_dict = []
     for child in children:
-        children_dict.append(child.dictify())
+        children_dict.append(child.dictify(fields))
     return_dict = {
         "parent": parent,
         "number": len(children_dict),
-        "children": children_dict
+        "children": children_dict,
+        "next": cursor
     }
     return HttpResponse(json.dumps(return_dict))
+
+
+@cache_control(private=True, no_cache=True)
+def tree(request):
+    """
+    Stream the items below a location that the user can access, one JSON
+    object per line, see web/export.py
+    :param request: The request object, with the parameters
+        key: API key of the user
+        parent: Id of the location, all locations if missing
+        since: ISO 8601 time, e.g. the `since` of the last line of the
+        previous export, to only return the items modified after it
+    :return: Streaming NDJSON response
+    """
+    key = request.GET.get('key', None)
+    if not key:
+        return error("No key provided", 401)
+    user = request.vault_user
+    if user is None:
+        return error("Invalid key", 401)
+    top = None
+    parent = request.GET.get('parent', None)
+    if parent:
+        try:
+            top = SharedItem.objects.get(id=int(parent))
+        except (ValueError, SharedItem.DoesNotExist):
+            return error("No such item", 404)
+        try:
+            checked_path(top)
+        except ValueError as e:
+            return error(str(e), 503)
+    since = request.GET.get('since', None)
+    if since:
+        try:
+            since = parse_datetime(since)
+        except ValueError:
+            since = None
+        if since is None:
+            return error("Invalid since, use an ISO 8601 time")
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+    lines = (json.dumps(record) + '\n' for record in
+             export_tree(user, top, since or None))
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+
+@cache_control(private=True, no_cache=True)
+def search(request):
+    """
+    Search the items the user can access, best matches first
+    :param request: The request object, with the parameters
+        key: API key of the user
+        q: Search query, matching words starting with each of its words
+        start: The `next` of the previous page
+        limit: Number of items on a page, up to MAX_PAGE_SIZE
+    :return: JSON response
+    """
+    key = request.GET.get('key', None)
+    if not key:
+        return error("No key provided", 401)
+    user = request.vault_user
+    if user is None:
+        return error("Invalid key", 401)
+    query = request.GET.get('q', '')
+    try:
+        start = max(0, int(request.GET.get('start', 0)))
+        limit = int(request.GET.get('limit', getattr(
+            settings, 'EXPLORE_PAGE_SIZE', PAGE_SIZE)))
+    except ValueError:
+        return error("Invalid start or limit")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    items, next_start = search_items(user, query, start, limit)
+    results = [item.dictify() for item in items]
+    return HttpResponse(json.dumps({
+        "query": query,
+        "number": len(results),
+        "results": results,
+        "next": next_start
+    }))
@@ -0,0 +1,64 @@
+"""
+Configuration of gunicorn serving MediaVault, used by run.py.
+
+Every setting can be changed with the MEDIAVAULT_* environment variable
+named next to it. Workers are forked from a master process that has loaded
+the application already, and each of them serves requests from a pool of
+threads, so that a few processes can hold many long media streams open at
+once. The master restarts workers gracefully on SIGHUP, e.g. after an
+upgrade, letting them finish what they serve for up to `graceful_timeout`
+seconds - media players resume interrupted streams with range requests,
+and downloads cut off are resumed by the new workers.
+"""
+import multiprocessing
+import os
+
+
+def env(name, default):
+    return type(default)(os.environ.get('MEDIAVAULT_' + name, default))
+
+
+bind = env('BIND', '0.0.0.0:8000')
+workers = env('WORKERS', multiprocessing.cpu_count())
+worker_class = 'gthread'
+# Threads of each worker, i.e. the number of requests, media streams
+# included, a worker serves at once
+threads = env('THREADS', 16)
+# Seconds a worker may stop responding to the master before it is
+# restarted. Requests served by threads do not hold the master up, so this
+# does not limit how long a media stream lasts.
+timeout = env('TIMEOUT', 60)
+graceful_timeout = env('GRACEFUL_TIMEOUT', 30)
+keepalive = env('KEEPALIVE', 5)
+# Workers are not restarted after a number of requests, as background
+# tasks such as downloads and access changes run in their threads and
+# would be cut off.
+preload_app = env('PRELOAD', 1) == 1
+pidfile = env('PIDFILE', os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'mediavault.pid'))
+accesslog = env('ACCESS_LOG', '-')
+errorlog = env('ERROR_LOG', '-')
+
+raw_env = ['DJANGO_SETTINGS_MODULE=' + env('SETTINGS',
+                                           'mediavault.production')]
+
+
+def post_fork(server, worker):
+    # Connections opened while preloading belong to the master
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+
+def post_worker_init(worker):
+    # Downloads interrupted by the last stop are resumed by whichever
+    # worker gets to them first
+    from web.downloads import resume_later
+    resume_later()
+
+
+def worker_exit(server, worker):
+    # Write the views counted in memory by the worker
+    from web import counters
+    if counters._counter is not None:
+        counters._counter.flush()
@@ -0,0 +1,25 @@
+"""
+ASGI config for mediavault project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``, serving the WSGI application with media streamed from an
+event loop, see web/asgi.py. Run it with an ASGI server, e.g. -
+
+    $ uvicorn mediavault.asgi:application
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mediavault.production")
+
+wsgi_application = get_wsgi_application()
+
+from web.asgi import ASGIHandler  # noqa: E402
+from web.downloads import resume_later  # noqa: E402
+
+application = ASGIHandler(wsgi_application)
+# Downloads interrupted by the last stop are resumed by whichever worker
+# gets to them first
+resume_later()
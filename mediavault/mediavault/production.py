@@ -0,0 +1,53 @@
+"""
+Settings for serving MediaVault in production, see run.py. They are the
+development settings with debugging off, secrets and hosts read from the
+environment, and static files collected into STATIC_ROOT and served by the
+application itself unless SERVE_STATIC is turned off for a web server in
+front of it to serve them.
+"""
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR
+
+
+def required(name):
+    value = os.environ.get(name, '').strip()
+    if not value:
+        raise ImproperlyConfigured('Set the {0} environment variable to serve '
+                                   'MediaVault in production'.format(name))
+    return value
+
+
+DEBUG = False
+
+SECRET_KEY = required('MEDIAVAULT_SECRET_KEY')
+
+# Comma separated host names the site is served under
+ALLOWED_HOSTS = [host.strip() for host in
+                 required('MEDIAVAULT_ALLOWED_HOSTS').split(',') if
+                 host.strip()]
+
+STATIC_ROOT = os.environ.get('MEDIAVAULT_STATIC_ROOT',
+                             os.path.join(BASE_DIR, 'static'))
+SERVE_STATIC = os.environ.get('MEDIAVAULT_SERVE_STATIC', '1') == '1'
+# Seconds for which browsers may reuse static files
+STATIC_MAX_AGE = 24 * 3600
+
+# Keep database connections open between requests of a worker thread
+CONN_MAX_AGE = 60
+
+# A cache shared by all worker processes, so that a user or API key that is
+# changed or deleted is forgotten by all of them at once
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('MEDIAVAULT_CACHE_DIR',
+                                   os.path.join(BASE_DIR, 'cache')),
+    }
+}
+
+# gunicorn copies media files to clients with os.sendfile, outside Python
+MEDIA_DELIVERY = os.environ.get('MEDIAVAULT_MEDIA_DELIVERY', 'file-wrapper')
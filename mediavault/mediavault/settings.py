@@ -46,6 +46,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'web.middleware.VaultUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -76,6 +77,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Tests of background tasks write from several threads, which an
+        # in-memory database would refuse rather than wait for
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
     }
 }
 
@@ -134,3 +138,64 @@ STATICFILES_FINDERS = (
 
 MEDIA_URL = '/static-media/'
 MEDIA_ROOT = '/'
+
+# Media delivery
+# One of 'stream', 'file-wrapper', 'x-sendfile' or 'x-accel-redirect'. See
+# web/delivery.py for what each of them does.
+MEDIA_DELIVERY = os.environ.get('MEDIAVAULT_MEDIA_DELIVERY', 'stream')
+# For 'x-accel-redirect', files under MEDIA_ACCEL_ROOT are redirected to
+# the internal nginx location MEDIA_ACCEL_LOCATION, e.g. -
+#     location /protected-media/ { internal; alias /; }
+MEDIA_ACCEL_ROOT = '/'
+MEDIA_ACCEL_LOCATION = '/protected-media/'
+# Seconds for which browsers may reuse media without revalidating it
+MEDIA_CACHE_MAX_AGE = 3600
+
+# Directory, size budget in bytes and browser cache lifetime in seconds of
+# thumbnails. Thumbnail URLs carry the modification time of their file, so
+# they can be cached for long.
+THUMBNAIL_ROOT = os.path.join(BASE_DIR, 'thumbnails')
+THUMBNAIL_CACHE_SIZE = 256 << 20
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+# Worker processes reading media metadata in the background, and whether to
+# ask ffprobe (when installed) about files the built-in parsers cannot read
+METADATA_WORKERS = 2
+METADATA_USE_FFPROBE = True
+
+# Threads running background tasks, and the number of items below which
+# changes to a whole subtree are made within the request instead
+TASK_WORKERS = 2
+SUBTREE_TASK_THRESHOLD = 2000
+# Seconds after which a pending or running task that the process running it
+# did not stamp is taken for interrupted by a restart, see web/tasks.py
+TASK_HEARTBEAT_TIMEOUT = 60
+
+# Seconds between writes of the view counts gathered in memory, and whether
+# to also record which users saw which items
+VIEW_FLUSH_INTERVAL = 10
+VIEW_RECORD_SEEN = True
+
+# Seconds for which users and API keys are cached by the middleware setting
+# request.vault_user
+USER_CACHE_TIMEOUT = 60
+
+# Seconds for which rendered directory listings are cached, at most how old
+# the view counts they show get
+LISTING_CACHE_TIMEOUT = 300
+
+# Seconds to connect to YouTube and to wait for data when searching, and
+# for which the results of a search are reused
+YOUTUBE_TIMEOUT = (3.05, 10)
+YOUTUBE_CACHE_TIMEOUT = 600
+
+# Threads downloading online videos, the directory they are downloaded to
+# and the class making downloads, see web/downloads.py
+DOWNLOAD_WORKERS = 2
+DOWNLOAD_DIR = os.path.join(BASE_DIR, 'downloads')
+DOWNLOADER = 'web.downloads.YoutubeDL'
+
+# Threads of the ASGI application building responses, and reading files for
+# the media streams it sends from its event loop, see web/asgi.py
+ASGI_THREADS = 32
+ASGI_READ_THREADS = 16
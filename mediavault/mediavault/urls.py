@@ -13,12 +13,17 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.conf.urls import url, include
 from django.contrib import admin
 
+from web.views import static_file
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^api/', include('api.urls')),
     url(r'^', include('web.urls'))
 ]
+
+if not settings.DEBUG and getattr(settings, 'SERVE_STATIC', False):
+    urlpatterns.insert(0, url(r'^static/(?P<path>.+)$', static_file))
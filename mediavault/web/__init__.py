@@ -1,13 +1,3 @@
-import os
-
-import magic
-import re
-import requests
-import threading
-import subprocess
-
-INF = float('inf')
-
 media_mimes = {
     'Directory': 'directory',
     'video/3gpp': 'video',
@@ -40,7 +30,6 @@ media_mimes = {
     'video/x-ms-asf': 'video',
     'video/x-msvideo': 'video'
 }
-identifier = magic.Magic(mime=True)
 
 
 def is_media(mime):
@@ -52,101 +41,31 @@ def media_type(mime):
 
 
 def youtube_search(query):
-    raw_html = requests.get(
-        'https://www.youtube.com/results?search_query={0}'.format(query))
-    vids = get_videos(raw_html.text)
-    return [get_video_attrs(vid) for vid in vids]
+    from .youtube import get_client
+    return get_client().search(query)
 
 
 def get_videos(html):
     """
     separate videos in html
     """
-    first = html.find('yt-lockup-tile')
-    html = html[first + 2:]
-    vid = []
-    while True:
-        pos = html.find('yt-lockup-tile')
-        if pos == -1:
-            pos = INF
-            vid.append(html)
-            break
-        vid.append(html[:pos + 2])
-        html = html[pos + 3:]
-    return vid
+    from .youtube import split_tiles
+    return split_tiles(html)
 
 
 def get_video_attrs(html):
     """
     get video attributes from html
     """
-    result = {}
-    # get video id and description
-    regex = 'yt\-lockup\-title.*?href.*?watch\?v\=(.*?[^\"]+)'
-    regex += '.*? title\=\"(.*?[^\"]+)'
-    temp = re.findall(regex, html)
-    if len(temp) and len(temp[0]) == 2:
-        result['id'] = temp[0][0]
-        result['title'] = temp[0][1]
-    # length
-    length_regex = 'video\-time.*?\>([^\<]+)'
-    temp = re.findall(length_regex, html)
-    if len(temp) > 0:
-        result['length'] = temp[0].strip()
-    # uploader
-    upl_regex = 'yt\-lockup\-byline.*?\>.*?\>([^\<]+)'
-    temp = re.findall(upl_regex, html)
-    if len(temp) > 0:
-        result['uploader'] = temp[0].strip()
-    # time ago
-    time_regex = 'yt\-lockup\-meta\-info.*?\>.*?\>([^\<]+).*?([0-9\,]+)'
-    temp = re.findall(time_regex, html)
-    if len(temp) and len(temp[0]) == 2:
-        result['time'] = temp[0][0]
-        result['views'] = temp[0][1]
-    # thumbnail
-    if 'id' in result:
-        thumb = 'http://img.youtube.com/vi/%s/0.jpg' % result['id']
-        result['thumb'] = thumb
-    else:
-        return None
-    # Description
-    desc_regex = 'yt-lockup-description.*?>(.*?)<'
-    temp = re.findall(desc_regex, html)
-    if len(temp) > 0:
-        result['description'] = temp[0]
-    else:
-        result['description'] = ''
-    return result
+    from .youtube import parse_tile
+    return parse_tile(html)
 
 
 def download_video(vid_id, user=None):
-    if not os.path.isdir('downloads'):
-        os.mkdir(os.getcwd() + '/downloads')
-    thread = threading.Thread(target=download_video_real, args=[vid_id, user])
-    thread.start()
-
-
-def download_video_real(vid_id, user):
-    command = 'cd downloads/ && youtube-dl https://www.youtube.com/watch?v=' \
-              '{0}'.format(vid_id)
-    subprocess.call(command, shell=True)
-    from .models import add_item_recursive
-    add_item_recursive(os.getcwd() + '/downloads', user, 'all', None)
+    from .downloads import enqueue
+    return enqueue(vid_id, False, user)
 
 
 def download_audio(vid_id, user=None):
-    if not os.path.isdir('downloads'):
-        os.mkdir(os.getcwd() + '/downloads')
-    thread = threading.Thread(target=download_audio_real, args=[vid_id, user])
-    thread.start()
-    from .models import add_item_recursive
-    add_item_recursive(os.getcwd() + '/downloads', user, 'all', None)
-
-
-def download_audio_real(vid_id, user):
-    command = 'cd downloads/ && youtube-dl --extract-audio https://www.youtu' \
-              'be.com/watch?v={0}'.format(vid_id)
-    subprocess.call(command, shell=True)
-    from .models import add_item_recursive
-    add_item_recursive(os.getcwd() + '/downloads', user, 'all', None)
+    from .downloads import enqueue
+    return enqueue(vid_id, True, user)
@@ -0,0 +1,315 @@
+"""
+Access of users to shared items.
+
+Access is stored sparsely as AccessGrant rows - an allow or a deny, for one
+user or for everyone, at any item. A grant holds for the item and
+everything below it until a grant nearer to an item says otherwise. At the
+same item a grant for the user wins over one for everyone, and items with no
+grant on their way up to the root are not accessible.
+
+Effective access is resolved for a batch of items from the grants on their
+way up the tree, read off the tree index (see web/tree.py), and the answers
+are cached per user in the memory of the process. The caches are dropped
+whenever the 'acl' generation changes, which every change to grants or to
+the shape of the tree bumps.
+"""
+import threading
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.db.models import Exists, OuterRef, Q
+from django.db.transaction import atomic
+
+from .models import AccessGrant, SharedItem, bump_generation, \
+    get_generation, prefixed
+from .tree import CHUNK_SIZE, chunks, descendant_ids, lineages, path_ids
+
+GENERATION = 'acl'
+MAX_CACHED_USERS = 64
+MAX_CACHED_ITEMS = 200000
+# Grants deciding for a user past which accessible_filter() gives up
+MAX_FILTER_GRANTS = 200
+
+_caches = OrderedDict()
+_classes = {}
+_lock = threading.Lock()
+
+
+def deciding_grants(user_id, item_ids):
+    """
+    :return: Dict of item id to whether the grant deciding for the user at
+    that item allows access, for those of `item_ids` that have one
+    """
+    decided = {}
+    for chunk in chunks(item_ids):
+        for item_id, grant_user_id, allow in AccessGrant.objects.filter(
+                Q(user_id=user_id) | Q(user__isnull=True),
+                item_id__in=chunk).values_list('item_id', 'user_id',
+                                               'allow'):
+            if grant_user_id is not None or item_id not in decided:
+                decided[item_id] = allow
+    return decided
+
+
+def subtree_grants(user_id, tree_path):
+    """
+    :return: Dict of item id to whether the grant deciding for the user at
+    that item allows access, for the items at or below `tree_path` that have
+    one
+    """
+    decided = {}
+    for item_id, grant_user_id, allow in AccessGrant.objects.filter(
+            Q(user_id=user_id) | Q(user__isnull=True),
+            prefixed('item__tree_path', tree_path)).values_list(
+            'item_id', 'user_id', 'allow'):
+        if grant_user_id is not None or item_id not in decided:
+            decided[item_id] = allow
+    return decided
+
+
+class AccessResolver(object):
+    """
+    Resolves the access of one user to items, remembering the answers.
+    """
+
+    def __init__(self, user, cache=None):
+        """
+        :param user: User whose access is resolved
+        :param cache: Dict of item id to access to fill, shared between
+        resolvers of the same user
+        """
+        self.user_id = user.id
+        self.cache = {} if cache is None else cache
+
+    def resolve(self, item_ids):
+        """
+        :param item_ids: Ids of items
+        :return: Dict of item id to True if the user can access the item
+        """
+        item_ids = set(item_ids)
+        if len(self.cache) > MAX_CACHED_ITEMS:
+            self.cache.clear()
+        pending = [item_id for item_id in item_ids if
+                   item_id not in self.cache]
+        # The grants that matter are those on the way up from each pending
+        # item to its root or to the nearest item with a cached answer.
+        lineage = lineages(pending)
+        needed = set()
+        for item_id in pending:
+            for node in reversed(lineage.get(item_id, [item_id])):
+                if node in self.cache:
+                    break
+                needed.add(node)
+        decided = deciding_grants(self.user_id, needed)
+        for item_id in pending:
+            path = []
+            allowed = False
+            for node in reversed(lineage.get(item_id, [item_id])):
+                if node in self.cache:
+                    allowed = self.cache[node]
+                    break
+                if node in decided:
+                    allowed = decided[node]
+                    self.cache[node] = allowed
+                    break
+                path.append(node)
+            for node in path:
+                self.cache[node] = allowed
+        return {item_id: self.cache[item_id] for item_id in item_ids}
+
+
+def acl_class(user, generation):
+    """
+    Class of users whose access is the same as the one of `user`. Users
+    without grants of their own all see what grants for everyone allow, so
+    they share the class 'all'.
+    :param generation: Current 'acl' generation
+    :return: Class name
+    """
+    with _lock:
+        entry = _classes.get(user.id)
+    if entry is None or entry[0] != generation:
+        own = AccessGrant.objects.filter(user_id=user.id).exists()
+        entry = (generation, 'user.{0}'.format(user.id) if own else 'all')
+        with _lock:
+            _classes[user.id] = entry
+    return entry[1]
+
+
+def get_resolver(user):
+    """
+    Resolver for `user` using the cache of the process for the user, if it
+    is still valid.
+    """
+    generation = get_generation(GENERATION)
+    with _lock:
+        entry = _caches.pop(user.id, None)
+        if entry is None or entry[0] != generation:
+            entry = (generation, {})
+        _caches[user.id] = entry
+        while len(_caches) > MAX_CACHED_USERS:
+            _caches.popitem(last=False)
+    return AccessResolver(user, entry[1])
+
+
+def can_access(user, item):
+    return get_resolver(user).resolve([item.id])[item.id]
+
+
+def accessible_items(user, items):
+    """
+    Those of `items` that `user` can access, in order.
+    """
+    items = list(items)
+    access = get_resolver(user).resolve(item.id for item in items)
+    return [item for item in items if access[item.id]]
+
+
+def accessible_children(user, parent=None):
+    """
+    QuerySet of the children of `parent` that `user` can access, the access
+    being checked by the query itself. A child inherits the access to its
+    parent unless a grant at the child decides otherwise, so only the
+    grants at the children are looked at.
+    :param parent: SharedItem, or None for the root items
+    """
+    if parent is None:
+        items = SharedItem.objects.filter(is_root=True)
+        inherited = False
+    else:
+        items = parent.children.all()
+        inherited = can_access(user, parent)
+    grants = AccessGrant.objects.filter(item=OuterRef('pk'))
+    items = items.annotate(
+        user_allow=Exists(grants.filter(user_id=user.id, allow=True)),
+        user_deny=Exists(grants.filter(user_id=user.id, allow=False)),
+        all_allow=Exists(grants.filter(user__isnull=True, allow=True)),
+        all_deny=Exists(grants.filter(user__isnull=True, allow=False)))
+    allowed = Q(user_allow=True) | Q(user_deny=False, all_allow=True)
+    if inherited:
+        allowed |= Q(user_deny=False, all_deny=False)
+    return items.filter(allowed)
+
+
+def accessible_filter(user):
+    """
+    Q object matching the items `user` can access, for narrowing down
+    queries over the whole library. An item is accessible when the nearest
+    grant deciding for the user on its way up allows it, that is when it is
+    below an allowing grant and not below a denying grant further down.
+    :return: Q object, or None if the user has too many grants to spell them
+    out or some of them are not in the tree index
+    """
+    grants = list(AccessGrant.objects.filter(
+        Q(user_id=user.id) | Q(user__isnull=True)).values_list(
+        'item_id', 'user_id', 'allow', 'item__tree_path')[
+        :MAX_FILTER_GRANTS + 1])
+    if len(grants) > MAX_FILTER_GRANTS:
+        return None
+    decided = {}
+    for item_id, grant_user_id, allow, tree_path in grants:
+        if not tree_path:
+            return None
+        if grant_user_id is not None or item_id not in decided:
+            decided[item_id] = (tree_path, allow)
+    allowed = [path for path, allow in decided.values() if allow]
+    denied = [path for path, allow in decided.values() if not allow]
+    accessible = Q(pk__in=[])
+    for top in allowed:
+        subtree = prefixed('tree_path', top)
+        for path in denied:
+            if path != top and path.startswith(top):
+                subtree &= ~prefixed('tree_path', path)
+        accessible |= subtree
+    return accessible
+
+
+def users_by_access(item):
+    """
+    Split the users by whether they can access `item`, with one query for
+    the users, which only loads their id and username.
+    :return: Tuple of the list of users who can access `item` and the list
+    of those who cannot
+    """
+    chain = list(reversed(path_ids(item.tree_path))) or [item.id]
+    grants = {}
+    for item_id, user_id, allow in AccessGrant.objects.filter(
+            item_id__in=chain).values_list('item_id', 'user_id', 'allow'):
+        grants.setdefault(item_id, {})[user_id] = allow
+    chain = [grants[item_id] for item_id in chain if item_id in grants]
+    allowed = []
+    denied = []
+    for user in User.objects.only('id', 'username').order_by('id'):
+        access = False
+        for granted in chain:
+            if user.id in granted or None in granted:
+                access = granted.get(user.id, granted.get(None))
+                break
+        (allowed if access else denied).append(user)
+    return allowed, denied
+
+
+def set_grant(item_id, user_id, allow):
+    """
+    Allow or deny access to an item, replacing the grant at the item for the
+    same user.
+    :param user_id: Id of the user, or None for everyone
+    """
+    if AccessGrant.objects.filter(item_id=item_id, user_id=user_id).update(
+            allow=allow) == 0:
+        AccessGrant.objects.create(item_id=item_id, user_id=user_id,
+                                   allow=allow)
+
+
+def grant_subtree(item, user, allow, below=None, progress=None):
+    """
+    Allow or deny access to `item` and everything below it, overriding the
+    grants further down that say otherwise.
+    :param item: SharedItem
+    :param user: User, or None for everyone
+    :param allow: True to allow access, False to deny it
+    :param below: Ids of all items below `item`, if already known
+    :param progress: Function called with the number of items handled and
+    the total after every chunk
+    :return: Tuple of the number of items covered and of grants created or
+    removed
+    """
+    if below is None:
+        below = descendant_ids(item)
+    total = len(below) + 1
+    changed = 0
+    # The grant at the item comes first, then every chunk below it is
+    # committed on its own, so that the write lock is never held for long
+    # and progress shows. Until a chunk is done, the grants left in it only
+    # keep the access those items had before.
+    with atomic():
+        if user is None:
+            # Grants for single users at the item would stand in the way.
+            changed += AccessGrant.objects.filter(
+                item_id=item.id, user__isnull=False).delete()[0]
+        set_grant(item.id, user and user.id, allow)
+        bump_generation(GENERATION)
+    for done, chunk in enumerate(chunks(below)):
+        with atomic():
+            if user is None:
+                # And so would all grants below it.
+                changed += AccessGrant.objects.filter(
+                    item_id__in=chunk).delete()[0]
+            else:
+                changed += AccessGrant.objects.filter(
+                    item_id__in=chunk, user=user).delete()[0]
+                # Where a grant for everyone says otherwise, the user needs a
+                # grant of their own.
+                overridden = AccessGrant.objects.filter(
+                    item_id__in=chunk, user__isnull=True).exclude(
+                    allow=allow).values_list('item_id', flat=True)
+                grants = [AccessGrant(item_id=item_id, user=user, allow=allow)
+                          for item_id in overridden]
+                AccessGrant.objects.bulk_create(grants)
+                changed += len(grants)
+            bump_generation(GENERATION)
+        if progress:
+            progress(min(total - 1, (done + 1) * CHUNK_SIZE), total)
+    if progress:
+        progress(total, total)
+    return total, changed + 1
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class WebConfig(AppConfig):
     name = 'web'
+
+    def ready(self):
+        # Connects the signals dropping cached users
+        from . import middleware  # noqa: F401
@@ -0,0 +1,269 @@
+"""
+ASGI application serving MediaVault from an event loop, see
+mediavault/asgi.py.
+
+Requests are handled by the WSGI application of Django in a pool of
+ASGI_THREADS threads, which only holds a thread for as long as Django
+builds the response. Bodies are then sent from the event loop: a media
+file handed to wsgi.file_wrapper (the 'file-wrapper' delivery backend, see
+web/delivery.py) is read in CHUNK_SIZE chunks by a pool of
+ASGI_READ_THREADS threads. So a viewer on a slow connection costs a
+coroutine and one chunk of memory instead of a thread for the length of the
+movie.
+
+Any other streamed body, e.g. the export of /api/tree, is a generator
+querying the database as it goes. Django keeps a connection per thread, so
+such a body is iterated chunk by chunk and closed on one thread of its own,
+which closes its connections once the response is done.
+
+A chunk is only read once the previous one was taken by the server, which
+waits for the client to drain its buffer, and a stream stops at the first
+chunk after the client disconnects.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .streaming import CHUNK_SIZE
+
+THREADS = 32
+READ_THREADS = 16
+
+
+class FileStream(object):
+    """
+    wsgi.file_wrapper of the ASGI application, marking the body of a
+    response as a file to read from the event loop.
+    """
+
+    def __init__(self, f, block_size=CHUNK_SIZE):
+        self.f = f
+        self.block_size = block_size
+
+    def __iter__(self):
+        # Only used if the body is iterated by middleware
+        while True:
+            data = self.f.read(self.block_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+def wsgi_environ(scope, body):
+    """
+    :return: WSGI environ of the HTTP request of an ASGI `scope`
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    path = scope['path'][len(scope.get('root_path', '')):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version',
+                                                       '1.1')),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileStream,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+def call_wsgi(wsgi_application, environ):
+    """
+    Run a WSGI application up to the response body.
+    :return: Tuple of the status code, the headers and the body iterable
+    """
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+
+    content = wsgi_application(environ, start_response)
+    return started[0], started[1], content
+
+
+def next_chunk(iterator):
+    return next(iterator, None)
+
+
+def close_body(content, own_thread=False):
+    """
+    Close the body of a response, which ends the request for Django, and
+    the database connections of the thread closing it.
+    :param own_thread: Whether the thread was the one of the response only
+    """
+    try:
+        close = getattr(content, 'close', None)
+        if close is not None:
+            close()
+    finally:
+        close_old_connections()
+        # A connection kept for CONN_MAX_AGE on a thread of a single
+        # response would never be used again
+        if own_thread:
+            connections.close_all()
+
+
+class ASGIHandler(object):
+    """
+    ASGI application running a WSGI application, with the bodies of its
+    responses sent asynchronously.
+    """
+
+    def __init__(self, wsgi_application, threads=None, read_threads=None):
+        """
+        :param wsgi_application: The WSGI application of Django
+        :param threads: Threads building responses, ASGI_THREADS if None
+        :param read_threads: Threads reading files, ASGI_READ_THREADS if
+        None
+        """
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(
+            threads or getattr(settings, 'ASGI_THREADS', THREADS))
+        self.read_executor = ThreadPoolExecutor(
+            read_threads or getattr(settings, 'ASGI_READ_THREADS',
+                                    READ_THREADS))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        # Write the views counted in memory by the process
+        from . import counters
+        if counters._counter is not None:
+            counters._counter.flush()
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        status, headers, content = await loop.run_in_executor(
+            self.executor, call_wsgi, self.wsgi_application,
+            wsgi_environ(scope, b''.join(body)))
+        if isinstance(content, FileStream) or not getattr(
+                content, 'streaming', True):
+            body_executor = self.executor
+        else:
+            body_executor = ThreadPoolExecutor(1)
+        disconnected = asyncio.Event()
+        watcher = loop.create_task(self.watch(receive, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(name.lower().encode('latin-1'),
+                                     value.strip().encode('latin-1'))
+                                    for name, value in headers]})
+            if scope['method'] == 'HEAD':
+                pass
+            elif isinstance(content, FileStream):
+                await self.send_file(content, headers, send, disconnected)
+            elif not getattr(content, 'streaming', True):
+                # Responses that are not streamed are complete already
+                await send({'type': 'http.response.body',
+                            'body': b''.join(content), 'more_body': True})
+            else:
+                await self.send_iterator(content, send, disconnected,
+                                         body_executor)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            try:
+                await loop.run_in_executor(
+                    body_executor, close_body, content,
+                    body_executor is not self.executor)
+            finally:
+                if body_executor is not self.executor:
+                    body_executor.shutdown(wait=False)
+
+    @staticmethod
+    async def watch(receive, disconnected):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    async def send_file(self, stream, headers, send, disconnected):
+        """
+        Send the bytes of a file response from the current position of its
+        file, Content-Length of them.
+        """
+        loop = asyncio.get_running_loop()
+        remaining = next((int(value) for name, value in headers if
+                          name.lower() == 'content-length'), None)
+        fd = stream.f.fileno()
+        offset = stream.f.tell()
+        if remaining is None:
+            remaining = os.fstat(fd).st_size - offset
+        while remaining > 0 and not disconnected.is_set():
+            data = await loop.run_in_executor(
+                self.read_executor, os.pread, fd,
+                min(stream.block_size, remaining), offset)
+            if not data:
+                break
+            offset += len(data)
+            remaining -= len(data)
+            await send({'type': 'http.response.body', 'body': data,
+                        'more_body': True})
+
+    async def send_iterator(self, content, send, disconnected, executor):
+        """
+        Send a streamed body, iterated in `executor`, the thread of the
+        response.
+        """
+        loop = asyncio.get_running_loop()
+        iterator = await loop.run_in_executor(executor, iter, content)
+        while not disconnected.is_set():
+            data = await loop.run_in_executor(executor, next_chunk, iterator)
+            if data is None:
+                break
+            if data:
+                await send({'type': 'http.response.body', 'body': data,
+                            'more_body': True})
@@ -0,0 +1,139 @@
+"""
+Write-behind counting of views of shared items.
+
+A view only adds to counts kept in the memory of the process, so that
+pages never wait for a write. A background thread flushes the counts every
+VIEW_FLUSH_INTERVAL seconds with one `views = views + n` UPDATE per chunk of
+items viewed the same number of times, and with VIEW_RECORD_SEEN also adds
+the viewers to `seen_by`. Since the updates are increments, every process
+serving requests can keep counts of its own.
+"""
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.db.transaction import atomic
+
+from .models import SharedItem, update_scores
+from .tree import CHUNK_SIZE, chunks
+
+FLUSH_INTERVAL = 10
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+class ViewCounter(object):
+    """
+    Counts of views waiting to be written, with the thread writing them.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, record_seen=True):
+        """
+        :param interval: Seconds between two flushes
+        :param record_seen: If True, also record which users saw items
+        """
+        self.interval = interval
+        self.record_seen = record_seen
+        self.lock = threading.Lock()
+        self.views = {}
+        self.seen = set()
+        self.thread = None
+
+    def add(self, item_id, user_id=None):
+        with self.lock:
+            self.views[item_id] = self.views.get(item_id, 0) + 1
+            if self.record_seen and user_id is not None:
+                self.seen.add((item_id, user_id))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def pending(self, item_id):
+        """
+        :return: Number of views of an item not written yet
+        """
+        with self.lock:
+            return self.views.get(item_id, 0)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print('Flushing view counts failed - {0!r}'.format(e))
+            finally:
+                connection.close()
+
+    def flush(self):
+        """
+        Write the counts gathered so far. If that fails they are kept for
+        the next flush.
+        :return: Number of items whose views were written
+        """
+        with self.lock:
+            views, self.views = self.views, {}
+            seen, self.seen = self.seen, set()
+        if not views and not seen:
+            return 0
+        try:
+            with atomic():
+                by_count = {}
+                for item_id, count in views.items():
+                    by_count.setdefault(count, []).append(item_id)
+                for count, item_ids in by_count.items():
+                    for chunk in chunks(item_ids):
+                        SharedItem.objects.filter(id__in=chunk).update(
+                            views=F('views') + count)
+                self.store_seen(seen)
+                update_scores(views)
+        except Exception:
+            with self.lock:
+                for item_id, count in views.items():
+                    self.views[item_id] = self.views.get(item_id, 0) + count
+                self.seen |= seen
+            raise
+        return len(views)
+
+    @staticmethod
+    def store_seen(seen):
+        """
+        Add the (item id, user id) pairs of `seen` to the seen_by relation,
+        skipping those already there and items that are gone.
+        """
+        through = SharedItem.seen_by.through
+        user_ids = list(set(user_id for _, user_id in seen))
+        pairs = []
+        for chunk in chunks(set(item_id for item_id, _ in seen)):
+            present = set(SharedItem.objects.filter(id__in=chunk).values_list(
+                'id', flat=True))
+            known = set(through.objects.filter(
+                shareditem_id__in=chunk, user_id__in=user_ids).values_list(
+                'shareditem_id', 'user_id'))
+            pairs.extend(pair for pair in seen if pair[0] in present and
+                         pair not in known)
+        through.objects.bulk_create(
+            [through(shareditem_id=item_id, user_id=user_id) for
+             item_id, user_id in pairs], batch_size=CHUNK_SIZE)
+
+
+def get_counter():
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            _counter = ViewCounter(
+                getattr(settings, 'VIEW_FLUSH_INTERVAL', FLUSH_INTERVAL),
+                getattr(settings, 'VIEW_RECORD_SEEN', True))
+            atexit.register(_counter.flush)
+        return _counter
+
+
+def count_view(item, user=None):
+    """
+    Count a view of `item` by `user`, without writing anything.
+    """
+    get_counter().add(item.id, user and user.id)
@@ -0,0 +1,151 @@
+"""
+Backends to hand the bytes of a media file over to the client.
+
+The backend is chosen with the MEDIA_DELIVERY setting -
+    'stream' - Read the file in chunks inside the Django process.
+    'file-wrapper' - Give the open file to the WSGI server's
+        wsgi.file_wrapper, so that servers like gunicorn or mod_wsgi copy it
+        with os.sendfile, and the ASGI application of web/asgi.py reads it
+        from its event loop. 'sendfile', its former name, still works.
+    'x-sendfile' - Only send an X-Sendfile header, for Apache (mod_xsendfile)
+        or lighttpd sitting in front of the application.
+    'x-accel-redirect' - Only send an X-Accel-Redirect header, for nginx.
+"""
+import os
+from urllib.parse import quote
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .streaming import parse_range_header, stream_file, CHUNK_SIZE, \
+    add_validators, not_modified, requested_range
+
+BACKENDS = ('stream', 'file-wrapper', 'x-sendfile', 'x-accel-redirect')
+ALIASES = {'sendfile': 'file-wrapper'}
+
+
+class OpenFileResponse(StreamingHttpResponse):
+    """
+    Streaming response over an already open file, positioned at the first
+    byte to send. The file is exposed as `file_to_stream` so that the WSGI
+    handler passes it to wsgi.file_wrapper.
+    """
+
+    def __init__(self, f, length, *args, **kwargs):
+        super(OpenFileResponse, self).__init__(
+            self.read_open_file(f, length), *args, **kwargs)
+        self.file_to_stream = f
+        self._closable_objects.append(f)
+        self['Content-Length'] = str(length)
+
+    @staticmethod
+    def read_open_file(f, length):
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def get_backend():
+    backend = getattr(settings, 'MEDIA_DELIVERY', 'stream').lower()
+    backend = ALIASES.get(backend, backend)
+    if backend not in BACKENDS:
+        raise ValueError('Unknown MEDIA_DELIVERY backend {0}'.format(backend))
+    return backend
+
+
+def deliver_file(request, path, content_type, stat=None, max_age=None):
+    """
+    Build the response that sends the file at `path` to the client, using
+    the backend configured in settings.
+    :param request: The request object
+    :param path: Path of the file on the host
+    :param content_type: MIME type of the file
+    :param stat: Result of os.stat() on the file, if already known
+    :param max_age: Seconds for which clients may reuse the file, by
+    default MEDIA_CACHE_MAX_AGE
+    :return: Response object
+    """
+    if stat is None:
+        stat = os.stat(path)
+    if max_age is None:
+        max_age = getattr(settings, 'MEDIA_CACHE_MAX_AGE', 0)
+    response = not_modified(request, stat)
+    if response is not None:
+        return add_validators(response, stat, max_age)
+    backend = get_backend()
+    response = None
+    if backend == 'x-sendfile':
+        response = offload_response('X-Sendfile', path, content_type)
+    elif backend == 'x-accel-redirect':
+        location = accel_location(path)
+        if location is not None:
+            response = offload_response('X-Accel-Redirect', location,
+                                        content_type)
+    elif backend == 'file-wrapper':
+        response = file_wrapper_response(request, path, content_type, stat)
+    if response is None:
+        response = stream_file(request, path, content_type, stat)
+    return add_validators(response, stat, max_age)
+
+
+def offload_response(header, value, content_type):
+    """
+    Response with an empty body asking the front proxy to send the file.
+    The proxy takes care of ranges and conditional requests itself. The
+    body is streamed so that no Content-Length of 0 is added, which is not
+    the length of the file the client gets.
+    """
+    response = StreamingHttpResponse(iter(()), content_type=content_type)
+    response[header] = value
+    return response
+
+
+def accel_location(path):
+    """
+    Map a path on the host to the internal nginx location serving it, or
+    None if the path lies outside MEDIA_ACCEL_ROOT.
+    """
+    root = os.path.abspath(getattr(settings, 'MEDIA_ACCEL_ROOT', '/'))
+    location = getattr(settings, 'MEDIA_ACCEL_LOCATION', '/protected-media/')
+    path = os.path.abspath(path)
+    if root != '/' and not path.startswith(root + '/'):
+        return None
+    relative = path[len(root):].lstrip('/')
+    return location.rstrip('/') + '/' + quote(relative)
+
+
+def file_wrapper_response(request, path, content_type, stat=None):
+    """
+    Response over an open file for zero-copy transfer by the WSGI server.
+    Returns None when the request has to be handled by the streaming
+    backend instead.
+    """
+    file_wrapper = request.META.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        return None
+    if stat is None:
+        stat = os.stat(path)
+    size = stat.st_size
+    ranges = parse_range_header(requested_range(request, stat), size)
+    if ranges is None:
+        start, end, status = 0, size - 1, 200
+    elif len(ranges) == 1 and file_wrapper is not FileWrapper:
+        # wsgiref's FileWrapper reads till the end of the file regardless of
+        # Content-Length, so only servers with their own wrapper get ranges.
+        (start, end), status = ranges[0], 206
+    else:
+        return None
+    f = open(path, 'rb')
+    f.seek(start)
+    response = OpenFileResponse(f, end - start + 1, status=status,
+                                content_type=content_type)
+    if status == 206:
+        response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end,
+                                                               size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,201 @@
+"""
+MIME type detection for files being shared.
+
+Files whose extension maps to exactly one type are answered from a table
+without being opened. Only the rest is sniffed with libmagic, using one
+handle per thread, and those answers are cached in the database keyed by
+path, size and modification time.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import magic
+from django.db.transaction import atomic
+
+from .models import MimeCacheEntry, prefixed
+
+WORKERS = 8
+BATCH_SIZE = 500
+
+# Extensions that are trusted to tell the type of a file. Containers that
+# may hold either audio or video (webm, ogg, 3gp, ...) are left to libmagic.
+TRUSTED_EXTENSIONS = {
+    'aac': 'audio/x-aac',
+    'asf': 'video/x-ms-asf',
+    'avi': 'video/x-msvideo',
+    'flv': 'video/x-flv',
+    'gif': 'image/gif',
+    'jpe': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'm3u': 'audio/x-mpegurl',
+    'm4a': 'audio/mp4',
+    'm4v': 'video/x-m4v',
+    'mkv': 'video/x-matroska',
+    'mp3': 'audio/mpeg',
+    'mp4': 'video/mp4',
+    'mpeg': 'video/mpeg',
+    'mpg': 'video/mpeg',
+    'oga': 'audio/ogg',
+    'ogv': 'video/ogg',
+    'png': 'image/png',
+    'tif': 'image/tiff',
+    'tiff': 'image/tiff',
+    'wav': 'audio/x-wav',
+    'wma': 'audio/x-ms-wma',
+    'wmv': 'video/x-ms-wmv',
+    # Common companions of media files that are not media themselves
+    'ini': 'text/plain',
+    'json': 'application/json',
+    'log': 'text/plain',
+    'md': 'text/plain',
+    'nfo': 'text/plain',
+    'pdf': 'application/pdf',
+    'srt': 'text/plain',
+    'sub': 'text/plain',
+    'txt': 'text/plain',
+    'vtt': 'text/vtt',
+    'xml': 'application/xml',
+    'zip': 'application/zip',
+}
+
+_local = threading.local()
+
+
+def extension_mime(path):
+    """
+    MIME type of the file at `path` going by its extension alone, or None
+    if the extension is unknown or ambiguous.
+    """
+    extension = os.path.splitext(path)[1][1:].lower()
+    return TRUSTED_EXTENSIONS.get(extension)
+
+
+def sniff(path):
+    """
+    MIME type of the file at `path` using the libmagic handle of the
+    current thread, or None if the file cannot be read.
+    """
+    identifier = getattr(_local, 'identifier', None)
+    if identifier is None:
+        identifier = _local.identifier = magic.Magic(mime=True)
+    try:
+        return identifier.from_file(path)
+    except (OSError, magic.MagicException):
+        return None
+
+
+class MimeDetector(object):
+    """
+    Detects MIME types of many files at once and counts how each of them
+    was answered.
+    """
+
+    def __init__(self, workers=WORKERS, batch_size=BATCH_SIZE):
+        """
+        :param workers: Number of threads sniffing files with libmagic
+        :param batch_size: Number of paths per cache query
+        """
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stats = {'extension': 0, 'cache': 0, 'magic': 0}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '{extension} by extension, {cache} from cache, {magic} ' \
+               'sniffed'.format(**self.stats)
+
+    def executor(self):
+        """
+        Pool of the threads sniffing files, started on first use and kept
+        for the life of the detector.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='mime-detector')
+            return self._executor
+
+    def close(self):
+        """
+        Stop the threads sniffing files.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def detect(self, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        return self.detect_all([(path, stat)])[0]
+
+    def detect_all(self, entries):
+        """
+        :param entries: List of (path, stat result) of files
+        :return: List of MIME types (None for unreadable files) in order
+        """
+        mimes = [extension_mime(path) for path, _ in entries]
+        pending = [i for i, mime in enumerate(mimes) if mime is None]
+        self.stats['extension'] += len(entries) - len(pending)
+        misses = []
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            cached = {
+                path: (size, mtime, mime) for path, size, mtime, mime in
+                MimeCacheEntry.objects.filter(
+                    path__in=[entries[i][0] for i in chunk]).values_list(
+                    'path', 'size', 'mtime', 'mime')
+            }
+            for i in chunk:
+                path, stat = entries[i]
+                size, mtime, mime = cached.get(path, (None, None, None))
+                if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+                    mimes[i] = mime
+                else:
+                    misses.append(i)
+        self.stats['cache'] += len(pending) - len(misses)
+        if len(misses) == 0:
+            return mimes
+        sniffed = list(self.executor().map(
+            sniff, [entries[i][0] for i in misses], chunksize=64))
+        self.stats['magic'] += len(misses)
+        for i, mime in zip(misses, sniffed):
+            mimes[i] = mime
+        self.store([(entries[i], mime) for i, mime in zip(misses, sniffed) if
+                    mime is not None])
+        return mimes
+
+    def store(self, results):
+        """
+        Cache sniffed MIME types, replacing stale entries for the paths.
+        :param results: List of ((path, stat result), mime)
+        """
+        with atomic():
+            for start in range(0, len(results), self.batch_size):
+                chunk = results[start:start + self.batch_size]
+                MimeCacheEntry.objects.filter(
+                    path__in=[path for (path, _), _ in chunk]).delete()
+                MimeCacheEntry.objects.bulk_create([
+                    MimeCacheEntry(path=path, size=stat.st_size,
+                                   mtime=stat.st_mtime_ns, mime=mime)
+                    for (path, stat), mime in chunk
+                ])
+
+    def forget(self, paths, directories=()):
+        """
+        Drop the cached MIME types of files that are gone.
+        :param paths: Paths of the files
+        :param directories: Paths of directories that are gone, whose files
+        are all dropped
+        """
+        with atomic():
+            for start in range(0, len(paths), self.batch_size):
+                MimeCacheEntry.objects.filter(
+                    path__in=paths[start:start + self.batch_size]).delete()
+            for directory in directories:
+                MimeCacheEntry.objects.filter(
+                    prefixed('path', directory + '/')).delete()
@@ -0,0 +1,258 @@
+"""
+Queue of downloads of online videos into the library.
+
+Every download is a background task (see web/tasks.py) run by a pool of
+DOWNLOAD_WORKERS threads of its own, so that its state and progress show on
+any page and downloads never hold up other tasks. A download asked for
+again while it is still pending or running is not queued twice.
+
+The file a download produces is shared under the DOWNLOAD_DIR directory
+item on its own, instead of rescanning the whole directory. Downloads are
+made by the downloader named by the DOWNLOADER setting, which tests can
+replace with set_downloader(), e.g. by a LocalDownloader copying a file.
+"""
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import SharedItem, Task
+from .tasks import FAILED, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, \
+    INTERRUPTED, PENDING, RUNNING, orphans, reap_orphans, submit
+
+KIND = 'download'
+QUEUE = 'downloads'
+DOWNLOADER = 'web.downloads.YoutubeDL'
+# Names of downloaded videos and audio, with the title and id of the video.
+# They differ so that the audio and the video of one video never mix up.
+TEMPLATES = {
+    'video': '%(title)s-%(id)s.%(ext)s',
+    'audio': '%(title)s-%(id)s-audio.%(ext)s',
+}
+PARTIAL = ('.part', '.ytdl', '.temp')
+PROGRESS = re.compile(r'\[download\]\s+([0-9.]+)%')
+# Result of interrupted downloads once they are queued again
+RESUMED = 'Interrupted, queued again'
+VIDEO_ID = re.compile(r'[A-Za-z0-9_-]{11}')
+
+_downloader = None
+_ingest_lock = threading.Lock()
+
+
+def download_dir():
+    return getattr(settings, 'DOWNLOAD_DIR',
+                   os.path.join(os.getcwd(), 'downloads'))
+
+
+def media_kind(audio):
+    return 'audio' if audio else 'video'
+
+
+def produced_file(directory, video_id, audio=False):
+    """
+    :return: Path of the finished video, or audio if `audio`, of a video in
+    `directory`, or None
+    """
+    marker = '-{0}{1}.'.format(video_id, '-audio' if audio else '')
+    for name in sorted(os.listdir(directory)):
+        if marker in name and not name.endswith(PARTIAL):
+            return os.path.join(directory, name)
+    return None
+
+
+class YoutubeDL(object):
+    """
+    Downloads videos with the youtube-dl command.
+    """
+
+    def __init__(self, command='youtube-dl'):
+        self.command = command
+
+    def download(self, video_id, audio, directory, progress):
+        """
+        :param video_id: Id of the YouTube video
+        :param audio: If True, only keep the audio
+        :param directory: Directory to download to
+        :param progress: Function taking the per mille downloaded and 1000
+        :return: Path of the file downloaded
+        """
+        args = [self.command, '--newline', '--no-playlist', '-o',
+                os.path.join(directory, TEMPLATES[media_kind(audio)])]
+        if audio:
+            args.append('--extract-audio')
+        args.append('https://www.youtube.com/watch?v={0}'.format(video_id))
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        output = []
+        reported = None
+        for line in process.stdout:
+            output.append(line)
+            match = PROGRESS.search(line)
+            if match:
+                # youtube-dl prints many lines per per mille, only report
+                # when it changes (the reporter of the task also limits
+                # how often it is written)
+                done = int(float(match.group(1)) * 10)
+                if done != reported:
+                    reported = done
+                    progress(done, 1000)
+        if process.wait() != 0:
+            raise RuntimeError('youtube-dl exited with {0} - {1}'.format(
+                process.returncode, ''.join(output[-3:]).strip()))
+        path = produced_file(directory, video_id, audio)
+        if path is None:
+            raise RuntimeError('youtube-dl left no file for {0}'.format(
+                video_id))
+        return path
+
+
+class LocalDownloader(object):
+    """
+    Downloads every video by copying a local file, for tests and for
+    trying the queue out without the network.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def download(self, video_id, audio, directory, progress):
+        extension = os.path.splitext(self.source)[1]
+        path = os.path.join(directory, '{0}-{1}{2}'.format(
+            media_kind(audio), video_id, extension))
+        shutil.copyfile(self.source, path)
+        progress(1000, 1000)
+        return path
+
+
+def get_downloader():
+    global _downloader
+    if _downloader is None:
+        _downloader = import_string(getattr(settings, 'DOWNLOADER',
+                                            DOWNLOADER))()
+    return _downloader
+
+
+def set_downloader(downloader):
+    global _downloader
+    _downloader = downloader
+
+
+def ingest(path, user):
+    """
+    Share a downloaded file under the download directory item, sharing the
+    directory with everyone first if it is not yet.
+    :return: SharedItem of the file
+    """
+    from .extraction import extract_in_background
+    from .scanner import scan_library
+    directory = os.path.dirname(path)
+    with _ingest_lock:
+        parent = SharedItem.objects.filter(path=directory).first()
+        if parent is None:
+            scan_library(directory, user, 'all')
+        else:
+            scan_library(path, user, 'inherit', parent)
+    extract_in_background()
+    return SharedItem.objects.filter(path=path).first()
+
+
+def download(video_id, audio, user, progress):
+    """
+    Download a video and share the file.
+    :return: Tuple of the name of the file
+    """
+    directory = download_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = get_downloader().download(video_id, audio, directory, progress)
+    ingest(path, user)
+    return os.path.basename(path),
+
+
+def task_key(video_id, audio):
+    return '{0}:{1}:{2}'.format(KIND, media_kind(audio), video_id)
+
+
+def enqueue(video_id, audio=False, user=None):
+    """
+    Queue the download of a YouTube video, unless it is already queued.
+    :param video_id: Id of the video
+    :param audio: If True, only keep the audio
+    :param user: User asking for it, who shares the file
+    :return: Task of the download
+    :raise ValueError: If `video_id` is not the id of a YouTube video
+    """
+    if not VIDEO_ID.fullmatch(video_id):
+        raise ValueError('Invalid video id {0!r}'.format(video_id))
+    description = 'Download {0} of {1}'.format(media_kind(audio), video_id)
+    return submit(KIND, description, download, video_id, audio, user,
+                  user=user, message='Downloaded {0}',
+                  key=task_key(video_id, audio), queue=QUEUE)
+
+
+def resume(everything=False):
+    """
+    Queue again the downloads interrupted by processes that stopped - those
+    they left pending or running and those already reaped as interrupted.
+    Every download is taken by one caller only, so that all processes can
+    resume downloads as they start.
+    :param everything: If True, take every pending or running download for
+    interrupted, when no process serving the site runs. Otherwise only those
+    whose heartbeat stopped, see tasks.orphans().
+    :return: Number of downloads queued
+    """
+    if everything:
+        interrupted = Task.objects.filter(state__in=(PENDING, RUNNING))
+    else:
+        interrupted = orphans()
+    interrupted = interrupted | Task.objects.filter(state=FAILED,
+                                                    result=INTERRUPTED)
+    count = 0
+    for task in interrupted.filter(kind=KIND):
+        _, media, video_id = task.key.split(':', 2)
+        if Task.objects.filter(id=task.id, state=task.state,
+                               result=task.result).update(
+                state=FAILED, result=RESUMED, active_key=None,
+                time_finished=timezone.now()) == 0:
+            continue
+        enqueue(video_id, media == 'audio', task.user)
+        count += 1
+    return count
+
+
+def resume_later():
+    """
+    Resume interrupted downloads in the background once the tasks of
+    processes that stopped just before this one started are taken for
+    interrupted, called by every process serving the site as it starts.
+    """
+    def run():
+        try:
+            count = resume()
+            if count:
+                print('Resumed {0} interrupted downloads'.format(count))
+        except Exception as e:
+            print('Cannot resume downloads - {0!r}'.format(e))
+        finally:
+            connection.close()
+
+    timeout = getattr(settings, 'TASK_HEARTBEAT_TIMEOUT', HEARTBEAT_TIMEOUT)
+    timer = threading.Timer(timeout + HEARTBEAT_INTERVAL, run)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def user_downloads(user, limit=10):
+    """
+    :return: List of the downloads asked for by `user`, newest first
+    """
+    reap_orphans()
+    return list(Task.objects.filter(kind=KIND, user=user).order_by(
+        '-time_created')[:limit])
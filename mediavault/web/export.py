@@ -0,0 +1,98 @@
+"""
+Export of the tree of shared items a user can access, for clients keeping
+a copy of the library to use offline.
+
+Items are read in the order of their tree_path, a chunk per query, so that
+every item comes after the items above it and its access follows from the
+grant at the item, if there is one, or else from the access to its parent.
+The grants deciding for the user in the subtree are read up front with a
+single query, so exporting n items takes about 2 n / EXPORT_CHUNK_SIZE + 3
+queries whatever the shape of the tree.
+
+A delta export only describes the items modified since a given time (see
+touch_listing()). Modification times are stamped when a change commits
+rather than when it is made, so the start of an export is a safe time to
+export since the next time. Changes to access or to the shape of the tree do not stamp
+every item they affect, so a delta export across one of them is a full one.
+Deleted items are not described; instead the last record of a delta export
+lists the ids of all items the user can access, so that clients can drop
+the others.
+"""
+from django.conf import settings
+from django.utils import timezone
+
+from .access import GENERATION, get_resolver, subtree_grants
+from .models import Generation, SharedItem, prefixed
+from .tree import SEPARATOR, ancestor_ids, checked_path, path_ids
+
+CHUNK_SIZE = 1000
+
+
+def is_full(since):
+    """
+    :return: True if a delta export since `since` has to be a full one
+    """
+    return since is None or Generation.objects.filter(
+        name=GENERATION, time_changed__gt=since).exists()
+
+
+def describe(item, parent_id):
+    record = item.dictify()
+    record.update({
+        "parent": parent_id,
+        "depth": item.depth,
+        "time_added": item.time_added.isoformat(),
+        "time_modified": item.time_modified.isoformat()
+    })
+    return record
+
+
+def export_tree(user, top=None, since=None):
+    """
+    Generate descriptions of the items of a subtree that `user` can access.
+    :param user: User
+    :param top: SharedItem at the top of the subtree, or None for all items
+    :param since: Aware datetime, to only describe the items modified after
+    it
+    :return: Generator of the dictify() of items along with their parent,
+    depth and times, then of a last {"end": summary} dictionary holding the
+    time to export since the next time
+    """
+    started = timezone.now()
+    full = is_full(since)
+    prefix = SEPARATOR if top is None else checked_path(top)
+    decided = subtree_grants(user.id, prefix)
+    access = {}
+    if top is not None and ancestor_ids(top):
+        access.update(get_resolver(user).resolve(ancestor_ids(top)[-1:]))
+    items = SharedItem.objects.filter(prefixed('tree_path', prefix)) \
+        .select_related('type', 'album', 'video_codec', 'audio_codec') \
+        .prefetch_related('artist').order_by('tree_path')
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', CHUNK_SIZE)
+    present = []
+    count = 0
+    last = ''
+    while True:
+        chunk = list(items.filter(tree_path__gt=last)[:chunk_size])
+        for item in chunk:
+            ids = path_ids(item.tree_path)
+            parent_id = ids[-2] if len(ids) > 1 else None
+            allowed = decided.get(item.id, access.get(parent_id, False))
+            access[item.id] = allowed
+            if not allowed:
+                continue
+            present.append(item.id)
+            if full or item.time_modified > since:
+                count += 1
+                yield describe(item, parent_id)
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1].tree_path
+    summary = {
+        "count": count,
+        "full": full,
+        "since": started.isoformat()
+    }
+    if not full:
+        summary["present"] = present
+    yield {"end": summary}
@@ -0,0 +1,211 @@
+"""
+Background extraction of media metadata into the SharedItem fields.
+
+Items whose file changed since their metadata was last read (or that were
+never read) are probed in a pool of worker processes, see web/metadata, and
+the results are written back a batch at a time. Codecs, albums and artists
+are looked up once per run.
+
+The workers are spawned as fresh interpreters rather than forked, because a
+run is started from a thread of a multithreaded web worker, and a forked
+child would inherit the locks other threads happened to hold.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.db.transaction import atomic
+
+from . import media_type, search
+from .metadata import probe
+from .models import SharedItem, ItemType, VideoCodec, AudioCodec, Album, \
+    Artist, touch_listings
+
+WORKERS = 2
+BATCH_SIZE = 100
+
+FIELDS = ('duration', 'title', 'album', 'year', 'video_codec',
+          'video_frame_rate', 'video_bit_rate', 'height', 'width',
+          'audio_codec', 'audio_channels', 'audio_sample_rate',
+          'audio_bit_rate')
+
+_lock = threading.Lock()
+_state = {'running': False, 'requested': False}
+
+
+def media_items():
+    types = [item_type.id for item_type in ItemType.objects.all() if
+             media_type(item_type.type) in ('audio', 'video')]
+    return SharedItem.objects.filter(type__in=types)
+
+
+def pending_items():
+    """
+    Audio and video items whose metadata has not been read since their
+    file last changed.
+    """
+    return media_items().filter(
+        Q(metadata_mtime__isnull=True) | ~Q(metadata_mtime=F('mtime')))
+
+
+class MetadataExtractor(object):
+    """
+    Reads the metadata of many items in worker processes and stores it.
+    """
+
+    def __init__(self, workers=None, batch_size=BATCH_SIZE,
+                 use_ffprobe=None):
+        """
+        :param workers: Number of worker processes
+        :param batch_size: Number of items written back at once
+        :param use_ffprobe: Fall back to ffprobe for files the parsers
+        cannot handle
+        """
+        if workers is None:
+            workers = getattr(settings, 'METADATA_WORKERS', WORKERS)
+        if use_ffprobe is None:
+            use_ffprobe = getattr(settings, 'METADATA_USE_FFPROBE', True)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.use_ffprobe = use_ffprobe
+        self.stats = {'extracted': 0, 'failed': 0}
+        self.related = {VideoCodec: {}, AudioCodec: {}, Album: {}, Artist: {}}
+
+    def __str__(self):
+        return '{extracted} extracted, {failed} failed'.format(**self.stats)
+
+    def lookup(self, model, **fields):
+        """
+        Id of the row of `model` with `fields`, created if missing.
+        """
+        key = tuple(sorted(fields.items()))
+        cache = self.related[model]
+        if key not in cache:
+            cache[key] = model.objects.get_or_create(**fields)[0].id
+        return cache[key]
+
+    def field_values(self, metadata):
+        """
+        Values for SharedItem.objects.update() from a probe() result.
+        Fields missing from `metadata` are cleared.
+        """
+        values = {field: metadata.get(field) for field in FIELDS}
+        values['title'] = values['title'] and values['title'][:2048]
+        for field, model in (('video_codec', VideoCodec),
+                             ('audio_codec', AudioCodec)):
+            codec = values.pop(field)
+            values[field + '_id'] = codec and self.lookup(model,
+                                                          codec=codec[:128])
+        album = values.pop('album')
+        values['album_id'] = album and self.lookup(Album, name=album[:50])
+        return values
+
+    def artist_ids(self, names):
+        ids = []
+        for name in names:
+            first_name, _, last_name = name.rpartition(' ')
+            if not first_name:
+                first_name, last_name = last_name, ''
+            ids.append(self.lookup(Artist, first_name=first_name[:30],
+                                   last_name=last_name[:30]))
+        return ids
+
+    def run(self, items=None):
+        """
+        Extract the metadata of `items`, the pending items by default.
+        Batches are written back while the workers probe the next one.
+        :param items: Queryset of SharedItem
+        :return: Number of items processed
+        """
+        if items is None:
+            items = pending_items()
+        items = items.order_by('id').values_list('id', 'path', 'mtime')
+        extract = partial(probe, use_ffprobe=self.use_ffprobe)
+        last_id = 0
+        previous = None
+        with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            while True:
+                batch = list(items.filter(id__gt=last_id)[:self.batch_size])
+                if batch:
+                    last_id = batch[-1][0]
+                    results = executor.map(
+                        extract, [path for _, path, _ in batch],
+                        chunksize=max(1, len(batch) // (self.workers * 4)))
+                if previous is not None:
+                    self.store(*previous)
+                if not batch:
+                    break
+                previous = batch, results
+        return self.stats['extracted'] + self.stats['failed']
+
+    def store(self, batch, results):
+        """
+        Write the metadata of a batch of items back.
+        :param batch: List of (id, path, mtime) of the items
+        :param results: probe() results in the same order
+        """
+        through = SharedItem.artist.through
+        with atomic():
+            links = []
+            for (item_id, path, mtime), metadata in zip(batch, results):
+                if metadata is None:
+                    print('No metadata found for - {0}'.format(path))
+                    self.stats['failed'] += 1
+                    metadata = {}
+                else:
+                    self.stats['extracted'] += 1
+                values = self.field_values(metadata)
+                SharedItem.objects.filter(id=item_id).update(
+                    metadata_mtime=mtime if mtime is not None else 0,
+                    **values)
+                links.extend(through(shareditem_id=item_id, artist_id=artist)
+                             for artist in
+                             self.artist_ids(metadata.get('artist', [])))
+            through.objects.filter(
+                shareditem_id__in=[item_id for item_id, _, _ in batch]
+            ).delete()
+            through.objects.bulk_create(links)
+            # API listings include the metadata of the children
+            touch_listings(item_id for item_id, _, _ in batch)
+            search.index_items(item_id for item_id, _, _ in batch)
+
+
+def extract_pending():
+    """
+    Extract metadata of pending items until no more runs are requested.
+    """
+    try:
+        while True:
+            with _lock:
+                if not _state['requested']:
+                    _state['running'] = False
+                    return
+                _state['requested'] = False
+            extractor = MetadataExtractor()
+            extractor.run()
+            print('Metadata extraction - {0}'.format(extractor))
+    except BaseException:
+        with _lock:
+            _state['running'] = False
+        raise
+    finally:
+        connection.close()
+
+
+def extract_in_background():
+    """
+    Extract metadata of pending items in a background thread. If a run is
+    already going on, another one follows it.
+    """
+    with _lock:
+        _state['requested'] = True
+        if _state['running']:
+            return
+        _state['running'] = True
+    threading.Thread(target=extract_pending, daemon=True).start()
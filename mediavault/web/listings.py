@@ -0,0 +1,64 @@
+"""
+Cache of the rendered markup of directory listings.
+
+Listings are rendered once with the types of their items joined in, and
+kept in the cache of Django under a key made of the directory, its version
+(see touch_listing()), the 'acl' generation and the class of users it was
+rendered for (see access.acl_class()). Any change to the children of a
+directory or to access gives new keys, so entries never have to be
+dropped, and browsing a directory again costs one cache get. View counts
+shown in a listing are up to LISTING_CACHE_TIMEOUT seconds old.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .access import acl_class, accessible_children
+from .models import get_generation, listing_version
+
+TIMEOUT = 300
+
+
+def listing_key(parent, version, generation, acl, destination):
+    return 'listing:{0}:{1}:{2}:{3}:{4}'.format(
+        parent.id if parent else 'root', version, generation, acl,
+        destination)
+
+
+def render_items(items, destination):
+    items = items.select_related('type').order_by('name')
+    return ''.join(item._html(destination) for item in items)
+
+
+def cached_listing(key, render):
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(key, html, getattr(settings, 'LISTING_CACHE_TIMEOUT',
+                                     TIMEOUT))
+    return html
+
+
+def explore_listing(user, parent=None):
+    """
+    :param user: User browsing the directory
+    :param parent: SharedItem of the directory, or None for the root items
+    :return: Markup of the items in the directory that `user` can access
+    """
+    version = parent.version if parent else listing_version(None)
+    generation = get_generation('acl')
+    return cached_listing(
+        listing_key(parent, version, generation,
+                    acl_class(user, generation), 'media'),
+        lambda: render_items(accessible_children(user, parent), 'media'))
+
+
+def manage_listing(items, parent=None):
+    """
+    :param items: QuerySet of the items in the directory, all of them
+    :param parent: SharedItem of the directory, or None for the root items
+    :return: Markup of the items for the pages managing shared items
+    """
+    version = parent.version if parent else listing_version(None)
+    return cached_listing(
+        listing_key(parent, version, None, 'manage', 'shared-items'),
+        lambda: render_items(items, 'shared-items'))
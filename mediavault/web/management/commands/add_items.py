@@ -0,0 +1,35 @@
+"""
+Management command to add a file or directory tree to the shared items.
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from web.scanner import LibraryScanner, WORKERS
+
+
+class Command(BaseCommand):
+    help = 'Add a file or directory tree on the host to the shared items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('location', help='Path to add')
+        parser.add_argument('--permission', default='all',
+                            choices=('all', 'admin', 'self'),
+                            help='Who can access the new items')
+        parser.add_argument('--user', default=None,
+                            help='Username of the user adding the items, '
+                                 'required for --permission self')
+        parser.add_argument('--workers', type=int, default=WORKERS,
+                            help='Number of threads sniffing MIME types')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError('No such user {0}'.format(options['user']))
+        elif options['permission'] == 'self':
+            raise CommandError('--user is required for --permission self')
+        scanner = LibraryScanner(user, options['permission'],
+                                 workers=options['workers'])
+        count = scanner.scan(options['location'])
+        self.stdout.write('Successfully added {0} items'.format(count))
@@ -0,0 +1,28 @@
+"""
+Management command to read the metadata of shared audio and video files.
+"""
+from django.core.management.base import BaseCommand
+
+from web.extraction import MetadataExtractor, media_items, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Fill duration, codecs and tags of shared items from their files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Read all items again, not only new and '
+                                 'changed ones')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Number of items written back at once')
+        parser.add_argument('--no-ffprobe', action='store_true',
+                            help='Never fall back to ffprobe')
+
+    def handle(self, *args, **options):
+        extractor = MetadataExtractor(
+            workers=options['workers'], batch_size=options['batch_size'],
+            use_ffprobe=False if options['no_ffprobe'] else None)
+        extractor.run(media_items() if options['all'] else None)
+        self.stdout.write('Metadata - {0}'.format(extractor))
@@ -0,0 +1,97 @@
+"""
+Management command to turn the dense accessibility rows of earlier versions
+into sparse, inherited access grants.
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic
+
+from web.access import GENERATION
+from web.models import AccessGrant, ItemAccessibility, SharedItem, \
+    bump_generation
+
+BATCH_SIZE = 500
+
+
+def allowed_sets(queryset):
+    """
+    Users allowed each item, as a dict of item id to frozenset of user ids.
+    Equal sets are shared, so memory grows with the number of distinct sets
+    rather than with the number of rows.
+    """
+    interned = {}
+    allowed = {}
+    current, users = None, []
+
+    def finish():
+        if current is not None:
+            users_set = frozenset(users)
+            allowed[current] = interned.setdefault(users_set, users_set)
+
+    for item_id, user_id in queryset.order_by('item_id').values_list(
+            'item_id', 'user_id').iterator():
+        if item_id != current:
+            finish()
+            current, users = item_id, []
+        users.append(user_id)
+    finish()
+    return allowed
+
+
+def item_grants(item_id, allowed, inherited, everyone):
+    """
+    Fewest grants at an item that turn the access it inherits into the
+    access it had.
+    :param allowed: Set of ids of users who could access the item
+    :param inherited: Set of ids of users who can access its parent
+    :param everyone: Set of ids of all users
+    :return: List of AccessGrant
+    """
+    if allowed == inherited:
+        return []
+    options = [
+        [(user_id, True) for user_id in allowed - inherited] +
+        [(user_id, False) for user_id in inherited - allowed],
+        [(None, True)] + [(user_id, False) for user_id in
+                          everyone - allowed],
+        [(None, False)] + [(user_id, True) for user_id in allowed],
+    ]
+    return [AccessGrant(item_id=item_id, user_id=user_id, allow=allow) for
+            user_id, allow in min(options, key=len)]
+
+
+class Command(BaseCommand):
+    help = 'Convert the accessibility rows of earlier versions into access ' \
+           'grants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the old rows after the conversion')
+
+    def handle(self, *args, **options):
+        rows = ItemAccessibility.objects.count()
+        if rows == 0:
+            self.stdout.write('No accessibility rows to convert')
+            return
+        allowed = allowed_sets(ItemAccessibility.objects.filter(
+            accessible=True))
+        everyone = frozenset(User.objects.values_list('id', flat=True))
+        through = SharedItem.children.through
+        parent_of = dict(through.objects.values_list('to_shareditem_id',
+                                                     'from_shareditem_id'))
+        nothing = frozenset()
+        grants = []
+        for item_id in SharedItem.objects.values_list('id', flat=True):
+            parent_id = parent_of.get(item_id)
+            inherited = allowed.get(parent_id, nothing) if parent_id else \
+                nothing
+            grants.extend(item_grants(item_id, allowed.get(item_id, nothing),
+                                      inherited, everyone))
+        with atomic():
+            AccessGrant.objects.all().delete()
+            AccessGrant.objects.bulk_create(grants, batch_size=BATCH_SIZE)
+            if not options['keep']:
+                ItemAccessibility.objects.all().delete()
+            bump_generation(GENERATION)
+        self.stdout.write('Converted {0} accessibility rows into {1} grants'
+                          .format(rows, len(grants)))
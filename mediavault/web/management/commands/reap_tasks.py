@@ -0,0 +1,14 @@
+"""
+Management command to mark as failed the background tasks left pending or
+running by processes that stopped.
+"""
+from django.core.management.base import BaseCommand
+
+from web.tasks import reap_orphans
+
+
+class Command(BaseCommand):
+    help = 'Mark background tasks interrupted by a restart as failed'
+
+    def handle(self, *args, **options):
+        self.stdout.write('{0} tasks marked as failed'.format(reap_orphans()))
@@ -0,0 +1,18 @@
+"""
+Management command to fill the full text search index with all shared
+items, for libraries shared before the index existed.
+"""
+from django.core.management.base import BaseCommand
+
+from web.search import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full text search index of shared items'
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        if count is None:
+            self.stdout.write('FTS5 is not available, searches use LIKE')
+        else:
+            self.stdout.write('Indexed {0} items'.format(count))
@@ -0,0 +1,18 @@
+"""
+Management command to fill the tree index of shared items from the links
+between them, for libraries shared before the index existed.
+"""
+from django.core.management.base import BaseCommand
+
+from web.access import GENERATION
+from web.models import bump_generation
+from web.tree import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the tree paths and depths of all shared items'
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        bump_generation(GENERATION)
+        self.stdout.write('Indexed {0} items'.format(count))
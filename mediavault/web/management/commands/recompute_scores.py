@@ -0,0 +1,15 @@
+"""
+Management command to recompute the recommendation scores of all shared
+items, e.g. after ratings were changed outside of the web interface.
+"""
+from django.core.management.base import BaseCommand
+
+from web.models import update_scores
+
+
+class Command(BaseCommand):
+    help = 'Recompute the recommendation scores of all shared items'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Updated the scores of {0} items'.format(
+            update_scores()))
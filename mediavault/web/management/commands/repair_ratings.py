@@ -0,0 +1,16 @@
+"""
+Management command to bring the rating totals of shared items back in line
+with the ratings, e.g. after ratings were changed outside of the web
+interface.
+"""
+from django.core.management.base import BaseCommand
+
+from web.models import repair_ratings
+
+
+class Command(BaseCommand):
+    help = 'Recompute the rating totals of all shared items'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Repaired the rating totals of {0} items'.format(
+            repair_ratings()))
@@ -0,0 +1,21 @@
+"""
+Management command to bring shared items in line with the disk.
+"""
+from django.core.management.base import BaseCommand
+
+from web.scanner import rescan_library
+
+
+class Command(BaseCommand):
+    help = 'Rescan shared directory trees and pick up added, changed and ' \
+           'removed files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('locations', nargs='*',
+                            help='Paths of shared items to rescan, all root '
+                                 'items by default')
+
+    def handle(self, *args, **options):
+        added, updated, removed = rescan_library(options['locations'] or None)
+        self.stdout.write('{0} items added, {1} updated and {2} removed'
+                          .format(added, updated, removed))
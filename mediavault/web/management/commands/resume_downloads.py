@@ -0,0 +1,22 @@
+"""
+Management command to run again the downloads of online videos that were
+pending or running when the processes serving the site stopped.
+"""
+from django.core.management.base import BaseCommand
+
+from web.downloads import QUEUE, resume
+from web.tasks import get_executor
+
+
+class Command(BaseCommand):
+    help = 'Run the downloads interrupted by a restart'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Take every pending or running download for '
+                                 'interrupted, when the site is not running')
+
+    def handle(self, *args, **options):
+        count = resume(options['all'])
+        self.stdout.write('Queued {0} downloads'.format(count))
+        get_executor(QUEUE).shutdown(wait=True)
@@ -0,0 +1,33 @@
+"""
+Management command to keep shared items in line with the disk as it
+changes.
+"""
+from django.core.management.base import BaseCommand
+
+from web.watcher import LibraryWatcher, get_backend
+
+
+class Command(BaseCommand):
+    help = 'Watch shared root directories and apply file additions, ' \
+           'renames and deletions as they happen'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', action='store_true',
+                            help='Poll for changes instead of using inotify')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds between polls')
+        parser.add_argument('--debounce', type=float, default=0.5,
+                            help='Seconds of quiet before changes are '
+                                 'applied')
+        parser.add_argument('--max-delay', type=float, default=2.0,
+                            help='Most seconds a change waits during a '
+                                 'burst of events')
+
+    def handle(self, *args, **options):
+        backend = get_backend(options['poll'], options['interval'])
+        watcher = LibraryWatcher(backend, debounce=options['debounce'],
+                                 max_delay=options['max_delay'])
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,136 @@
+"""
+Extraction of technical details and tags from media files.
+
+The container is recognised from the first bytes of the file and parsed in
+pure Python, reading only the headers it needs. Files no parser knows, or
+that turn out to be damaged, are handed to ffprobe when it is installed.
+
+Nothing here touches the database so that probe() can run in worker
+processes, see web/extraction.py.
+"""
+import json
+import os
+import shutil
+import struct
+import subprocess
+from fractions import Fraction
+
+from . import matroska, mp4, mpeg, ogg, riff
+from .base import add_tag
+
+FFPROBE_TIMEOUT = 30
+
+INTEGER_FIELDS = ('year', 'video_frame_rate', 'video_bit_rate', 'width',
+                  'height', 'audio_channels', 'audio_sample_rate',
+                  'audio_bit_rate')
+
+
+def find_parser(header):
+    """
+    Parser module for a file starting with the bytes `header`, or None.
+    """
+    if header[4:8] == b'ftyp':
+        return mp4
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return matroska
+    if header[:4] == b'OggS':
+        return ogg
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return riff
+    if header[:3] == b'ID3' or (len(header) > 1 and header[0] == 0xFF and
+                                header[1] & 0xE0 == 0xE0):
+        return mpeg
+    return None
+
+
+def ffprobe(path):
+    """
+    Metadata of the file at `path` as reported by ffprobe, or None if
+    ffprobe is not installed or fails.
+    """
+    executable = shutil.which('ffprobe')
+    if executable is None:
+        return None
+    try:
+        output = subprocess.run(
+            [executable, '-v', 'quiet', '-print_format', 'json',
+             '-show_format', '-show_streams', path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            timeout=FFPROBE_TIMEOUT, check=True).stdout
+        report = json.loads(output.decode('utf-8', 'replace'))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+    metadata = {}
+    container = report.get('format', {})
+    if container.get('duration'):
+        metadata['duration'] = float(container['duration'])
+    for name, text in container.get('tags', {}).items():
+        add_tag(metadata, name, text)
+    for stream in report.get('streams', []):
+        prefix = stream.get('codec_type')
+        if prefix not in ('video', 'audio') or prefix + '_codec' in metadata:
+            continue
+        metadata[prefix + '_codec'] = stream.get('codec_name')
+        metadata[prefix + '_bit_rate'] = stream.get('bit_rate')
+        if prefix == 'video':
+            metadata['width'] = stream.get('width')
+            metadata['height'] = stream.get('height')
+            try:
+                metadata['video_frame_rate'] = float(
+                    Fraction(stream.get('avg_frame_rate', '')))
+            except (ValueError, ZeroDivisionError):
+                pass
+        else:
+            metadata['audio_channels'] = stream.get('channels')
+            metadata['audio_sample_rate'] = stream.get('sample_rate')
+    return metadata
+
+
+def normalize(metadata):
+    """
+    Round the numbers in `metadata` to what SharedItem stores and drop
+    unknown values.
+    """
+    result = {}
+    for key, value in metadata.items():
+        if key in INTEGER_FIELDS or key == 'duration':
+            try:
+                value = int(round(float(value)))
+            except (TypeError, ValueError, OverflowError):
+                continue
+            if value <= 0:
+                continue
+        elif not value:
+            continue
+        result[key] = value
+    return result
+
+
+def probe(path, use_ffprobe=True):
+    """
+    Read the technical details and tags of the media file at `path`.
+    :param path: Path of the file on the host
+    :param use_ffprobe: Ask ffprobe about files the parsers cannot handle
+    :return: Dict of SharedItem field names to values ('artist' is a list of
+    names), or None if nothing could be found out
+    """
+    metadata = None
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            parser = find_parser(f.read(12))
+            if parser is not None:
+                f.seek(0)
+                metadata = parser.parse(f, size)
+    except (OSError, EOFError, ValueError, IndexError, KeyError,
+            struct.error, ZeroDivisionError, OverflowError):
+        metadata = None
+    if use_ffprobe and not (metadata and metadata.get('duration')):
+        reported = ffprobe(path)
+        if reported:
+            for key, value in (metadata or {}).items():
+                reported.setdefault(key, value)
+            metadata = reported
+    if not metadata:
+        return None
+    return normalize(metadata) or None
@@ -0,0 +1,64 @@
+"""
+Helpers shared by the container parsers.
+
+Every parser fills a dict whose keys are the names of SharedItem fields -
+'duration' (seconds), 'title', 'artist' (list of names), 'album', 'year',
+'video_codec', 'video_frame_rate', 'video_bit_rate', 'width', 'height',
+'audio_codec', 'audio_channels', 'audio_sample_rate' and 'audio_bit_rate'.
+"""
+import re
+
+# Tag names (lower case) of the various formats mapped to metadata keys
+TAG_NAMES = {
+    'title': 'title',
+    'artist': 'artist',
+    'album': 'album',
+    'year': 'year',
+    'date': 'year',
+    'date_released': 'year',
+    'date_recorded': 'year',
+    'icrd': 'year',
+}
+
+
+def decode_text(data):
+    """
+    Decode text of unknown encoding, UTF-8 if it is valid else Latin-1.
+    """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def parse_year(value):
+    match = re.search(r'\d{4}', value)
+    if match is None:
+        return None
+    return int(match.group())
+
+
+def add_tag(metadata, name, value):
+    """
+    Add a tag to `metadata`. The first value of a tag wins, except for
+    artists which are collected. Unknown tags are ignored.
+    :param metadata: Dict being filled by a parser
+    :param name: Tag name as found in the file, e.g. 'TITLE' or 'date'
+    :param value: Text of the tag
+    """
+    key = TAG_NAMES.get(name.lower())
+    value = value.strip('\0 \t\r\n')
+    if key is None or not value:
+        return
+    if key == 'artist':
+        artists = metadata.setdefault('artist', [])
+        for artist in value.split(';'):
+            artist = artist.strip('\0 ')
+            if artist and artist not in artists:
+                artists.append(artist)
+    elif key not in metadata:
+        if key == 'year':
+            value = parse_year(value)
+            if value is None:
+                return
+        metadata[key] = value
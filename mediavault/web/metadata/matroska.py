@@ -0,0 +1,266 @@
+"""
+Parser for Matroska and WebM files.
+
+The Info, Tracks and Tags elements of the segment are read, skipping
+everything else by its size. Tags usually follow the clusters at the end of
+the file, in which case they are found through the SeekHead.
+"""
+import struct
+
+from .base import add_tag, decode_text
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TITLE = 0x7BA9
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+DEFAULT_DURATION = 0x23E383
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+AUDIO = 0xE1
+SAMPLING_FREQUENCY = 0xB5
+CHANNELS = 0x9F
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+TAG_TRACK_UID = 0x63C5
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_STRING = 0x4487
+CLUSTER = 0x1F43B675
+
+CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264',
+    'V_MPEGH/ISO/HEVC': 'hevc',
+    'V_MPEG4/ISO/ASP': 'mpeg4',
+    'V_MPEG2': 'mpeg2video',
+    'V_VP8': 'vp8',
+    'V_VP9': 'vp9',
+    'V_AV1': 'av1',
+    'V_THEORA': 'theora',
+    'A_AAC': 'aac',
+    'A_AC3': 'ac3',
+    'A_EAC3': 'eac3',
+    'A_DTS': 'dts',
+    'A_FLAC': 'flac',
+    'A_MPEG/L3': 'mp3',
+    'A_MPEG/L2': 'mp2',
+    'A_OPUS': 'opus',
+    'A_VORBIS': 'vorbis',
+}
+
+# Elements whose size is larger than this are not read as values
+MAX_VALUE_SIZE = 1 << 16
+
+
+def read_id(f):
+    data = f.read(1)
+    if not data or data[0] == 0:
+        raise EOFError('No element ID')
+    length = 9 - data[0].bit_length()
+    if length > 4:
+        raise ValueError('Invalid element ID')
+    return int.from_bytes(data + f.read(length - 1), 'big')
+
+
+def read_size(f):
+    """
+    Read an element data size, None for unknown sizes.
+    """
+    data = f.read(1)
+    if not data or data[0] == 0:
+        raise EOFError('No element size')
+    length = 9 - data[0].bit_length()
+    value = int.from_bytes(bytes([data[0] & (0xFF >> length)]) +
+                           f.read(length - 1), 'big')
+    if value == (1 << (7 * length)) - 1:
+        return None
+    return value
+
+
+def elements(f, start, end):
+    """
+    Iterate over the elements between the offsets `start` and `end` of `f`.
+    Iteration stops after an element of unknown size.
+    :return: Generator of (ID, data start, data size or None)
+    """
+    offset = start
+    while offset < end:
+        f.seek(offset)
+        try:
+            element_id = read_id(f)
+            size = read_size(f)
+        except EOFError:
+            return
+        data_start = f.tell()
+        yield element_id, data_start, size
+        if size is None:
+            return
+        offset = data_start + size
+
+
+def children(f, start, size):
+    """
+    Elements inside an element, as a dict of ID to list of (start, size).
+    """
+    found = {}
+    for element_id, data_start, data_size in elements(f, start, start + size):
+        found.setdefault(element_id, []).append((data_start, data_size))
+    return found
+
+
+def value(f, found, element_id, kind='uint'):
+    """
+    Value of the first child `element_id` in `found`, or None.
+    """
+    if element_id not in found:
+        return None
+    start, size = found[element_id][0]
+    if size is None or size > MAX_VALUE_SIZE:
+        return None
+    f.seek(start)
+    data = f.read(size)
+    if kind == 'uint':
+        return int.from_bytes(data, 'big')
+    if kind == 'float':
+        if size == 4:
+            return struct.unpack('>f', data)[0]
+        if size == 8:
+            return struct.unpack('>d', data)[0]
+        return None
+    return decode_text(data.rstrip(b'\0'))
+
+
+def parse_info(f, start, size, metadata, tracks):
+    found = children(f, start, size)
+    scale = value(f, found, TIMECODE_SCALE) or 1000000
+    duration = value(f, found, DURATION, 'float')
+    if duration:
+        metadata['duration'] = duration * scale / 1e9
+    title = value(f, found, TITLE, 'string')
+    if title:
+        add_tag(metadata, 'title', title)
+
+
+def parse_tracks(f, start, size, metadata, tracks):
+    """
+    Add the first video and the first audio track to `metadata`, and
+    remember the kind of every track by its UID in `tracks`.
+    """
+    for entry_start, entry_size in children(f, start, size).get(
+            TRACK_ENTRY, []):
+        if entry_size is None:
+            continue
+        found = children(f, entry_start, entry_size)
+        prefix = {1: 'video', 2: 'audio'}.get(value(f, found, TRACK_TYPE))
+        if prefix is None:
+            continue
+        tracks[value(f, found, TRACK_UID)] = prefix
+        if prefix + '_codec' in metadata:
+            continue
+        codec = value(f, found, CODEC_ID, 'string') or ''
+        metadata[prefix + '_codec'] = CODECS.get(
+            codec, codec.split('_', 1)[-1].lower())
+        if prefix == 'video':
+            frame_duration = value(f, found, DEFAULT_DURATION)
+            if frame_duration:
+                metadata['video_frame_rate'] = 1e9 / frame_duration
+            if VIDEO in found and found[VIDEO][0][1] is not None:
+                video = children(f, *found[VIDEO][0])
+                metadata['width'] = value(f, video, PIXEL_WIDTH)
+                metadata['height'] = value(f, video, PIXEL_HEIGHT)
+        elif AUDIO in found and found[AUDIO][0][1] is not None:
+            audio = children(f, *found[AUDIO][0])
+            metadata['audio_sample_rate'] = value(f, audio,
+                                                  SAMPLING_FREQUENCY,
+                                                  'float') or 8000
+            metadata['audio_channels'] = value(f, audio, CHANNELS) or 1
+
+
+def parse_tags(f, start, size, metadata, tracks):
+    """
+    Add global tags to `metadata`. Of the tags targeting a track only the
+    bit rate statistics written by mkvmerge are used.
+    """
+    for tag_start, tag_size in children(f, start, size).get(TAG, []):
+        if tag_size is None:
+            continue
+        found = children(f, tag_start, tag_size)
+        track = None
+        if TARGETS in found and found[TARGETS][0][1] is not None:
+            targets = children(f, *found[TARGETS][0])
+            track = value(f, targets, TAG_TRACK_UID)
+        for simple_start, simple_size in found.get(SIMPLE_TAG, []):
+            if simple_size is None:
+                continue
+            simple = children(f, simple_start, simple_size)
+            name = value(f, simple, TAG_NAME, 'string')
+            text = value(f, simple, TAG_STRING, 'string')
+            if not name or text is None:
+                continue
+            if not track:
+                add_tag(metadata, name, text)
+            elif name == 'BPS' and text.isdigit() and track in tracks:
+                metadata.setdefault(tracks[track] + '_bit_rate', int(text))
+
+
+HANDLERS = {
+    INFO: parse_info,
+    TRACKS: parse_tracks,
+    TAGS: parse_tags,
+}
+
+
+def parse(f, size):
+    """
+    :param f: File opened in binary mode
+    :param size: Size of the file
+    :return: Metadata dict, or None if the file has no segment
+    """
+    header = next(elements(f, 0, size), None)
+    if header is None or header[0] != EBML or header[2] is None:
+        return None
+    segment = next(elements(f, header[1] + header[2], size), None)
+    if segment is None or segment[0] != SEGMENT:
+        return None
+    segment_start = segment[1]
+    segment_end = size if segment[2] is None else min(
+        size, segment_start + segment[2])
+    metadata = {}
+    tracks = {}
+    positions = {}
+    for element_id, start, element_size in elements(f, segment_start,
+                                                    segment_end):
+        if element_id == CLUSTER or element_size is None:
+            break
+        if element_id == SEEK_HEAD:
+            for seek_start, seek_size in children(
+                    f, start, element_size).get(SEEK, []):
+                seek = children(f, seek_start, seek_size or 0)
+                target = value(f, seek, SEEK_ID)
+                position = value(f, seek, SEEK_POSITION)
+                if target in HANDLERS and position is not None:
+                    positions.setdefault(target, segment_start + position)
+        elif element_id in HANDLERS:
+            HANDLERS[element_id](f, start, element_size, metadata, tracks)
+            positions[element_id] = None
+    for element_id in (INFO, TRACKS, TAGS):
+        position = positions.get(element_id)
+        if position is None:
+            continue
+        element = next(elements(f, position, segment_end), None)
+        if element is not None and element[0] == element_id and \
+                element[2] is not None:
+            HANDLERS[element_id](f, element[1], element[2], metadata, tracks)
+    return metadata
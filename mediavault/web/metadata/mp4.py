@@ -0,0 +1,252 @@
+"""
+Parser for ISO base media files - MP4, M4A, M4V, MOV and 3GP.
+
+Only the top level box headers are read to find the 'moov' box, which is
+then read in one piece. The media data itself is never touched, so files
+whose 'moov' box comes after the media data cost one extra seek.
+"""
+import io
+import struct
+import sys
+from array import array
+
+from .base import add_tag, decode_text
+
+# Movie boxes larger than this are not read into memory
+MAX_MOOV_SIZE = 64 << 20
+
+CODECS = {
+    b'avc1': 'h264',
+    b'avc3': 'h264',
+    b'hvc1': 'hevc',
+    b'hev1': 'hevc',
+    b'mp4v': 'mpeg4',
+    b'vp08': 'vp8',
+    b'vp09': 'vp9',
+    b'av01': 'av1',
+    b's263': 'h263',
+    b'mp4a': 'aac',
+    b'ac-3': 'ac3',
+    b'ec-3': 'eac3',
+    b'Opus': 'opus',
+    b'fLaC': 'flac',
+    b'alac': 'alac',
+    b'samr': 'amr_nb',
+    b'sawb': 'amr_wb',
+    b'.mp3': 'mp3',
+}
+
+TAGS = {
+    b'\xa9nam': 'title',
+    b'\xa9ART': 'artist',
+    b'\xa9alb': 'album',
+    b'\xa9day': 'date',
+}
+
+
+def boxes(f, start, end):
+    """
+    Iterate over the boxes between the offsets `start` and `end` of `f`.
+    :return: Generator of (type, data start, data end)
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size = struct.unpack('>Q', header)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield kind, offset + header_size, min(offset + size, end)
+        offset += size
+
+
+def find(f, start, end, path):
+    """
+    Iterate over the boxes at `path` (list of types) below the box whose
+    data spans from `start` to `end`.
+    :return: Generator of (data start, data end)
+    """
+    for kind, box_start, box_end in boxes(f, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                yield box_start, box_end
+            else:
+                yield from find(f, box_start, box_end, path[1:])
+
+
+def first(f, start, end, path):
+    return next(find(f, start, end, path), None)
+
+
+def media_header(f, start):
+    """
+    Time scale and duration from a 'mvhd' or 'mdhd' box.
+    """
+    f.seek(start)
+    version = f.read(4)[0]
+    if version == 1:
+        f.seek(16, io.SEEK_CUR)
+        timescale, duration = struct.unpack('>IQ', f.read(12))
+        unknown = (1 << 64) - 1
+    else:
+        f.seek(8, io.SEEK_CUR)
+        timescale, duration = struct.unpack('>II', f.read(8))
+        unknown = (1 << 32) - 1
+    if duration == unknown:
+        duration = 0
+    return timescale, duration
+
+
+def sample_sizes(f, start):
+    """
+    Number of samples and their total size in bytes from a 'stsz' box.
+    """
+    f.seek(start + 4)
+    size, count = struct.unpack('>II', f.read(8))
+    if size != 0:
+        return count, size * count
+    sizes = array('I')
+    sizes.frombytes(f.read(count * 4))
+    if sizes.itemsize != 4:
+        return count, None
+    if sys.byteorder == 'little':
+        sizes.byteswap()
+    return count, sum(sizes)
+
+
+def sample_entry(f, start, handler, info):
+    """
+    Codec and its parameters from the first entry of a 'stsd' box.
+    """
+    f.seek(start + 4)
+    if struct.unpack('>I', f.read(4))[0] == 0:
+        return
+    entry = start + 8
+    header = f.read(36)
+    if len(header) < 36:
+        return
+    kind = header[4:8]
+    info['codec'] = CODECS.get(kind, decode_text(kind).strip().lower())
+    if handler == b'vide':
+        info['width'], info['height'] = struct.unpack('>HH', header[32:36])
+    elif handler == b'soun':
+        version = struct.unpack('>H', header[16:18])[0]
+        info['channels'] = struct.unpack('>H', header[24:26])[0]
+        info['sample_rate'] = struct.unpack('>I', header[32:36])[0] >> 16
+        if version == 2:
+            f.seek(entry + 40)
+            rate, channels = struct.unpack('>dI', f.read(12))
+            info['sample_rate'], info['channels'] = int(rate), channels
+
+
+def track(f, start, end, metadata):
+    """
+    Add the details of the first video and first audio track to
+    `metadata`.
+    """
+    handler = first(f, start, end, [b'mdia', b'hdlr'])
+    if handler is None:
+        return
+    f.seek(handler[0] + 8)
+    handler = f.read(4)
+    prefix = {b'vide': 'video', b'soun': 'audio'}.get(handler)
+    if prefix is None or prefix + '_codec' in metadata:
+        return
+    info = {}
+    stbl = first(f, start, end, [b'mdia', b'minf', b'stbl'])
+    if stbl is not None:
+        stsd = first(f, stbl[0], stbl[1], [b'stsd'])
+        if stsd is not None:
+            sample_entry(f, stsd[0], handler, info)
+    if 'codec' not in info:
+        return
+    metadata[prefix + '_codec'] = info['codec']
+    if prefix == 'video':
+        metadata['width'] = info['width']
+        metadata['height'] = info['height']
+    else:
+        metadata['audio_channels'] = info['channels']
+        metadata['audio_sample_rate'] = info['sample_rate']
+    mdhd = first(f, start, end, [b'mdia', b'mdhd'])
+    stsz = first(f, stbl[0], stbl[1], [b'stsz'])
+    if mdhd is None or stsz is None:
+        return
+    timescale, duration = media_header(f, mdhd[0])
+    if not timescale or not duration:
+        return
+    count, total = sample_sizes(f, stsz[0])
+    seconds = duration / timescale
+    if prefix == 'video' and count:
+        metadata['video_frame_rate'] = count / seconds
+    if total:
+        metadata[prefix + '_bit_rate'] = total * 8 / seconds
+
+
+def item_list(f, start, end, metadata):
+    """
+    Add the tags in the 'ilst' box of a 'meta' box to `metadata`.
+    """
+    f.seek(start + 4)
+    if f.read(4) != b'hdlr':
+        # ISO 'meta' is a full box, QuickTime's is not
+        start += 4
+    ilst = first(f, start, end, [b'ilst'])
+    if ilst is None:
+        return
+    for kind, tag_start, tag_end in boxes(f, ilst[0], ilst[1]):
+        name = TAGS.get(kind)
+        if name is None:
+            continue
+        data = first(f, tag_start, tag_end, [b'data'])
+        if data is None or data[1] - data[0] <= 8:
+            continue
+        f.seek(data[0])
+        value_type = struct.unpack('>I', f.read(8)[:4])[0]
+        if value_type == 1:
+            add_tag(metadata, name, f.read(data[1] - data[0] - 8)
+                    .decode('utf-8', 'replace'))
+
+
+def parse(f, size):
+    """
+    :param f: File opened in binary mode
+    :param size: Size of the file
+    :return: Metadata dict, or None if the file has no movie box
+    """
+    for kind, start, end in boxes(f, 0, size):
+        if kind != b'moov':
+            continue
+        if end - start > MAX_MOOV_SIZE:
+            return None
+        f.seek(start)
+        moov = io.BytesIO(f.read(end - start))
+        return parse_moov(moov, end - start)
+    return None
+
+
+def parse_moov(f, length):
+    metadata = {}
+    for kind, start, end in boxes(f, 0, length):
+        if kind == b'mvhd':
+            timescale, duration = media_header(f, start)
+            if timescale and duration:
+                metadata['duration'] = duration / timescale
+        elif kind == b'trak':
+            track(f, start, end, metadata)
+        elif kind == b'udta':
+            for meta_start, meta_end in find(f, start, end, [b'meta']):
+                item_list(f, meta_start, meta_end, metadata)
+        elif kind == b'meta':
+            item_list(f, start, end, metadata)
+    return metadata
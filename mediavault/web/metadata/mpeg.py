@@ -0,0 +1,251 @@
+"""
+Parser for MPEG audio files (MP3, MP2) with ID3 tags.
+
+The ID3v2 tag at the start and the ID3v1 tag in the last 128 bytes are
+read, then the first audio frame. The duration comes from the Xing, Info or
+VBRI header of variable bit rate files, or from the size of the audio data
+at the bit rate of the first frame.
+"""
+import struct
+
+from .base import add_tag
+
+# Bytes searched for the first frame after the ID3v2 tag
+SYNC_WINDOW = 1 << 16
+
+BIT_RATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416,
+             448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+             384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+             256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+BIT_RATES[2, 3] = BIT_RATES[2, 2]
+SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+VERSIONS = {0: 2.5, 2: 2, 3: 1}
+LAYERS = {1: 3, 2: 2, 3: 1}
+
+ID3_FRAMES = {
+    'TIT2': 'title',
+    'TT2': 'title',
+    'TPE1': 'artist',
+    'TP1': 'artist',
+    'TALB': 'album',
+    'TAL': 'album',
+    'TYER': 'year',
+    'TYE': 'year',
+    'TDRC': 'date',
+}
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+
+def syncsafe(data):
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7F)
+    return value
+
+
+def id3_text(body):
+    """
+    Text of an ID3v2 text frame. Multiple values are joined with ';'.
+    """
+    if len(body) < 2 or body[0] >= len(ID3_ENCODINGS):
+        return ''
+    text = body[1:].decode(ID3_ENCODINGS[body[0]], 'replace')
+    return ';'.join(value for value in text.split('\0') if value)
+
+
+def id3v2(data, major, flags, metadata):
+    """
+    Add the text frames of an ID3v2.2, 2.3 or 2.4 tag to `metadata`.
+    :param data: Tag data following the 10 byte header
+    """
+    if flags & 0x80 and major < 4:
+        data = data.replace(b'\xff\x00', b'\xff')
+    offset = 0
+    if flags & 0x40 and major >= 3 and len(data) >= 4:
+        if major == 3:
+            offset = 4 + struct.unpack('>I', data[:4])[0]
+        else:
+            offset = syncsafe(data[:4])
+    header_size = 6 if major == 2 else 10
+    while offset + header_size <= len(data):
+        header = data[offset:offset + header_size]
+        if header[0] == 0:
+            break
+        if major == 2:
+            frame_id = header[:3]
+            size = int.from_bytes(header[3:6], 'big')
+        elif major == 4:
+            frame_id = header[:4]
+            size = syncsafe(header[4:8])
+        else:
+            frame_id = header[:4]
+            size = struct.unpack('>I', header[4:8])[0]
+        body = data[offset + header_size:offset + header_size + size]
+        offset += header_size + size
+        name = ID3_FRAMES.get(frame_id.decode('latin-1'))
+        if name is None:
+            continue
+        if major == 4:
+            if header[9] & 0x0C:
+                # Compressed or encrypted
+                continue
+            if header[9] & 0x02:
+                body = body.replace(b'\xff\x00', b'\xff')
+            if header[9] & 0x01:
+                body = body[4:]
+        elif major == 3 and header[9] & 0xC0:
+            continue
+        add_tag(metadata, name, id3_text(body))
+
+
+def id3v1(data):
+    """
+    Tags of an ID3v1 tag (the last 128 bytes of the file).
+    """
+    metadata = {}
+
+    def field(start, end):
+        return data[start:end].split(b'\0')[0].decode('latin-1')
+
+    add_tag(metadata, 'title', field(3, 33))
+    add_tag(metadata, 'artist', field(33, 63))
+    add_tag(metadata, 'album', field(63, 93))
+    add_tag(metadata, 'year', field(93, 97))
+    return metadata
+
+
+def frame_header(data, offset):
+    """
+    Decode the frame header at `offset` of `data`.
+    :return: Dict of the header fields, or None if it is not a valid header
+    """
+    if offset + 4 > len(data):
+        return None
+    header = struct.unpack_from('>I', data, offset)[0]
+    if header >> 21 != 0x7FF:
+        return None
+    version = VERSIONS.get((header >> 19) & 3)
+    layer = LAYERS.get((header >> 17) & 3)
+    bit_rate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 3
+    if version is None or layer is None or bit_rate_index in (0, 15) or \
+            sample_rate_index == 3:
+        return None
+    bit_rate = BIT_RATES[min(version, 2), layer][bit_rate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (header >> 9) & 1
+    if layer == 1:
+        samples = 384
+        length = (12 * bit_rate // sample_rate + padding) * 4
+    else:
+        samples = 576 if layer == 3 and version != 1 else 1152
+        length = samples // 8 * bit_rate // sample_rate + padding
+    return {
+        'version': version,
+        'layer': layer,
+        'bit_rate': bit_rate,
+        'sample_rate': sample_rate,
+        'channels': 1 if (header >> 6) & 3 == 3 else 2,
+        'samples': samples,
+        'length': length,
+    }
+
+
+def first_frame(data):
+    """
+    Find the first frame header in `data` that is followed by another one.
+    :return: Tuple of (offset, header fields), or None
+    """
+    offset = data.find(b'\xff')
+    while 0 <= offset:
+        frame = frame_header(data, offset)
+        if frame is not None:
+            following = offset + frame['length']
+            if following + 4 > len(data) or \
+                    frame_header(data, following) is not None:
+                return offset, frame
+        offset = data.find(b'\xff', offset + 1)
+    return None
+
+
+def vbr_header(data, offset, frame):
+    """
+    Number of frames and bytes from the Xing/Info or VBRI header in the
+    first frame.
+    :return: Tuple of (frames or None, bytes or None)
+    """
+    if frame['version'] == 1:
+        side_info = 17 if frame['channels'] == 1 else 32
+    else:
+        side_info = 9 if frame['channels'] == 1 else 17
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info') and \
+            len(data) >= xing + 16:
+        flags = struct.unpack_from('>I', data, xing + 4)[0]
+        position = xing + 8
+        frames = size = None
+        if flags & 1:
+            frames = struct.unpack_from('>I', data, position)[0]
+            position += 4
+        if flags & 2:
+            size = struct.unpack_from('>I', data, position)[0]
+        return frames, size
+    vbri = offset + 36
+    if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+        size, frames = struct.unpack_from('>II', data, vbri + 10)
+        return frames, size
+    return None, None
+
+
+def parse(f, size):
+    """
+    :param f: File opened in binary mode
+    :param size: Size of the file
+    :return: Metadata dict, or None if no audio frame is found
+    """
+    metadata = {}
+    header = f.read(10)
+    audio_start = 0
+    if header[:3] == b'ID3' and len(header) == 10:
+        tag_size = syncsafe(header[6:10]) + 10
+        id3v2(f.read(tag_size - 10), header[3], header[5], metadata)
+        audio_start = tag_size + (10 if header[5] & 0x10 else 0)
+    audio_end = size
+    if size - audio_start >= 128:
+        f.seek(size - 128)
+        tail = f.read(128)
+        if tail[:3] == b'TAG':
+            audio_end -= 128
+            for key, value in id3v1(tail).items():
+                metadata.setdefault(key, value)
+    f.seek(audio_start)
+    data = f.read(SYNC_WINDOW)
+    found = first_frame(data)
+    if found is None:
+        return None
+    offset, frame = found
+    metadata['audio_codec'] = 'mp{0}'.format(frame['layer'])
+    metadata['audio_channels'] = frame['channels']
+    metadata['audio_sample_rate'] = frame['sample_rate']
+    frames, audio_size = vbr_header(data, offset, frame)
+    if audio_size is None:
+        audio_size = audio_end - audio_start - offset
+    if frames:
+        metadata['duration'] = frames * frame['samples'] / \
+            frame['sample_rate']
+        metadata['audio_bit_rate'] = audio_size * 8 / metadata['duration']
+    else:
+        metadata['duration'] = audio_size * 8 / frame['bit_rate']
+        metadata['audio_bit_rate'] = frame['bit_rate']
+    return metadata
@@ -0,0 +1,146 @@
+"""
+Parser for Ogg files carrying Vorbis, Opus or Theora streams.
+
+The header packets are reassembled from the pages at the start of the
+file, and the duration is taken from the granule position of the last page
+of the audio stream near the end of the file.
+"""
+import struct
+
+from .base import add_tag, decode_text
+
+# Bytes read at either end of the file
+HEAD_SIZE = 1 << 16
+TAIL_SIZE = 1 << 16
+PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+
+def pages(data):
+    """
+    Iterate over the complete pages in `data`.
+    :return: Generator of (header type, granule, serial, list of segments)
+    """
+    offset = data.find(b'OggS')
+    while 0 <= offset and offset + PAGE_HEADER.size <= len(data):
+        _, version, header_type, granule, serial, _, _, count = \
+            PAGE_HEADER.unpack_from(data, offset)
+        table = data[offset + PAGE_HEADER.size:
+                     offset + PAGE_HEADER.size + count]
+        body = offset + PAGE_HEADER.size + count
+        if len(table) < count or body + sum(table) > len(data):
+            return
+        segments = []
+        for lacing in table:
+            segments.append((data[body:body + lacing], lacing < 255))
+            body += lacing
+        yield header_type, granule, serial, segments
+        offset = data.find(b'OggS', body)
+
+
+def header_packets(data, count=3):
+    """
+    First `count` packets of every logical stream starting in `data`. The
+    last one may be incomplete.
+    :return: Dict of serial number to list of packets
+    """
+    streams = {}
+    partial = {}
+    for header_type, _, serial, segments in pages(data):
+        if header_type & 0x02:
+            streams[serial] = []
+        if serial not in streams or len(streams[serial]) >= count:
+            continue
+        for segment, complete in segments:
+            partial[serial] = partial.get(serial, b'') + segment
+            if complete:
+                streams[serial].append(partial.pop(serial))
+    for serial, packet in partial.items():
+        if len(streams[serial]) < count:
+            streams[serial].append(packet)
+    return streams
+
+
+def comments(packet, metadata):
+    """
+    Add the tags in a Vorbis comment block to `metadata`, tolerating a
+    truncated block.
+    """
+    try:
+        vendor_length = struct.unpack_from('<I', packet)[0]
+        offset = 4 + vendor_length
+        count = struct.unpack_from('<I', packet, offset)[0]
+        offset += 4
+        for _ in range(count):
+            length = struct.unpack_from('<I', packet, offset)[0]
+            comment = packet[offset + 4:offset + 4 + length]
+            offset += 4 + length
+            if len(comment) < length:
+                return
+            name, _, text = decode_text(comment).partition('=')
+            add_tag(metadata, name, text)
+    except struct.error:
+        return
+
+
+def last_granule(data, serial):
+    granule = None
+    for _, page_granule, page_serial, _ in pages(data):
+        if page_serial == serial and page_granule > 0:
+            granule = page_granule
+    return granule
+
+
+def parse(f, size):
+    """
+    :param f: File opened in binary mode
+    :param size: Size of the file
+    :return: Metadata dict, or None if no known stream is found
+    """
+    head = f.read(HEAD_SIZE)
+    streams = header_packets(head)
+    metadata = {}
+    audio = None
+    for serial, packets in streams.items():
+        if not packets:
+            continue
+        first = packets[0]
+        if first.startswith(b'\x01vorbis') and len(first) >= 28 and \
+                'audio_codec' not in metadata:
+            channels, rate, _, nominal = struct.unpack_from('<BIiI', first, 11)
+            metadata.update(audio_codec='vorbis', audio_channels=channels,
+                            audio_sample_rate=rate)
+            if 0 < nominal < (1 << 31):
+                metadata['audio_bit_rate'] = nominal
+            audio = serial, rate, 0
+            if len(packets) > 1 and packets[1].startswith(b'\x03vorbis'):
+                comments(packets[1][7:], metadata)
+        elif first.startswith(b'OpusHead') and len(first) >= 19 and \
+                'audio_codec' not in metadata:
+            channels, pre_skip = struct.unpack_from('<BH', first, 9)
+            metadata.update(audio_codec='opus', audio_channels=channels,
+                            audio_sample_rate=48000)
+            audio = serial, 48000, pre_skip
+            if len(packets) > 1 and packets[1].startswith(b'OpusTags'):
+                comments(packets[1][8:], metadata)
+        elif first.startswith(b'\x80theora') and len(first) >= 42 and \
+                'video_codec' not in metadata:
+            width = int.from_bytes(first[14:17], 'big')
+            height = int.from_bytes(first[17:20], 'big')
+            numerator, denominator = struct.unpack_from('>II', first, 22)
+            metadata.update(video_codec='theora', width=width, height=height)
+            if denominator:
+                metadata['video_frame_rate'] = numerator / denominator
+            if len(packets) > 1 and packets[1].startswith(b'\x81theora'):
+                comments(packets[1][7:], metadata)
+    if not metadata:
+        return None
+    if audio is not None:
+        serial, rate, pre_skip = audio
+        f.seek(max(0, size - TAIL_SIZE))
+        granule = last_granule(f.read(TAIL_SIZE), serial)
+        if granule and rate and granule > pre_skip:
+            metadata['duration'] = (granule - pre_skip) / rate
+            if 'video_codec' not in metadata:
+                metadata.setdefault('audio_bit_rate',
+                                    size * 8 / metadata['duration'])
+    return metadata
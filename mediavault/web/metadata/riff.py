@@ -0,0 +1,92 @@
+"""
+Parser for WAV files.
+
+Only the chunk headers are read, plus the bodies of the 'fmt ' chunk and
+the INFO list holding the tags.
+"""
+import struct
+
+from .base import add_tag, decode_text
+
+CODECS = {
+    0x0002: 'adpcm_ms',
+    0x0006: 'pcm_alaw',
+    0x0007: 'pcm_mulaw',
+    0x0011: 'adpcm_ima_wav',
+    0x0050: 'mp2',
+    0x0055: 'mp3',
+}
+INFO_TAGS = {
+    b'INAM': 'title',
+    b'IART': 'artist',
+    b'IPRD': 'album',
+    b'ICRD': 'date',
+}
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def codec_name(format_tag, bits):
+    if format_tag == 1:
+        return 'pcm_u8' if bits == 8 else 'pcm_s{0}le'.format(bits)
+    if format_tag == 3:
+        return 'pcm_f{0}le'.format(bits)
+    return CODECS.get(format_tag, 'wav_{0:04x}'.format(format_tag))
+
+
+def chunks(f, start, end):
+    """
+    Iterate over the chunks between the offsets `start` and `end` of `f`.
+    :return: Generator of (chunk ID, data start, data size)
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        chunk_id, size = struct.unpack('<4sI', header)
+        yield chunk_id, offset + 8, min(size, end - offset - 8)
+        offset += 8 + size + (size & 1)
+
+
+def parse(f, size):
+    """
+    :param f: File opened in binary mode
+    :param size: Size of the file
+    :return: Metadata dict, or None if the file is not a WAV file
+    """
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    metadata = {}
+    byte_rate = data_size = None
+    for chunk_id, start, chunk_size in chunks(f, 12, size):
+        if chunk_id == b'fmt ' and chunk_size >= 16:
+            f.seek(start)
+            fmt = f.read(min(chunk_size, 40))
+            format_tag, channels, sample_rate, byte_rate, _, bits = \
+                struct.unpack_from('<HHIIHH', fmt)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                format_tag = struct.unpack_from('<H', fmt, 24)[0]
+            metadata.update(audio_codec=codec_name(format_tag, bits),
+                            audio_channels=channels,
+                            audio_sample_rate=sample_rate,
+                            audio_bit_rate=byte_rate * 8)
+        elif chunk_id == b'data':
+            data_size = chunk_size
+        elif chunk_id == b'LIST':
+            f.seek(start)
+            if f.read(4) != b'INFO':
+                continue
+            for tag_id, tag_start, tag_size in chunks(f, start + 4,
+                                                      start + chunk_size):
+                name = INFO_TAGS.get(tag_id)
+                if name is not None:
+                    f.seek(tag_start)
+                    add_tag(metadata, name,
+                            decode_text(f.read(tag_size).split(b'\0')[0]))
+    if 'audio_codec' not in metadata:
+        return None
+    if byte_rate and data_size:
+        metadata['duration'] = data_size / byte_rate
+    return metadata
@@ -0,0 +1,109 @@
+"""
+Middleware resolving the user of a request once, for all views.
+
+Requests to the API (under API_PREFIX) are made by the user whose API key
+is in the `key` parameter, and all other requests by the user whose
+username is in the session, so that a key never stands for a login to the
+site. The id and flags of users and the username of each key are kept in
+the cache for USER_CACHE_TIMEOUT seconds, so that most requests - every
+range request of a media player included - resolve their user without a
+query, and the rest of a User is only loaded by views that use it. They are
+dropped from the cache when a user or a key is saved or deleted, which
+reaches every process only if they share a cache, as the production
+settings set up. With the default in-memory cache of each process, other
+processes see the change within USER_CACHE_TIMEOUT seconds.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+from rest_framework.authtoken.models import Token
+
+TIMEOUT = 60
+API_PREFIX = '/api/'
+
+
+def user_key(username):
+    return 'vault-user:{0}'.format(username)
+
+
+def token_key(key):
+    return 'vault-token:{0}'.format(key)
+
+
+def timeout():
+    return getattr(settings, 'USER_CACHE_TIMEOUT', TIMEOUT)
+
+
+class CachedUser(SimpleLazyObject):
+    """
+    User whose id, username and flags are known, loaded from the database
+    once any other attribute is used.
+    """
+
+    def __init__(self, username, fields):
+        """
+        :param fields: Dict of the cached id, is_active and is_superuser
+        """
+        super().__init__(lambda: User.objects.get(pk=fields['id']))
+        self.__dict__.update(fields, pk=fields['id'], username=username)
+
+
+def get_user(username):
+    """
+    :return: CachedUser named `username`, or None if there is none
+    """
+    fields = cache.get(user_key(username))
+    if fields is None:
+        fields = User.objects.filter(username=username).values(
+            'id', 'is_active', 'is_superuser').first()
+        if fields is None:
+            return None
+        cache.set(user_key(username), fields, timeout())
+    return CachedUser(username, fields)
+
+
+def get_token_user(key):
+    """
+    :return: User whose API key is `key`, or None if there is none
+    """
+    username = cache.get(token_key(key))
+    if username is None:
+        username = Token.objects.filter(key=key).values_list(
+            'user__username', flat=True).first()
+        if username is None:
+            return None
+        cache.set(token_key(key), username, timeout())
+    return get_user(username)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user(sender, instance, **kwargs):
+    cache.delete(user_key(instance.username))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    cache.delete(token_key(instance.key))
+
+
+class VaultUserMiddleware(object):
+    """
+    Sets `request.vault_user` to the User making the request, or None.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path_info.startswith(API_PREFIX):
+            key = request.GET.get('key', None)
+            request.vault_user = get_token_user(key) if key else None
+        else:
+            username = request.session.get('username', None)
+            request.vault_user = get_user(username) if username else None
+        return self.get_response(request)
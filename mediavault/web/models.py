@@ -4,16 +4,19 @@ and methods to manipulate them.
 """
 import os
 from datetime import datetime
-from operator import itemgetter
 
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
-from django.db.transaction import atomic
-from django.dispatch import receiver
+from django.db import connection, models
+from django.db.models import Case, Count, ExpressionWrapper, F, Max, Q, \
+    Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
 
-from . import identifier, is_media, media_type
+from . import media_type
+
+# Views at which an item gets half of the points for popularity in its score
+VIEWS_HALF_SCORE = 20
 
 
 class ItemType(models.Model):
@@ -82,7 +85,7 @@ class SharedItem(models.Model):
 
     name = models.CharField(max_length=2014, default='')
     type = models.ForeignKey(ItemType)
-    path = models.CharField(max_length=2048)
+    path = models.CharField(max_length=2048, db_index=True)
     duration = models.IntegerField(null=True, blank=True)
     title = models.CharField(max_length=2048, null=True, blank=True)
     artist = models.ManyToManyField(Artist, blank=True)
@@ -102,8 +105,27 @@ class SharedItem(models.Model):
     is_root = models.BooleanField(default=False)
     seen_by = models.ManyToManyField(User, blank=True)
     time_added = models.DateTimeField(default=timezone.now)
-
-    def dictify(self):
+    version = models.PositiveIntegerField(default=0)
+    size = models.BigIntegerField(null=True, blank=True)
+    mtime = models.BigIntegerField(null=True, blank=True)
+    inode = models.BigIntegerField(null=True, blank=True)
+    metadata_mtime = models.BigIntegerField(null=True, blank=True)
+    # Ids of the items from the root down to this one, see web/tree.py
+    tree_path = models.CharField(max_length=1024, default='', db_index=True)
+    depth = models.PositiveIntegerField(default=0)
+    # Recommendation score, see score_expression()
+    score = models.FloatField(default=5.0, db_index=True)
+    # Totals of the ratings of the item, see rate_item()
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    # Last time the item or its children changed, see touch_listing()
+    time_modified = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def dictify(self, fields=None):
+        """
+        :param fields: Keys to include, all of them if None
+        :return: Dictionary describing the item
+        """
         _dict = {
             "id": self.id,
             "name": self.name,
@@ -111,8 +133,7 @@ class SharedItem(models.Model):
             "path": self.path,
             "duration": self.duration,
             "title": self.title,
-            "artist": list(self.artist.all()),
-            "album": self.album,
+            "album": None if not self.album else self.album.name,
             "year": self.year,
             "video_codec": None if not self.video_codec else self.video_codec
                 .codec,
@@ -124,23 +145,45 @@ class SharedItem(models.Model):
                 .codec,
             "audio_channels": self.audio_channels,
             "audio_sample_rate": self.audio_sample_rate,
-            "audio_bit_rate": self.audio_bit_rate
+            "audio_bit_rate": self.audio_bit_rate,
+            "average_rating": self.average_rating(),
+            "number_of_ratings": self.rating_count
         }
+        if fields is None or 'artist' in fields:
+            _dict["artist"] = [str(artist).strip() for artist in
+                               self.artist.all()]
+        if fields is not None:
+            _dict = {key: _dict[key] for key in fields}
         return _dict
 
     def exists(self):
         return os.path.exists(self.path)
 
+    def duration_text(self):
+        if self.duration is None:
+            return ''
+        minutes, seconds = divmod(self.duration, 60)
+        if minutes < 60:
+            return '{0}:{1:02}'.format(minutes, seconds)
+        return '{0}:{1:02}:{2:02}'.format(minutes // 60, minutes % 60,
+                                          seconds)
+
     def media_type(self):
         return media_type(self.type.type)
 
+    def average_rating(self):
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
     def accessible(self, user):
-        return ItemAccessibility.objects.get(user=user, item=self).accessible
+        from .access import can_access
+        return can_access(user, self)
 
     def _html(self, destination):
         html = '''<a href="{0}">
             <div class="mv">
-                <span class="mv-type"><i class="fa fa-{1}" aria-hidden="true"></i></span>
+                <span class="mv-type"><i class="fa fa-{1}" aria-hidden="true"></i></span>{4}
                 <span class="mv-name">{2}</span>
                 <span class="pull-right">{3} <i class="fa fa-eye aria-hidden="true"></i></span>
             </div>
@@ -155,7 +198,15 @@ class SharedItem(models.Model):
             fa = 'image'
         else:
             fa = 'folder'
-        return html.format(link, fa, self.name, self.views)
+        thumbnail = ''
+        if media_t in ('image', 'video'):
+            thumbnail = '<img class="mv-thumb" src="{0}" alt="" ' \
+                        'onerror="this.remove()">'.format(
+                            self.thumbnail_url('small'))
+        return html.format(link, fa, self.name, self.views, thumbnail)
+
+    def thumbnail_url(self, size):
+        return '/thumb/{0}/{1}?v={2}'.format(self.id, size, self.mtime)
 
     def html(self):
         return self._html('media')
@@ -164,9 +215,81 @@ class SharedItem(models.Model):
         return self._html('shared-items')
 
 
+class AccessGrant(models.Model):
+    """
+    Database ORM to store access to an item and everything below it, allowed
+    or denied to one user or to everyone (no user), see web/access.py
+    """
+
+    def __str__(self):
+        return '{0} {1} to {2}'.format(
+            self.item,
+            'allowed' if self.allow else 'denied',
+            self.user or 'everyone'
+        )
+
+    item = models.ForeignKey(SharedItem)
+    user = models.ForeignKey(User, null=True, blank=True)
+    allow = models.BooleanField(default=True)
+    time = models.DateTimeField(auto_now=True)
+
+
+class Generation(models.Model):
+    """
+    Database ORM to store counters that are bumped whenever data cached in
+    memory by the processes serving requests changes
+    """
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.name, self.value)
+
+    name = models.CharField(max_length=64, unique=True)
+    value = models.PositiveIntegerField(default=0)
+    time_changed = models.DateTimeField(default=timezone.now)
+
+
+class Task(models.Model):
+    """
+    Database ORM to store background tasks and their progress, see
+    web/tasks.py
+    """
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.description, self.state)
+
+    def percent(self):
+        if not self.total:
+            return 100 if self.state == 'done' else 0
+        return min(100, self.done * 100 // self.total)
+
+    kind = models.CharField(max_length=32)
+    description = models.CharField(max_length=256)
+    # What the task works on, to find a task already queued, see submit()
+    key = models.CharField(max_length=128, blank=True, default='',
+                           db_index=True)
+    # The key while the task is pending or running, unique so that a key is
+    # queued once however many processes submit it at the same time
+    active_key = models.CharField(max_length=128, null=True, blank=True,
+                                  unique=True, default=None)
+    item = models.ForeignKey(SharedItem, null=True, blank=True,
+                             on_delete=models.SET_NULL)
+    user = models.ForeignKey(User, null=True, blank=True,
+                             on_delete=models.SET_NULL)
+    state = models.CharField(max_length=16, default='pending')
+    done = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    result = models.CharField(max_length=512, blank=True, default='')
+    time_created = models.DateTimeField(default=timezone.now)
+    time_finished = models.DateTimeField(null=True, blank=True)
+    # Last time the process running the task said it was still alive
+    time_heartbeat = models.DateTimeField(default=timezone.now)
+
+
 class ItemAccessibility(models.Model):
     """
-    Database ORM to store the accessibility of shared items to users
+    Database ORM of the dense accessibility rows of earlier versions, one per
+    user and item. Only read by the migrate_acl command, which turns them
+    into AccessGrant rows.
     """
 
     def __str__(self):
@@ -195,6 +318,10 @@ class ItemRating(models.Model):
     rating = models.PositiveIntegerField()
     time = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # One rating per user, which rate_item() relies on
+        unique_together = ('item', 'user')
+
 
 class Suggestion(models.Model):
     """
@@ -211,19 +338,52 @@ class Suggestion(models.Model):
     time = models.DateTimeField(default=datetime.now)
 
 
+class MimeCacheEntry(models.Model):
+    """
+    Database ORM to cache MIME types detected by libmagic
+    """
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.path, self.mime)
+
+    path = models.CharField(max_length=2048, db_index=True)
+    size = models.BigIntegerField()
+    mtime = models.BigIntegerField()
+    mime = models.CharField(max_length=128)
+
+
+def prefixed(field, prefix):
+    """
+    Q object matching the rows whose `field` starts with `prefix`, in a way
+    an index of the field can serve. SQLite only uses an index for a LIKE
+    that is case sensitive, which the one of startswith is not there, so
+    the prefix is matched as the range of values sorting from it up to the
+    prefix with its last character bumped.
+    """
+    if connection.vendor == 'sqlite' and prefix:
+        return Q(**{field + '__gte': prefix,
+                    field + '__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)})
+    return Q(**{field + '__startswith': prefix})
+
+
 def get_children(parent, user):
+    """
+    QuerySet of the children of the item with id `parent` that `user` can
+    access, or of the root items if there is no such item.
+    """
+    from .access import accessible_children
     if not parent:
-        return get_root_items(user)
+        return accessible_children(user)
     try:
         parent = int(parent)
     except ValueError:
-        return get_root_items(user)
+        return accessible_children(user)
     item = SharedItem.objects.filter(id=parent)
     if len(item) == 0:
-        return get_root_items(user)
+        return accessible_children(user)
     else:
         item = item[0]
-    return item.children.all()
+    return accessible_children(user, item)
 
 
 def get_root_items(user):
@@ -231,16 +391,99 @@ def get_root_items(user):
 
 
 def filter_items(items, user):
-    allowed = []
-    for item in items:
-        access = ItemAccessibility.objects.filter(user=user, item=item)
-        if len(access) == 1:
-            if access[0].accessible:
-                allowed.append(item)
-    return allowed
+    from .access import accessible_items
+    return accessible_items(user, items)
+
+
+def get_generation(name):
+    value = Generation.objects.filter(name=name).values_list('value',
+                                                             flat=True)
+    return value[0] if len(value) == 1 else 0
+
+
+def bump_generation(name):
+    if Generation.objects.filter(name=name).update(
+            value=F('value') + 1) == 0:
+        Generation.objects.get_or_create(name=name, defaults={'value': 1})
+    # Stamped once the change is visible to others, see stamp_modified()
+    on_commit(lambda: Generation.objects.filter(name=name).update(
+        time_changed=timezone.now()))
+
+
+def listing_version(parent):
+    """
+    Version of the listing of children of `parent`, resolved the same way as
+    get_children(). It changes whenever the children of the directory or
+    their permissions change.
+    :return: Version string, or None if it cannot be determined
+    """
+    try:
+        parent = int(parent)
+    except (TypeError, ValueError):
+        parent = None
+    if parent:
+        version = SharedItem.objects.filter(id=parent).values_list('version',
+                                                                   flat=True)
+        if len(version) == 1:
+            return '{0}.{1}'.format(parent, version[0])
+    roots = SharedItem.objects.filter(is_root=True).aggregate(
+        count=Count('id'), last=Max('id'), version=Sum('version'))
+    return 'root.{count}.{last}.{version}'.format(**roots)
+
+
+def stamp_modified(item_ids, chunk_size=500):
+    """
+    Set the modification time of items once the current transaction, if
+    any, commits. A delta export since a time before the commit then sees
+    the change, which a time taken within a long transaction, e.g. of a
+    scan, would hide from it (see web/export.py).
+    """
+    item_ids = list(item_ids)
+
+    def stamp():
+        now = timezone.now()
+        for i in range(0, len(item_ids), chunk_size):
+            SharedItem.objects.filter(
+                id__in=item_ids[i:i + chunk_size]).update(time_modified=now)
+
+    on_commit(stamp)
+
+
+def touch_listing(item):
+    """
+    Bump the version and the modification time of the item itself and of
+    the listings that show it, i.e. those of its parents (the root listing
+    sums the versions of the root items).
+    """
+    touch_listings([item.id])
+
+
+def touch_listings(item_ids, chunk_size=500):
+    """
+    Set based touch_listing() for many items at once.
+    """
+    item_ids = list(item_ids)
+    through = SharedItem.children.through
+    touched = set()
+    for i in range(0, len(item_ids), chunk_size):
+        chunk = item_ids[i:i + chunk_size]
+        touched.update(chunk)
+        touched.update(through.objects.filter(
+            to_shareditem_id__in=chunk).values_list('from_shareditem_id',
+                                                    flat=True))
+    touched = list(touched)
+    for i in range(0, len(touched), chunk_size):
+        SharedItem.objects.filter(id__in=touched[i:i + chunk_size]).update(
+            version=F('version') + 1)
+    stamp_modified(touched, chunk_size)
 
 
 def get_children_recursive(parent, user):
+    """
+    Nested dictionaries of `parent` and everything below it that `user` can
+    access, read with a single query of the subtree.
+    """
+    from .tree import path_ids, subtree
     if not parent:
         return get_root_items_recursive(user)
     try:
@@ -251,11 +494,20 @@ def get_children_recursive(parent, user):
     if len(item) == 0:
         return get_root_items_recursive(user)
     item = item[0]
+    items = subtree(item).exclude(id=item.id).select_related(
+        'type', 'album', 'video_codec', 'audio_codec').prefetch_related(
+        'artist').order_by('depth', 'id')
     parent_dict = item.dictify()
-    children = item.children.all()
-    children = filter_items(children, user)
-    child_list = [get_children_recursive(child.id, user) for child in children]
-    parent_dict['children'] = child_list
+    parent_dict['children'] = []
+    dicts = {item.id: parent_dict}
+    for child in filter_items(items, user):
+        parent_id = path_ids(child.tree_path)[-2]
+        # Children of items the user cannot access are left out with them
+        if parent_id in dicts:
+            child_dict = child.dictify()
+            child_dict['children'] = []
+            dicts[parent_id]['children'].append(child_dict)
+            dicts[child.id] = child_dict
     return parent_dict
 
 
@@ -265,156 +517,216 @@ def get_root_items_recursive(user):
     return tree
 
 
-def add_item_recursive(location, user, permission, parent=None):
-    print('Adding Item - {0} {1} {2} {3}'.format(location, user, permission,
-                                                 parent))
-    if not os.path.isdir(location):
-        return add_item(location, user, permission, parent)
-    else:
-        items = os.listdir(location)
-        number = add_item(location, user, permission, parent, directory=True)
-        curr_dir = SharedItem.objects.get(path=location)
-        for item in items:
-            number += add_item_recursive(location + '/' + item, user,
-                                         permission, curr_dir)
-        return number
+def delete_items(item_ids, chunk_size=500):
+    """
+    Delete items along with the rows depending on them, with set based
+    statements per chunk of ids inside one transaction.
+    :return: Dict of model label to the number of rows deleted
+    """
+    from .access import GENERATION
+    from .search import remove_items
+    item_ids = list(item_ids)
+    counts = {}
+    with atomic():
+        for i in range(0, len(item_ids), chunk_size):
+            _, deleted = SharedItem.objects.filter(
+                id__in=item_ids[i:i + chunk_size]).delete()
+            for label, count in deleted.items():
+                counts[label] = counts.get(label, 0) + count
+        remove_items(item_ids)
+        # Ids of deleted items may be handed out again
+        bump_generation(GENERATION)
+    return counts
 
 
 def remove_item_recursive(item):
-    for child in item.children.all():
-        remove_item_recursive(child)
-    print("Deleting item - {0}".format(item))
-    item.delete()
-
-
-def add_item(location, user, permission, parent, directory=False):
-    if len(SharedItem.objects.filter(path=location)) > 0:
-        print("Already exists")
-        return 0
-    if directory:
-        mime = 'Directory'
-    else:
-        mime = identifier.from_file(location)
-    if not is_media(mime):
-        print('Unrecognized mime {1} for - {0}... Ignoring.'.format(location,
-                                                                    mime))
-        return 0
-    if location[-1] == '/':
-        location = location[:-1]
-    name = location.split('/')[-1]
-    type = ItemType.objects.filter(type=mime)
-    if len(type) == 0:
-        type = ItemType(type=mime)
-        type.save()
-    else:
-        type = type[0]
-    new_item = SharedItem(name=name, type=type,
-                          path=location)  # TODO : Get more details
-    if parent is None:
-        new_item.is_root = True
-    new_item.save()
-    if parent:
-        parent.children.add(new_item)
-        parent.save()
-    if permission == 'all':
-        grant_permission(new_item, None, admin_only=False)
-    elif permission == 'admin':
-        grant_permission(new_item, None, admin_only=True)
-    elif permission == 'self':
-        grant_permission(new_item, user, admin_only=False)
-    return 1
-
-
-def grant_permission(item, user, admin_only):
+    """
+    Delete `item` and everything below it.
+    :return: Dict of model label to the number of rows deleted, see
+    delete_items()
+    """
+    from .tree import descendant_ids
+    touch_listing(item)
+    counts = delete_items([item.id] + descendant_ids(item))
+    print("Deleted {0} - {1}".format(item, counts))
+    return counts
+
+
+def grant_permission_recursive(item, user, admin_only, below=None,
+                               progress=None):
+    """
+    Give access to `item` and everything below it.
+    :param user: User getting access, or None for everyone
+    :param admin_only: If True, give access to the superusers instead
+    :return: Tuple of the number of items covered and of grants changed, see
+    access.grant_subtree()
+    """
+    from .access import grant_subtree
     print("Permission Grant - {0} -- {1} -- {2}".format(item, user, admin_only))
-    if admin_only:
-        users = User.objects.filter(is_superuser=True)
-        with atomic():
-            for _user in users:
-                print("Granting Access of {0} to {1}".format(item, _user))
-                accessibility_instance = ItemAccessibility.objects.get(
-                    user=_user, item=item)
-                accessibility_instance.accessible = True
-                accessibility_instance.save()
-    elif user:
-        print("Granting Access of {0} to {1}".format(item, user))
-        accessibility_instance = ItemAccessibility.objects.get(user=user,
-                                                               item=item)
-        accessibility_instance.accessible = True
-        accessibility_instance.save()
-    else:
-        users = User.objects.all()
-        with atomic():
-            for _user in users:
-                print("Granting Access of {0} to {1}".format(item, _user))
-                accessibility_instance = ItemAccessibility.objects.get(
-                    user=_user, item=item)
-                accessibility_instance.accessible = True
-                accessibility_instance.save()
-
-
-@receiver(post_save, sender=SharedItem)
-def create_auth_token(sender, instance=None, created=False, **kwargs):
-    if created:
-        permissions = []
-        for user in User.objects.all():
-            permissions.append(ItemAccessibility(user=user, item=instance,
-                                                 accessible=False))
-        ItemAccessibility.objects.bulk_create(permissions)
-
-
-def grant_permission_recursive(item, user, admin_only):
-    for child in item.children.all():
-        grant_permission_recursive(child, user, admin_only)
-    grant_permission(item, user, admin_only)
-
-
-def remove_permission_recursive(item, user):
-    for child in item.children.all():
-        remove_permission_recursive(child, user)
-    remove_permission(item, user)
-
-
-def remove_permission(item, user):
-    instance = ItemAccessibility.objects.get(user=user, item=item)
-    instance.accessible = False
-    instance.save()
-
-
-def get_suggested_items(user):
-    items = [instance.item for instance in
-             ItemAccessibility.objects.filter(user=user, accessible=True) if
-             instance.item.type.type != 'Directory']
-    max_views = max([item.views for item in items]) if len(items) > 0 else 1
-    max_views = max_views + 1 if max_views == 0 else max_views
-    items_lot = [(item, item.views / max_views * 10.0) for item in items]
-    seen_list = []
-    unseen_list = []
-    for item, score in items_lot:
-        ratings = [rating_instance.rating for rating_instance in
-                   ItemRating.objects.filter(item=item)]
-        number_of_ratings = len(ratings)
-        if number_of_ratings > 0:
-            average_rating = sum(ratings) / number_of_ratings
-        else:
-            average_rating = 5.0
-        tpl = (item, score + average_rating)
-        if user in list(item.seen_by.all()):
-            seen_list.append(tpl)
-        else:
-            unseen_list.append(tpl)
-    seen_list = sorted(seen_list, key=itemgetter(1), reverse=True)
-    unseen_list = sorted(unseen_list, key=itemgetter(1), reverse=True)
-    if len(seen_list) >= 3:
-        ret_lst = unseen_list[:7] + seen_list[:3]
-    else:
-        ret_lst = unseen_list[:10 - len(seen_list)] + seen_list
-    return [i[0] for i in ret_lst]
+    touch_listing(item)
+    if not admin_only:
+        return grant_subtree(item, user, True, below, progress)
+    items = changed = 0
+    for _user in User.objects.filter(is_superuser=True):
+        items, _changed = grant_subtree(item, _user, True, below, progress)
+        changed += _changed
+    return items, changed
+
+
+def remove_permission_recursive(item, user, below=None, progress=None):
+    """
+    Take away access to `item` and everything below it.
+    :return: Tuple of the number of items covered and of grants changed
+    """
+    from .access import grant_subtree
+    touch_listing(item)
+    return grant_subtree(item, user, False, below, progress)
+
+
+def average_rating_expression():
+    """
+    Average rating of an item as an expression over its row, NULL for
+    unrated items. It can be annotated on to sort by it.
+    """
+    return Case(When(rating_count=0, then=None), default=ExpressionWrapper(
+        Value(1.0) * F('rating_sum') / F('rating_count'),
+        output_field=models.FloatField()))
+
+
+def score_expression():
+    """
+    Recommendation score of an item as an expression over its row - up to
+    10 points for popularity, half of them at VIEWS_HALF_SCORE views, plus
+    the average rating, 5 for unrated items.
+    """
+    popularity = ExpressionWrapper(
+        Value(10.0) * F('views') / (F('views') + VIEWS_HALF_SCORE),
+        output_field=models.FloatField())
+    return popularity + Coalesce(average_rating_expression(), Value(5.0))
+
+
+def update_scores(item_ids=None, chunk_size=500):
+    """
+    Recompute the scores of items, or of all items, with one UPDATE per
+    chunk.
+    """
+    if item_ids is None:
+        return SharedItem.objects.update(score=score_expression())
+    item_ids = list(item_ids)
+    updated = 0
+    for i in range(0, len(item_ids), chunk_size):
+        updated += SharedItem.objects.filter(
+            id__in=item_ids[i:i + chunk_size]).update(
+            score=score_expression())
+    return updated
+
+
+def rate_item(item, user, rating):
+    """
+    Rate an item for a user, replacing their earlier rating, and keep the
+    rating totals and the score of the item in step.
+    :param rating: Rating from 0 to 10
+    """
+    with atomic():
+        # The unique rating of the user is created or locked, so that
+        # concurrent ratings cannot both count as the first one.
+        previous, created = ItemRating.objects.select_for_update() \
+            .get_or_create(item=item, user=user, defaults={'rating': rating})
+        if created:
+            SharedItem.objects.filter(id=item.id).update(
+                rating_sum=F('rating_sum') + rating,
+                rating_count=F('rating_count') + 1)
+        elif previous.rating != rating:
+            ItemRating.objects.filter(id=previous.id).update(rating=rating)
+            SharedItem.objects.filter(id=item.id).update(
+                rating_sum=F('rating_sum') + rating - previous.rating)
+        update_scores([item.id])
+        # The rating totals are exported
+        stamp_modified([item.id])
+    item.refresh_from_db(fields=['rating_sum', 'rating_count', 'score'])
+
+
+def remove_ratings(ratings):
+    """
+    Delete ratings and take them out of the totals of their items.
+    :param ratings: QuerySet of ItemRating
+    """
+    with atomic():
+        totals = list(ratings.values('item').annotate(
+            total=Sum('rating'), count=Count('id')).values_list(
+            'item', 'total', 'count'))
+        ratings.delete()
+        for item_id, total, count in totals:
+            SharedItem.objects.filter(id=item_id).update(
+                rating_sum=F('rating_sum') - total,
+                rating_count=F('rating_count') - count)
+        update_scores(item_id for item_id, _, _ in totals)
+        stamp_modified(item_id for item_id, _, _ in totals)
+
+
+def repair_ratings():
+    """
+    Recompute the rating totals of all items with one GROUP BY over the
+    ratings, writing only the ones that are off.
+    :return: Number of items repaired
+    """
+    with atomic():
+        totals = {item_id: (total, count) for item_id, total, count in
+                  ItemRating.objects.values('item').annotate(
+                      total=Sum('rating'), count=Count('id')).values_list(
+                      'item', 'total', 'count')}
+        stored = {item_id: (total, count) for item_id, total, count in
+                  SharedItem.objects.filter(rating_count__gt=0).values_list(
+                      'id', 'rating_sum', 'rating_count')}
+        repaired = [item_id for item_id in set(stored) | set(totals) if
+                    stored.get(item_id) != totals.get(item_id)]
+        for item_id in repaired:
+            total, count = totals.get(item_id, (0, 0))
+            SharedItem.objects.filter(id=item_id).update(rating_sum=total,
+                                                         rating_count=count)
+        update_scores(repaired)
+        stamp_modified(repaired)
+    return len(repaired)
+
+
+def first_accessible(items, user, count, limit=2000):
+    """
+    First `count` of `items` that `user` can access. The query is narrowed
+    down to the subtrees the user can access where possible, and the rest
+    is checked a page at a time.
+    :param items: Ordered QuerySet
+    :param limit: Number of items looked at at most
+    """
+    from .access import accessible_filter
+    accessible = accessible_filter(user)
+    if accessible is not None:
+        items = items.filter(accessible)
+    found = []
+    offset = 0
+    while len(found) < count and offset < limit:
+        batch = list(items[offset:min(offset + count * 4, limit)])
+        if len(batch) == 0:
+            break
+        found.extend(filter_items(batch, user))
+        offset += len(batch)
+    return found[:count]
+
+
+def get_suggested_items(user, count=10, seen_count=3):
+    """
+    Highest scored files `user` can access, mostly ones they have not seen
+    yet.
+    :param seen_count: Number of seen files at most among them
+    """
+    files = SharedItem.objects.exclude(type__type='Directory').order_by(
+        '-score', '-id')
+    seen = first_accessible(files.filter(seen_by=user), user, seen_count)
+    unseen = first_accessible(files.exclude(seen_by=user), user,
+                              count - len(seen))
+    return unseen + seen
 
 
 def get_latest_items(user, count=10):
-    items = [instance.item for instance in
-             ItemAccessibility.objects.filter(
-                 ~models.Q(item__type__type='Directory'), user=user,
-                 accessible=True).order_by('-item__time_added')[:count]]
-    return items
+    latest = SharedItem.objects.exclude(type__type='Directory').order_by(
+        '-time_added', '-id')
+    return first_accessible(latest, user, count)
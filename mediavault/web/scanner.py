@@ -0,0 +1,508 @@
+"""
+Library scanner adding whole directory trees to the shared items and
+keeping them in line with the disk.
+
+The tree is walked with os.scandir, MIME types of files are found by a
+MimeDetector (see web/detection.py) and the new
+items, their links to parents and the grants of the items at the top are
+written with chunked bulk inserts inside a single transaction, followed by
+their place in the tree index (see web/tree.py).
+
+Every item stores the size, modification time and inode of its file. A
+rescan only stats the tree and detects types of files whose fingerprint
+changed.
+"""
+import os
+
+from django.contrib.auth.models import User
+from django.db.models import Q, Value
+from django.db.models.functions import Concat, Substr
+from django.db.transaction import atomic
+
+from . import is_media, search, tree
+from .access import GENERATION as ACL_GENERATION
+from .detection import MimeDetector
+from .models import SharedItem, ItemType, AccessGrant, touch_listings, \
+    bump_generation, delete_items, prefixed
+
+WORKERS = 8
+BATCH_SIZE = 500
+
+
+def fingerprint(stat):
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def walk(location, recursive=True):
+    """
+    Walk the tree at `location` with os.scandir.
+    :param recursive: If False, only list the entries directly inside
+    `location`
+    :return: Tuple of lists of (path, parent path, stat result) of
+    directories and of files, and the list of paths that could not be read.
+    Directories are listed before anything inside them. If `location`
+    itself does not exist or cannot be read, only it is listed as
+    unreadable.
+    """
+    try:
+        stat = os.stat(location)
+    except OSError:
+        return [], [], [location]
+    if not os.path.isdir(location):
+        return [], [(location, None, stat)], []
+    directories = [(location, None, stat)]
+    files = []
+    unreadable = []
+    stack = [location]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            unreadable.append(directory)
+            continue
+        for entry in entries:
+            path = directory + '/' + entry.name
+            try:
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except OSError:
+                unreadable.append(path)
+                continue
+            if is_dir:
+                directories.append((path, directory, stat))
+                if recursive:
+                    stack.append(path)
+            else:
+                files.append((path, directory, stat))
+    if location in unreadable:
+        return [], [], [location]
+    return directories, files, unreadable
+
+
+def under(path, prefixes):
+    """
+    :return: True if `path` is one of `prefixes` or lies under one of them
+    """
+    return any(path == prefix or path.startswith(prefix + '/') for prefix in
+               prefixes)
+
+
+class LibraryScanner(object):
+    """
+    Adds a file or directory tree to the shared items, or rescans one that
+    is already shared.
+    """
+
+    def __init__(self, user, permission, workers=WORKERS,
+                 batch_size=BATCH_SIZE):
+        """
+        :param user: User adding the items
+        :param permission: One of 'all', 'admin', 'self', or 'inherit' to
+        give new items the access of their parent directory
+        :param workers: Number of threads sniffing MIME types
+        :param batch_size: Number of rows per bulk insert
+        """
+        self.user = user
+        self.permission = permission
+        self.detector = MimeDetector(workers, batch_size)
+        self.batch_size = batch_size
+        self.types = {}
+
+    def item_type(self, mime):
+        """
+        ItemType for `mime`, interned in memory for the scan.
+        """
+        if not self.types:
+            self.types = {item_type.type: item_type for item_type in
+                          ItemType.objects.all()}
+        if mime not in self.types:
+            self.types[mime] = ItemType.objects.create(type=mime)
+        return self.types[mime]
+
+    def grants(self, item_id):
+        """
+        Grants giving access to a new item added at the top of a scan.
+        Items below it inherit them, and with 'inherit' it gets none of its
+        own.
+        """
+        if self.permission == 'all':
+            user_ids = [None]
+        elif self.permission == 'admin':
+            user_ids = User.objects.filter(is_superuser=True).values_list(
+                'id', flat=True)
+        elif self.permission == 'self' and self.user:
+            user_ids = [self.user.id]
+        else:
+            user_ids = []
+        return [AccessGrant(item_id=item_id, user_id=user_id, allow=True) for
+                user_id in user_ids]
+
+    def known_items(self, location, recursive=True):
+        """
+        Dictionary of path to (id, fingerprint, mime) of the item at
+        `location` and the items under it, or only its direct children if
+        not `recursive`.
+        """
+        if recursive:
+            items = SharedItem.objects.filter(
+                Q(path=location) | prefixed('path', location + '/'))
+        else:
+            items = SharedItem.objects.filter(
+                Q(path=location) | Q(shareditem__path=location)).distinct()
+        return {
+            path: (item_id, (size, mtime, inode), mime) for
+            path, item_id, size, mtime, inode, mime in items.values_list(
+                'path', 'id', 'size', 'mtime', 'inode', 'type__type')
+        }
+
+    def scan(self, location, parent=None):
+        """
+        Add `location` and everything under it that is not shared yet.
+        :param location: Path of a file or directory on the host
+        :param parent: SharedItem under which `location` is added, or None
+        to add it as a root item
+        :return: Number of items added
+        """
+        location = location.rstrip('/') or '/'
+        known = self.known_items(location)
+        directories, files, _ = walk(location)
+        new = [(path, parent_path, 'Directory', stat) for
+               path, parent_path, stat in directories if path not in known]
+        files = [(path, parent_path, stat) for path, parent_path, stat in
+                 files if path not in known]
+        mimes = self.detector.detect_all([(path, stat) for path, _, stat in
+                                          files])
+        for (path, parent_path, stat), mime in zip(files, mimes):
+            if mime and is_media(mime):
+                new.append((path, parent_path, mime, stat))
+            else:
+                print('Unrecognized mime {1} for - {0}... Ignoring.'.format(
+                    path, mime))
+        if len(new) == 0:
+            return 0
+        existing = {path: item[0] for path, item in known.items()}
+        with atomic():
+            self.insert(new, existing, parent)
+        print('Added {0} items under {1} ({2})'.format(len(new), location,
+                                                       self.detector))
+        return len(new)
+
+    def rescan(self, location):
+        """
+        Bring the shared items under `location` in line with the disk. Only
+        files whose size, modification time or inode changed have their type
+        detected again, new files are added with the access of their parent
+        directory, moved files and directories keep their items and items
+        whose files are gone are removed.
+        :param location: Path of a shared file or directory on the host
+        :return: Tuple of numbers of items added, updated and removed
+        """
+        return self.sync([location])
+
+    def sync(self, locations, recursive=True):
+        """
+        Bring the shared items at and under several locations in line with
+        the disk at once, so that an item moved from one to another is
+        recognised as such by its inode.
+        :param locations: Paths of shared directories or files
+        :param recursive: If False, only compare the entries directly inside
+        the locations, walking further only into new directories. This is
+        what the library watcher uses for directories it saw events in.
+        :return: Tuple of numbers of items added, updated and removed
+
+        Only items whose files were positively found missing are removed. A
+        location that does not exist or cannot be read, e.g. an unplugged
+        drive, is skipped altogether, and the items under directories or
+        files that cannot be read are kept as they are.
+        """
+        known = {}
+        directories = {}
+        files = {}
+        unreadable = []
+        for location in set(path.rstrip('/') or '/' for path in locations):
+            items = self.known_items(location, recursive)
+            if location not in items:
+                continue
+            found_directories, found_files, found_unreadable = walk(
+                location, recursive)
+            if found_unreadable == [location]:
+                print('Cannot read {0}, leaving it as it is'.format(location))
+                continue
+            known.update(items)
+            unreadable.extend(found_unreadable)
+            for found, entries in ((found_directories, directories),
+                                   (found_files, files)):
+                for path, parent_path, stat in found:
+                    if path not in entries or entries[path][0] is None:
+                        entries[path] = (parent_path, stat)
+        for path in unreadable:
+            print('Cannot read {0}, keeping what is shared under it'.format(
+                path))
+        removed = {path: item for path, item in known.items() if
+                   path not in directories and path not in files and
+                   not under(path, unreadable)}
+        new_directories = sorted(
+            ((path, parent_path, stat) for path, (parent_path, stat) in
+             directories.items() if path not in known),
+            key=lambda entry: entry[0].count('/'))
+        new_files = [(path, parent_path, stat) for
+                     path, (parent_path, stat) in files.items() if
+                     path not in known]
+        changed = [(known[path][0], 'Directory', stat) for
+                   path, (_, stat) in directories.items() if
+                   path in known and known[path][1] != fingerprint(stat)]
+        moved, carried, new_directories, new_files = self.match_moves(
+            removed, new_directories, new_files)
+        if not recursive:
+            for path, _, _ in list(new_directories):
+                found_directories, found_files, _ = walk(path)
+                new_directories.extend(found_directories[1:])
+                new_files.extend(found_files)
+
+        to_sniff = [(path, parent_path, stat, None) for
+                    path, parent_path, stat in new_files]
+        to_sniff.extend((path, None, stat, known[path][0]) for
+                        path, (_, stat) in files.items() if
+                        path in known and known[path][1] != fingerprint(stat))
+        mimes = self.detector.detect_all([(path, stat) for path, _, stat, _ in
+                                          to_sniff])
+        new = [(path, parent_path, 'Directory', stat) for
+               path, parent_path, stat in new_directories]
+        for (path, parent_path, stat, item_id), mime in zip(to_sniff, mimes):
+            media = mime and is_media(mime)
+            if item_id is None and media:
+                new.append((path, parent_path, mime, stat))
+            elif item_id is not None and media:
+                changed.append((item_id, mime, stat))
+            elif item_id is not None and mime:
+                # No longer a media file. Files that cannot be read are kept.
+                removed[path] = known[path]
+
+        existing = {path: item[0] for path, item in known.items()}
+        existing.update(carried)
+        existing.update((new_path, item_id) for
+                        item_id, _, new_path, _, _, _ in moved)
+        with atomic():
+            if len(removed) > 0:
+                self.remove(removed, recursive)
+            if len(new) > 0:
+                self.insert(new, existing, None)
+            if len(moved) > 0:
+                self.move(moved, existing)
+            if len(changed) > 0:
+                self.update(changed)
+        print('Synced {0} - {1} added, {2} updated, {3} moved, {4} removed '
+              '({5})'.format(', '.join(sorted(locations)), len(new),
+                             len(changed), len(moved), len(removed),
+                             self.detector))
+        return len(new), len(changed) + len(moved), len(removed)
+
+    def match_moves(self, removed, new_directories, new_files):
+        """
+        Pair new entries with removed items of the same inode (and for files
+        the same size and modification time too). Entries inside a moved
+        directory that were shared under its old path move along with it.
+        :return: Tuple of the list of moves, as (item id, old path, new
+        path, new parent path, stat, is directory), a dictionary of new path
+        to id of the items carried along, and the lists of new directories
+        and files that did not move. Removed items that moved are taken out
+        of `removed`.
+        """
+        directories = {}
+        files = {}
+        for path, (item_id, (size, mtime, inode), mime) in removed.items():
+            if mime == 'Directory':
+                directories[inode] = path
+            else:
+                files[(size, mtime, inode)] = path
+        moved = []
+        carried = {}
+        prefixes = []
+
+        def carried_from(path):
+            for old, new in prefixes:
+                if path.startswith(new) and old + path[len(new):] in removed:
+                    return old + path[len(new):]
+            return None
+
+        remaining = ([], [])
+        for is_dir, entries, candidates in (
+                (True, new_directories, directories),
+                (False, new_files, files)):
+            for path, parent_path, stat in entries:
+                old_path = carried_from(path)
+                if old_path is not None:
+                    carried[path] = removed.pop(old_path)[0]
+                    continue
+                key = stat.st_ino if is_dir else fingerprint(stat)
+                old_path = candidates.pop(key, None)
+                if old_path is None or old_path not in removed:
+                    remaining[not is_dir].append((path, parent_path, stat))
+                    continue
+                moved.append((removed.pop(old_path)[0], old_path, path,
+                              parent_path, stat, is_dir))
+                if is_dir:
+                    prefixes.append((old_path + '/', path + '/'))
+        for path in list(removed):
+            for old, new in prefixes:
+                if path.startswith(old) and \
+                        os.path.exists(new + path[len(old):]):
+                    # Not walked at the new path, but still there
+                    del removed[path]
+                    break
+        return moved, carried, remaining[0], remaining[1]
+
+    def insert(self, new, existing, parent):
+        """
+        Bulk insert the items, the links to their parents and the grants of
+        the items at the top.
+        :param new: List of (path, parent path, mime, stat) of the new
+        items, parents before their children
+        :param existing: Dictionary of path to id of items already shared,
+        updated with the new items
+        :param parent: SharedItem above the scanned location, or None
+        """
+        items = []
+        for path, parent_path, mime, stat in new:
+            size, mtime, inode = fingerprint(stat)
+            items.append(SharedItem(
+                name=path.split('/')[-1], type=self.item_type(mime),
+                path=path, is_root=parent_path is None and parent is None,
+                size=size, mtime=mtime, inode=inode))
+        SharedItem.objects.bulk_create(items, batch_size=self.batch_size)
+        paths = [path for path, _, _, _ in new]
+        for chunk in tree.chunks(paths, self.batch_size):
+            # Paths shared twice by older versions map to the newest item
+            existing.update(SharedItem.objects.filter(
+                path__in=chunk).order_by('id').values_list('path', 'id'))
+
+        links = []
+        tops = []
+        for path, parent_path, _, _ in new:
+            if parent_path is not None:
+                parent_id = existing[parent_path]
+            elif parent is not None:
+                parent_id = parent.id
+            else:
+                tops.append(existing[path])
+                continue
+            links.append((parent_id, existing[path]))
+        through = SharedItem.children.through
+        through.objects.bulk_create(
+            [through(from_shareditem_id=parent_id, to_shareditem_id=item_id)
+             for parent_id, item_id in links], batch_size=self.batch_size)
+        tree.index(tops, links)
+
+        grants = []
+        for path, parent_path, _, _ in new:
+            if parent_path is None:
+                grants.extend(self.grants(existing[path]))
+        AccessGrant.objects.bulk_create(grants)
+        touch_listings(existing[path] for path in paths)
+        search.index_items(existing[path] for path in paths)
+
+    def update(self, changed):
+        """
+        Store the new type and fingerprint of changed items.
+        :param changed: List of (item id, mime, stat)
+        """
+        for item_id, mime, stat in changed:
+            size, mtime, inode = fingerprint(stat)
+            SharedItem.objects.filter(id=item_id).update(
+                type=self.item_type(mime), size=size, mtime=mtime,
+                inode=inode)
+        touch_listings(item_id for item_id, _, _ in changed)
+
+    def move(self, moved, existing):
+        """
+        Point moved items to their new path and parent, along with everything
+        under moved directories.
+        :param moved: List of moves as returned by match_moves()
+        :param existing: Dictionary of path to id of shared items
+        """
+        through = SharedItem.children.through
+        item_ids = [move[0] for move in moved]
+        renamed = list(item_ids)
+        touch_listings(item_ids)
+        for item_id, old_path, path, parent_path, stat, is_dir in moved:
+            size, mtime, inode = fingerprint(stat)
+            SharedItem.objects.filter(id=item_id).update(
+                path=path, name=path.split('/')[-1], size=size, mtime=mtime,
+                inode=inode)
+            through.objects.filter(to_shareditem_id=item_id).delete()
+            through.objects.create(from_shareditem_id=existing[parent_path],
+                                   to_shareditem_id=item_id)
+            tree.move(item_id, existing[parent_path])
+            if is_dir:
+                SharedItem.objects.filter(
+                    prefixed('path', old_path + '/')).update(path=Concat(
+                        Value(path), Substr('path', len(old_path) + 1)))
+                renamed.extend(SharedItem.objects.filter(
+                    prefixed('path', path + '/')).values_list('id', flat=True))
+        touch_listings(item_ids)
+        search.index_items(renamed)
+        # Moved items inherit the grants of their new parents
+        bump_generation(ACL_GENERATION)
+
+    def remove(self, removed, recursive=True):
+        """
+        Delete items whose files are gone, in chunks.
+        :param removed: Dictionary of path to (id, fingerprint, mime) of the
+        items
+        :param recursive: If False, the items under removed directories are
+        not in `removed` and are looked up by their path
+        """
+        item_ids = [item[0] for item in removed.values()]
+        if not recursive:
+            for path, (_, _, mime) in removed.items():
+                if mime == 'Directory':
+                    item_ids.extend(SharedItem.objects.filter(
+                        prefixed('path', path + '/')).values_list('id',
+                                                                  flat=True))
+        touch_listings(item_ids)
+        delete_items(item_ids, self.batch_size)
+        # The types cached for the files would only get in the way of
+        # files later put at the same paths, and the files left out as not
+        # media under removed directories have theirs as well.
+        directories = [path for path, (_, _, mime) in removed.items() if
+                       mime == 'Directory' and
+                       os.path.dirname(path) not in removed]
+        self.detector.forget([path for path, (_, _, mime) in removed.items()
+                              if mime != 'Directory'], directories)
+
+
+def scan_library(location, user, permission, parent=None):
+    """
+    Add the file or directory tree at `location` to the shared items.
+    :param location: Path on the host
+    :param user: User adding the items
+    :param permission: One of 'all', 'admin' or 'self'
+    :param parent: SharedItem under which `location` is added, or None
+    :return: Number of items added
+    """
+    scanner = LibraryScanner(user, permission)
+    try:
+        return scanner.scan(location, parent)
+    finally:
+        scanner.detector.close()
+
+
+def rescan_library(locations=None):
+    """
+    Rescan shared trees, all root items by default.
+    :param locations: Paths of shared items to rescan, or None
+    :return: Tuple of numbers of items added, updated and removed
+    """
+    if locations is None:
+        locations = SharedItem.objects.filter(is_root=True).values_list(
+            'path', flat=True)
+    scanner = LibraryScanner(None, 'inherit')
+    totals = [0, 0, 0]
+    try:
+        for location in locations:
+            for i, count in enumerate(scanner.rescan(location)):
+                totals[i] += count
+    finally:
+        scanner.detector.close()
+    return tuple(totals)
@@ -0,0 +1,222 @@
+"""
+Full text search of the shared items.
+
+On SQLite with the FTS5 extension, the name, title, artists, album and path
+of every item are kept in the FTS5 table `web_search`, whose rowid is the id
+of the item. Every term of a query matches the words starting with it in
+any of those columns, and results are ranked by bm25 with matches in the
+name and title weighing most. Other databases fall back to case insensitive
+LIKE matching of every term, with results in order of name.
+
+The scanner, metadata extraction and delete_items() keep the index up to
+date, and the rebuild_search command fills it for libraries shared before
+it existed. Results are filtered by access with the resolver of the user,
+reading ranked ids a batch at a time off one query until a page is full.
+"""
+import re
+import threading
+from itertools import islice
+
+from django.db import OperationalError, connection
+from django.db.models import Q
+from django.db.transaction import atomic, on_commit
+
+from .access import get_resolver
+from .models import SharedItem
+from .tree import chunks
+
+TABLE = 'web_search'
+COLUMNS = ('name', 'title', 'artist', 'album', 'path')
+# bm25 weights of COLUMNS
+WEIGHTS = (10.0, 8.0, 5.0, 4.0, 1.0)
+BATCH_SIZE = 200
+PAGE_SIZE = 20
+
+_available = None
+_lock = threading.Lock()
+
+
+def terms(query):
+    """
+    :return: List of the words of a search query, lower cased
+    """
+    return re.findall(r'\w+', query.lower())
+
+
+def fts_available():
+    """
+    :return: True if the FTS5 index can be used, creating its table if
+    needed. Only a database without FTS5 is given up on for good; other
+    failures, such as the database being locked, are tried again next time.
+    """
+    global _available
+    with _lock:
+        if _available is None:
+            if connection.vendor != 'sqlite':
+                _available = False
+                return _available
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING '
+                        'fts5({1}, tokenize="unicode61 remove_diacritics '
+                        '2", prefix="2 3")'.format(TABLE, ', '.join(COLUMNS)))
+            except OperationalError as e:
+                print('Full text search index unavailable, falling back '
+                      'to LIKE - {0!r}'.format(e))
+                if 'fts5' not in str(e):
+                    return False
+                _available = False
+                return _available
+            if connection.in_atomic_block:
+                # The table is only there for good once the transaction
+                # creating it commits.
+                on_commit(mark_available)
+                return True
+            _available = True
+        return _available
+
+
+def mark_available():
+    global _available
+    with _lock:
+        _available = True
+
+
+def documents(item_ids):
+    """
+    :return: List of (id, name, title, artists, album, path) of the items
+    with `item_ids`
+    """
+    rows = {}
+    for item_id, name, title, album, path in SharedItem.objects.filter(
+            id__in=item_ids).values_list('id', 'name', 'title', 'album__name',
+                                         'path'):
+        rows[item_id] = (name, title or '', [], album or '', path)
+    for item_id, first_name, last_name in SharedItem.artist.through.objects \
+            .filter(shareditem_id__in=item_ids).values_list(
+                'shareditem_id', 'artist__first_name', 'artist__last_name'):
+        rows[item_id][2].append('{0} {1}'.format(first_name, last_name))
+    return [(item_id, name, title, ' '.join(artists), album, path) for
+            item_id, (name, title, artists, album, path) in rows.items()]
+
+
+def index_items(item_ids):
+    """
+    Add items to the index, or bring their entries up to date.
+    """
+    if not fts_available():
+        return
+    with atomic(), connection.cursor() as cursor:
+        for chunk in chunks(item_ids):
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(
+                TABLE, ', '.join(['%s'] * len(chunk))), chunk)
+            cursor.executemany(
+                'INSERT INTO {0} (rowid, {1}) VALUES (%s, {2})'.format(
+                    TABLE, ', '.join(COLUMNS),
+                    ', '.join(['%s'] * len(COLUMNS))), documents(chunk))
+
+
+def remove_items(item_ids):
+    """
+    Drop the entries of deleted items from the index.
+    """
+    if not fts_available():
+        return
+    with atomic(), connection.cursor() as cursor:
+        for chunk in chunks(item_ids):
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(
+                TABLE, ', '.join(['%s'] * len(chunk))), chunk)
+
+
+def rebuild():
+    """
+    Fill the index with all items.
+    :return: Number of items indexed, or None without FTS5
+    """
+    if not fts_available():
+        return None
+    with atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {0}'.format(TABLE))
+        item_ids = list(SharedItem.objects.values_list('id', flat=True))
+        index_items(item_ids)
+    return len(item_ids)
+
+
+def ranked_ids(words, start):
+    """
+    Ids of the items matching all `words`, best matches first, starting at
+    the `start`th one. They are read off a single query, so that going on
+    past the first batch does not run the query again.
+    :return: Iterator over lists of at most BATCH_SIZE ids
+    """
+    if fts_available():
+        match = ' '.join('"{0}"*'.format(word) for word in words)
+        with connection.cursor() as cursor:
+            # rowid breaks ties, so that pages in a row neither repeat nor
+            # skip items ranked the same
+            cursor.execute(
+                'SELECT rowid FROM {0} WHERE {0} MATCH %s ORDER BY '
+                'bm25({0}, {1}), rowid LIMIT -1 OFFSET %s'.format(
+                    TABLE, ', '.join(str(weight) for weight in WEIGHTS)),
+                [match, start])
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
+        return
+    items = SharedItem.objects.all()
+    for word in words:
+        items = items.filter(
+            Q(name__icontains=word) | Q(title__icontains=word) |
+            Q(album__name__icontains=word) |
+            Q(artist__first_name__icontains=word) |
+            Q(artist__last_name__icontains=word))
+    ids = items.order_by('name', 'id').values_list(
+        'id', flat=True).distinct()[start:].iterator()
+    while True:
+        batch = list(islice(ids, BATCH_SIZE))
+        if not batch:
+            break
+        yield batch
+
+
+def search(user, query, start=0, limit=PAGE_SIZE):
+    """
+    Search the items that `user` can access.
+    :param query: Search query, words separated by anything else
+    :param start: Position in the ranked results to start at, the `next`
+    of the previous page
+    :param limit: Number of items on a page
+    :return: Tuple of the list of SharedItems found and of the start of the
+    next page, None on the last page
+    """
+    words = terms(query)
+    if not words:
+        return [], None
+    resolver = get_resolver(user)
+    page = []
+    position = start
+    next_start = None
+    batches = ranked_ids(words, start)
+    try:
+        for ids in batches:
+            access = resolver.resolve(ids)
+            for item_id in ids:
+                position += 1
+                if access[item_id]:
+                    page.append(item_id)
+                    if len(page) == limit:
+                        break
+            if len(page) == limit:
+                next_start = position
+                break
+    finally:
+        batches.close()
+    items = SharedItem.objects.filter(id__in=page).select_related(
+        'type', 'album', 'video_codec', 'audio_codec').prefetch_related(
+        'artist').in_bulk()
+    return [items[item_id] for item_id in page if item_id in items], \
+        next_start
@@ -0,0 +1,209 @@
+"""
+Helpers to stream files from the disk with support for HTTP range requests.
+"""
+import os
+import re
+import uuid
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+
+range_spec_regex = re.compile(r'^(\d*)-(\d*)$')
+
+
+def parse_range_header(header, size):
+    """
+    Parse the value of a Range header for a file of given size.
+    :param header: Value of the Range header (or None)
+    :param size: Size of the file in bytes
+    :return: None if the header should be ignored, an empty list if none of
+    the ranges can be satisfied, otherwise a list of (start, end) tuples with
+    inclusive byte positions.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = range_spec_regex.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # Suffix range - last N bytes of the file
+            suffix = int(last)
+            if suffix == 0 or size == 0:
+                continue
+            ranges.append((max(size - suffix, 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        end = int(last) if last else size - 1
+        ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        # Too many ranges to be worth it, send the whole file instead.
+        return None
+    return coalesce_ranges(ranges)
+
+
+def file_etag(stat):
+    """
+    Strong ETag of a file built from its inode, size and modification time.
+    """
+    return '"{0:x}-{1:x}-{2:x}"'.format(stat.st_ino, stat.st_size,
+                                        stat.st_mtime_ns)
+
+
+def not_modified(request, stat):
+    """
+    Evaluate the conditional headers of the request against the file.
+    :return: A 304 (or 412) response if the body need not be sent, else None
+    """
+    return get_conditional_response(request, etag=file_etag(stat),
+                                    last_modified=int(stat.st_mtime))
+
+
+def add_validators(response, stat, max_age=0):
+    """
+    Add ETag, Last-Modified and Cache-Control headers for the file.
+    """
+    response['ETag'] = file_etag(stat)
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = 'private, max-age={0}'.format(max_age)
+    return response
+
+
+def requested_range(request, stat):
+    """
+    Value of the Range header of the request, or None if there is none or
+    an If-Range precondition says the client's copy is stale.
+    """
+    header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not header or not if_range:
+        return header
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        # Only strong comparison is allowed for If-Range
+        return header if if_range == file_etag(stat) else None
+    if if_range.startswith('W/'):
+        return None
+    date = parse_http_date_safe(if_range)
+    if date is not None and date == int(stat.st_mtime):
+        return header
+    return None
+
+
+def coalesce_ranges(ranges):
+    """
+    Merge overlapping or adjacent ranges, keeping the requested order when
+    none of them overlap.
+    """
+    ordered = sorted(ranges)
+    for previous, current in zip(ordered, ordered[1:]):
+        if current[0] <= previous[1] + 1:
+            break
+    else:
+        return ranges
+    merged = [ordered[0]]
+    for start, end in ordered[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def read_file(path, start, length, chunk_size=CHUNK_SIZE):
+    """
+    Yield `length` bytes of a file starting at `start`, `chunk_size` bytes at
+    a time, so that memory use stays bounded irrespective of the file size.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def read_multipart(path, parts, trailer, chunk_size=CHUNK_SIZE):
+    """
+    Yield the body of a multipart/byteranges response.
+    :param parts: List of (part header, start, end) tuples
+    :param trailer: Closing boundary of the body
+    """
+    for header, start, end in parts:
+        yield header
+        for data in read_file(path, start, end - start + 1, chunk_size):
+            yield data
+    yield trailer
+
+
+def stream_file(request, path, content_type, stat=None):
+    """
+    Build a streaming response for the file at `path` honouring the Range
+    header of the request.
+    :param request: The request object
+    :param path: Path of the file on the host
+    :param content_type: MIME type of the file
+    :param stat: Result of os.stat() on the file, if already known
+    :return: Response with status 200, 206 or 416
+    """
+    if stat is None:
+        stat = os.stat(path)
+    size = stat.st_size
+    ranges = parse_range_header(requested_range(request, stat), size)
+    if ranges is None:
+        response = StreamingHttpResponse(read_file(path, 0, size),
+                                         content_type=content_type)
+        response['Content-Length'] = str(size)
+    elif len(ranges) == 0:
+        response = HttpResponse('', status=416)
+        response['Content-Range'] = 'bytes */{0}'.format(size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            read_file(path, start, end - start + 1), status=206,
+            content_type=content_type)
+        response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end,
+                                                               size)
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        length = 0
+        for start, end in ranges:
+            header = '{0}--{1}\r\nContent-Type: {2}\r\nContent-Range: ' \
+                     'bytes {3}-{4}/{5}\r\n\r\n'.format(
+                         '\r\n' if parts else '', boundary, content_type,
+                         start, end, size).encode()
+            parts.append((header, start, end))
+            length += len(header) + end - start + 1
+        trailer = '\r\n--{0}--\r\n'.format(boundary).encode()
+        length += len(trailer)
+        response = StreamingHttpResponse(
+            read_multipart(path, parts, trailer), status=206,
+            content_type='multipart/byteranges; boundary={0}'.format(boundary))
+        response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
@@ -0,0 +1,189 @@
+"""
+Background tasks for work too long to do within a request.
+
+Tasks run in small pools of threads of the process that started them, one
+pool per queue. Their state and progress are kept in Task rows, so that
+pages served by any process can show them.
+
+While a process has tasks queued or running, a thread of it stamps them
+every HEARTBEAT_INTERVAL seconds. Tasks left pending or running by a
+process that stopped, whose stamp is older than TASK_HEARTBEAT_TIMEOUT
+seconds, are marked as failed by reap_orphans().
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .models import Task
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# Result of tasks reaped by reap_orphans()
+INTERRUPTED = 'Interrupted'
+
+WORKERS = 2
+# Settings holding the number of threads of each queue
+QUEUES = {
+    'default': 'TASK_WORKERS',
+    'downloads': 'DOWNLOAD_WORKERS',
+}
+# Least number of seconds between two writes of the progress of a task
+PROGRESS_INTERVAL = 0.5
+# Seconds between two stamps of the tasks of a process, and after which a
+# task that was not stamped is taken for interrupted
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+
+_executors = {}
+_lock = threading.Lock()
+_owned = set()
+_heartbeat = None
+
+
+def get_executor(queue='default'):
+    with _lock:
+        if queue not in _executors:
+            _executors[queue] = ThreadPoolExecutor(
+                max_workers=getattr(settings, QUEUES[queue], WORKERS))
+        return _executors[queue]
+
+
+def beat():
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        with _lock:
+            task_ids = list(_owned)
+        if task_ids:
+            try:
+                Task.objects.filter(id__in=task_ids).update(
+                    time_heartbeat=timezone.now())
+            except Exception as e:
+                print('Cannot stamp tasks - {0!r}'.format(e))
+            finally:
+                connection.close()
+
+
+def own(task_id):
+    """
+    Stamp the task with the heartbeat of this process until it finishes.
+    """
+    global _heartbeat
+    with _lock:
+        _owned.add(task_id)
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=beat, daemon=True)
+            _heartbeat.start()
+
+
+def orphans():
+    """
+    :return: QuerySet of the tasks left pending or running by processes that
+    stopped
+    """
+    timeout = getattr(settings, 'TASK_HEARTBEAT_TIMEOUT', HEARTBEAT_TIMEOUT)
+    return Task.objects.filter(
+        state__in=(PENDING, RUNNING),
+        time_heartbeat__lt=timezone.now() - timedelta(seconds=timeout))
+
+
+def reap_orphans():
+    """
+    Mark the tasks left pending or running by processes that stopped as
+    failed.
+    :return: Number of tasks marked
+    """
+    return orphans().update(state=FAILED, result=INTERRUPTED,
+                            active_key=None, time_finished=timezone.now())
+
+
+def reporter(task_id):
+    """
+    :return: Function taking the number of units of work done and the total,
+    writing them to the task at most every PROGRESS_INTERVAL seconds
+    """
+    last = [0.0]
+
+    def progress(done, total):
+        now = time.monotonic()
+        if now - last[0] < PROGRESS_INTERVAL and done < total:
+            return
+        last[0] = now
+        Task.objects.filter(id=task_id).update(done=done, total=total)
+
+    return progress
+
+
+def run(task_id, function, args, message):
+    try:
+        Task.objects.filter(id=task_id).update(state=RUNNING)
+        result = function(*args, progress=reporter(task_id))
+        if not isinstance(result, tuple):
+            result = (result,)
+        Task.objects.filter(id=task_id).update(
+            state=DONE, result=message.format(*result)[:512],
+            active_key=None, time_finished=timezone.now())
+    except Exception as e:
+        print('Task {0} failed - {1!r}'.format(task_id, e))
+        Task.objects.filter(id=task_id).update(
+            state=FAILED, result=repr(e)[:512], active_key=None,
+            time_finished=timezone.now())
+    finally:
+        with _lock:
+            _owned.discard(task_id)
+        connection.close()
+
+
+def submit(kind, description, function, *args, item=None, user=None,
+           message='{0}', key='', queue='default'):
+    """
+    Run `function` in the background.
+    :param kind: Short name of the kind of task
+    :param description: What the task does, shown while it runs
+    :param function: Called with `args` and a `progress` keyword argument,
+    a function to report the units of work done and the total to
+    :param item: SharedItem the task works on, if any
+    :param user: User who started the task, if any
+    :param message: Format string for the result of `function`, or the items
+    of it if it is a tuple, saved as the result of the task
+    :param key: What the task works on, if a task with the same key that is
+    pending or running should take its place
+    :param queue: One of QUEUES, the pool of threads running the task
+    :return: Task, the one already queued with the same key if any
+    """
+    if key:
+        reap_orphans()
+    for attempt in range(2):
+        try:
+            with atomic():
+                task = Task.objects.create(
+                    kind=kind, description=description, item=item, user=user,
+                    key=key, active_key=key or None)
+            break
+        except IntegrityError:
+            # The same key is pending or running, unless it just finished
+            queued = Task.objects.filter(active_key=key).first()
+            if queued is not None:
+                return queued
+            if attempt == 1:
+                raise
+    own(task.id)
+    get_executor(queue).submit(run, task.id, function, args, message)
+    return task
+
+
+def item_tasks(item, limit=5):
+    """
+    :return: List of the tasks running on `item` and of the last ones that
+    finished, newest first
+    """
+    reap_orphans()
+    return list(Task.objects.filter(item=item).order_by('-time_created')[
+                :limit])
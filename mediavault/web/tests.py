@@ -1,3 +1,1402 @@
-from django.test import TestCase
+import asyncio
+import ctypes
+import errno
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.transaction import atomic
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+    override_settings
+from django.utils import timezone
+from requests import HTTPError
+
+from . import access, counters, downloads, listings, search, tasks, \
+    thumbnails, tree
+from .access import AccessResolver, accessible_children, accessible_filter, \
+    set_grant, users_by_access
+from .asgi import ASGIHandler, FileStream
+from .delivery import get_backend
+from .extraction import MetadataExtractor, pending_items
+from .listings import explore_listing, manage_listing
+from .metadata import find_parser, probe
+from .middleware import get_user, user_key
+from .models import AccessGrant, ItemRating, ItemType, SharedItem, Task, \
+    bump_generation, delete_items, get_suggested_items, prefixed, \
+    rate_item, remove_item_recursive, remove_ratings, repair_ratings, \
+    touch_listing, update_scores
+from .scanner import LibraryScanner, scan_library
+from .streaming import coalesce_ranges, parse_range_header
+from .tasks import DONE, FAILED
+from .thumbnails import ThumbnailCache
+from .tree import path_ids
+from .watcher import InotifyBackend
+from .youtube import POOL_SIZE, YouTubeClient, parse_results
+
+
+def make_files(root, names):
+    """
+    Write small MP3 files at `names`, paths relative to `root`.
+    """
+    for name in names:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'ID3' + b'\0' * 100)
+
+
+def finished(task, timeout=30):
+    """
+    Wait for a background task to be done or to fail.
+    :return: The task, refreshed
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        task.refresh_from_db()
+        if task.state in (DONE, FAILED):
+            return task
+        time.sleep(0.1)
+    raise AssertionError('{0} did not finish'.format(task))
+
+
+class RangeTests(SimpleTestCase):
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range_header('bytes=900-', 1000),
+                         [(900, 999)])
+        self.assertEqual(parse_range_header('bytes=-100', 1000),
+                         [(900, 999)])
+        self.assertEqual(parse_range_header('bytes=990-2000', 1000),
+                         [(990, 999)])
+        self.assertEqual(parse_range_header('bytes=-5000', 1000),
+                         [(0, 999)])
+
+    def test_ignored_headers(self):
+        self.assertIsNone(parse_range_header(None, 1000))
+        self.assertIsNone(parse_range_header('', 1000))
+        self.assertIsNone(parse_range_header('items=0-9', 1000))
+        self.assertIsNone(parse_range_header('bytes=9-0', 1000))
+        self.assertIsNone(parse_range_header('bytes=a-b', 1000))
+        self.assertIsNone(parse_range_header('bytes=-', 1000))
+
+    def test_unsatisfiable_ranges(self):
+        self.assertEqual(parse_range_header('bytes=1000-', 1000), [])
+        self.assertEqual(parse_range_header('bytes=-0', 1000), [])
+        self.assertEqual(parse_range_header('bytes=-10', 0), [])
+
+    def test_several_ranges(self):
+        self.assertEqual(parse_range_header('bytes=500-599, 0-99', 1000),
+                         [(500, 599), (0, 99)])
+        self.assertEqual(parse_range_header('bytes=0-99,50-149', 1000),
+                         [(0, 149)])
+
+    def test_coalesce_ranges(self):
+        self.assertEqual(coalesce_ranges([(10, 19), (0, 4)]),
+                         [(10, 19), (0, 4)])
+        self.assertEqual(coalesce_ranges([(10, 19), (0, 9)]), [(0, 19)])
+        self.assertEqual(coalesce_ranges([(0, 50), (10, 20), (60, 70)]),
+                         [(0, 50), (60, 70)])
+        self.assertEqual(coalesce_ranges([(5, 9)]), [(5, 9)])
+
+
+class ScannerTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.library = os.path.join(self.root, 'library')
+        make_files(self.library, ['a.mp3', 'sub/b.mp3', 'sub/c.mp3'])
+        self.user = User.objects.create_user('user')
+        self.scanner = LibraryScanner(None, 'inherit')
+        self.addCleanup(self.scanner.detector.close)
+        scan_library(self.library, self.user, 'all')
+
+    def paths(self):
+        return sorted(os.path.relpath(path, self.root) for path in
+                      SharedItem.objects.values_list('path', flat=True))
+
+    def test_scan(self):
+        self.assertEqual(self.paths(), [
+            'library', 'library/a.mp3', 'library/sub', 'library/sub/b.mp3',
+            'library/sub/c.mp3'])
+        self.assertEqual(scan_library(self.library, self.user, 'all'), 0)
+
+    def test_sibling_with_the_same_prefix_is_left_alone(self):
+        sibling = os.path.join(self.root, 'library2')
+        make_files(sibling, ['e.mp3'])
+        scan_library(sibling, self.user, 'all')
+        self.assertEqual(self.scanner.rescan(self.library), (0, 0, 0))
+        os.remove(os.path.join(sibling, 'e.mp3'))
+        shutil.rmtree(os.path.join(self.library, 'sub'))
+        self.assertEqual(self.scanner.rescan(self.library)[2], 3)
+        self.assertTrue(SharedItem.objects.filter(name='e.mp3').exists())
+
+    def test_prefixed_matches_exactly(self):
+        paths = [path for path in SharedItem.objects.filter(
+            prefixed('path', self.library + '/sub/')).values_list(
+            'path', flat=True)]
+        self.assertEqual(sorted(os.path.basename(path) for path in paths),
+                         ['b.mp3', 'c.mp3'])
+
+    def test_sync_adds_and_removes(self):
+        os.remove(os.path.join(self.library, 'sub', 'c.mp3'))
+        make_files(self.library, ['sub/d.mp3'])
+        added, _, removed = self.scanner.rescan(self.library)
+        self.assertEqual((added, removed), (1, 1))
+        self.assertEqual(self.paths(), [
+            'library', 'library/a.mp3', 'library/sub', 'library/sub/b.mp3',
+            'library/sub/d.mp3'])
+        added = SharedItem.objects.get(name='d.mp3')
+        self.assertTrue(added.tree_path.startswith(
+            SharedItem.objects.get(name='sub').tree_path))
+
+    def test_sync_keeps_items_of_a_missing_root(self):
+        before = self.paths()
+        os.rename(self.library, os.path.join(self.root, 'unmounted'))
+        self.assertEqual(self.scanner.rescan(self.library), (0, 0, 0))
+        self.assertEqual(self.paths(), before)
+
+    def test_sync_keeps_items_of_an_unreadable_directory(self):
+        before = self.paths()
+        scandir = os.scandir
+
+        def denied(path):
+            if path.endswith('/sub'):
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        with mock.patch('os.scandir', denied):
+            self.assertEqual(self.scanner.rescan(self.library), (0, 0, 0))
+        self.assertEqual(self.paths(), before)
+
+    def test_sync_follows_moves(self):
+        item_id = SharedItem.objects.get(name='b.mp3').id
+        os.rename(os.path.join(self.library, 'sub', 'b.mp3'),
+                  os.path.join(self.library, 'b.mp3'))
+        self.scanner.rescan(self.library)
+        item = SharedItem.objects.get(id=item_id)
+        self.assertEqual(item.path, os.path.join(self.library, 'b.mp3'))
+        self.assertEqual(item.tree_path.count('/'), 3)
+
+
+class TreeTests(TestCase):
+
+    def setUp(self):
+        directory = ItemType.objects.create(type='Directory')
+        self.items = {}
+        for name, parent in [('root', None), ('a', 'root'), ('b', 'a'),
+                             ('c', 'b'), ('d', 'root'), ('other', None)]:
+            self.items[name] = SharedItem.objects.create(
+                name=name, path='/' + name, type=directory,
+                is_root=parent is None)
+            if parent:
+                self.items[parent].children.add(self.items[name])
+        self.assertEqual(tree.rebuild(), 6)
+        for item in self.items.values():
+            item.refresh_from_db()
+
+    def names(self, ids):
+        names = {item.id: name for name, item in self.items.items()}
+        return [names[item_id] for item_id in ids]
+
+    def test_rebuild(self):
+        c = self.items['c']
+        self.assertEqual(self.names(path_ids(c.tree_path)),
+                         ['root', 'a', 'b', 'c'])
+        self.assertEqual(c.depth, 3)
+        self.assertEqual(self.items['other'].tree_path,
+                         '/{0}/'.format(self.items['other'].id))
+        self.assertEqual([item.name for item in tree.breadcrumbs(c)],
+                         ['root', 'a', 'b', 'c'])
+
+    def test_subtree(self):
+        self.assertEqual(sorted(self.names(tree.descendant_ids(
+            self.items['root']))), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.names(tree.descendant_ids(self.items['c'])),
+                         [])
+
+    def test_move(self):
+        self.items['root'].children.remove(self.items['a'])
+        self.items['d'].children.add(self.items['a'])
+        tree.move(self.items['a'].id, self.items['d'].id)
+        c = SharedItem.objects.get(id=self.items['c'].id)
+        self.assertEqual(self.names(path_ids(c.tree_path)),
+                         ['root', 'd', 'a', 'b', 'c'])
+        self.assertEqual(c.depth, 4)
+        self.assertEqual(sorted(self.names(tree.descendant_ids(
+            self.items['d']))), ['a', 'b', 'c'])
+
+    def test_remove_subtree(self):
+        user = User.objects.create_user('user')
+        for name in ('a', 'c', 'other'):
+            set_grant(self.items[name].id, user.id, True)
+            ItemRating.objects.create(user=user, item=self.items[name],
+                                      rating=5)
+        task = Task.objects.create(kind='test', item=self.items['b'])
+        counts = remove_item_recursive(self.items['a'])
+        self.assertEqual(counts['web.SharedItem'], 3)
+        self.assertEqual(counts['web.SharedItem_children'], 3)
+        self.assertEqual(counts['web.AccessGrant'], 2)
+        self.assertEqual(counts['web.ItemRating'], 2)
+        self.assertEqual(sorted(SharedItem.objects.values_list(
+            'name', flat=True)), ['d', 'other', 'root'])
+        self.assertEqual(AccessGrant.objects.get().item_id,
+                         self.items['other'].id)
+        # Tasks outlive the items they worked on
+        task.refresh_from_db()
+        self.assertIsNone(task.item_id)
+
+    def test_delete_in_chunks(self):
+        ids = [self.items[name].id for name in ('a', 'b', 'c', 'd')]
+        counts = delete_items(ids, chunk_size=3)
+        self.assertEqual(counts['web.SharedItem'], 4)
+        self.assertEqual(counts['web.SharedItem_children'], 4)
+        self.assertEqual(SharedItem.objects.count(), 2)
+
+    def test_unindexed_item(self):
+        SharedItem.objects.filter(id=self.items['b'].id).update(tree_path='')
+        self.items['b'].refresh_from_db()
+        with self.assertRaises(ValueError):
+            tree.descendant_ids(self.items['b'])
+
+
+class AccessTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        library = os.path.join(self.root, 'library')
+        make_files(library, ['a.mp3', 'open/b.mp3', 'closed/c.mp3',
+                             'closed/reopened/d.mp3'])
+        self.user = User.objects.create_user('user')
+        self.other = User.objects.create_user('other')
+        scan_library(library, self.user, 'all')
+        self.items = {item.name: item for item in SharedItem.objects.all()}
+        set_grant(self.items['closed'].id, None, False)
+        set_grant(self.items['reopened'].id, None, True)
+        set_grant(self.items['open'].id, self.other.id, False)
+        bump_generation(access.GENERATION)
+        # The caches of the process outlive the rolled back generations
+        access._caches.clear()
+        access._classes.clear()
+
+    def accessible(self, user):
+        resolved = AccessResolver(user).resolve(self.items[name].id for name
+                                                in self.items)
+        return sorted(name for name in self.items if
+                      resolved[self.items[name].id])
+
+    def test_resolver_inherits_nearest_grant(self):
+        self.assertEqual(self.accessible(self.user), [
+            'a.mp3', 'b.mp3', 'd.mp3', 'library', 'open', 'reopened'])
+        self.assertEqual(self.accessible(self.other), [
+            'a.mp3', 'd.mp3', 'library', 'reopened'])
+
+    def test_user_grant_wins_over_everyone(self):
+        set_grant(self.items['closed'].id, self.other.id, True)
+        self.assertIn('c.mp3', self.accessible(self.other))
+        self.assertNotIn('c.mp3', self.accessible(self.user))
+
+    def test_no_grant_no_access(self):
+        AccessGrant.objects.filter(item=self.items['library']).delete()
+        self.assertEqual(self.accessible(self.user), ['d.mp3', 'reopened'])
+
+    def test_accessible_children(self):
+        def children(user, parent=None):
+            return sorted(accessible_children(user, parent).values_list(
+                'name', flat=True))
+
+        self.assertEqual(children(self.user), ['library'])
+        self.assertEqual(children(self.user, self.items['library']),
+                         ['a.mp3', 'open'])
+        self.assertEqual(children(self.other, self.items['library']),
+                         ['a.mp3'])
+        self.assertEqual(children(self.user, self.items['closed']),
+                         ['reopened'])
+        self.assertEqual(children(self.user, self.items['reopened']),
+                         ['d.mp3'])
+
+    def test_users_by_access(self):
+        for name in self.items:
+            with self.assertNumQueries(2):
+                allowed, denied = users_by_access(self.items[name])
+            self.assertEqual(
+                [user.username for user in allowed],
+                [user.username for user in (self.user, self.other) if
+                 name in self.accessible(user)])
+            self.assertEqual(len(allowed) + len(denied), 2)
+
+    def test_accessible_filter_agrees_with_resolver(self):
+        for user in (self.user, self.other):
+            found = SharedItem.objects.filter(accessible_filter(user))
+            self.assertEqual(sorted(found.values_list('name', flat=True)),
+                             self.accessible(user))
+
+    def test_accessible_filter_gives_up_on_many_grants(self):
+        with mock.patch.object(access, 'MAX_FILTER_GRANTS', 1):
+            self.assertIsNone(accessible_filter(self.user))
+
+
+class SuggestionTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        make_files(self.root, ['library/open/{0}.mp3'.format(i) for i in
+                               range(6)] + ['library/closed/hidden.mp3'])
+        self.user = User.objects.create_user('user')
+        scan_library(os.path.join(self.root, 'library'), self.user, 'all')
+        set_grant(SharedItem.objects.get(name='closed').id, None, False)
+        bump_generation(access.GENERATION)
+        access._caches.clear()
+        for views, name in enumerate(['0.mp3', '1.mp3', '2.mp3', '3.mp3',
+                                      '4.mp3', '5.mp3']):
+            SharedItem.objects.filter(name=name).update(views=views * 10)
+        SharedItem.objects.filter(name='hidden.mp3').update(views=1000)
+        update_scores()
+
+    def names(self, items):
+        return [item.name for item in items]
+
+    def test_highest_scores_the_user_can_access(self):
+        self.assertEqual(self.names(get_suggested_items(self.user, 3)),
+                         ['5.mp3', '4.mp3', '3.mp3'])
+
+    def test_seen_items_are_limited(self):
+        for name in ('5.mp3', '4.mp3', '3.mp3'):
+            SharedItem.objects.get(name=name).seen_by.add(self.user)
+        self.assertEqual(self.names(get_suggested_items(self.user, 4, 1)),
+                         ['2.mp3', '1.mp3', '0.mp3', '5.mp3'])
+
+    def test_without_the_filter(self):
+        with mock.patch.object(access, 'MAX_FILTER_GRANTS', 0):
+            self.assertEqual(self.names(get_suggested_items(self.user, 3)),
+                             ['5.mp3', '4.mp3', '3.mp3'])
+
+
+class RatingTests(TestCase):
+
+    def setUp(self):
+        self.item = SharedItem.objects.create(
+            name='a.mp3', path='/a.mp3',
+            type=ItemType.objects.create(type='Audio'))
+        self.users = [User.objects.create_user(str(i)) for i in range(3)]
+
+    def totals(self):
+        self.item.refresh_from_db()
+        return self.item.rating_sum, self.item.rating_count
+
+    def test_totals_follow_ratings(self):
+        rate_item(self.item, self.users[0], 8)
+        rate_item(self.item, self.users[1], 4)
+        self.assertEqual(self.totals(), (12, 2))
+        self.assertEqual(self.item.average_rating(), 6)
+        # Rating again replaces the earlier rating
+        rate_item(self.item, self.users[0], 2)
+        self.assertEqual(self.totals(), (6, 2))
+        self.assertEqual(ItemRating.objects.count(), 2)
+        remove_ratings(ItemRating.objects.filter(user=self.users[1]))
+        self.assertEqual(self.totals(), (2, 1))
+
+    def test_one_rating_per_user(self):
+        rate_item(self.item, self.users[0], 8)
+        with self.assertRaises(IntegrityError), atomic():
+            ItemRating.objects.create(item=self.item, user=self.users[0],
+                                      rating=1)
+
+    def test_repair(self):
+        for user, rating in zip(self.users, (3, 5, 7)):
+            rate_item(self.item, user, rating)
+        other = SharedItem.objects.create(name='b.mp3', path='/b.mp3',
+                                          type=self.item.type,
+                                          rating_sum=9, rating_count=1)
+        self.assertEqual(repair_ratings(), 1)
+        SharedItem.objects.filter(id=self.item.id).update(rating_sum=1)
+        self.assertEqual(repair_ratings(), 1)
+        self.assertEqual(self.totals(), (15, 3))
+        other.refresh_from_db()
+        self.assertEqual((other.rating_sum, other.rating_count), (0, 0))
+
+
+class CounterTests(TestCase):
+
+    def setUp(self):
+        kind = ItemType.objects.create(type='Audio')
+        self.items = [SharedItem.objects.create(
+            name='{0}.mp3'.format(i), path='/{0}.mp3'.format(i), type=kind)
+            for i in range(3)]
+        self.user = User.objects.create_user('user')
+        # The thread flushing on its own never wakes up during a test
+        self.counter = counters.ViewCounter(interval=3600)
+
+    def views(self):
+        return [SharedItem.objects.get(id=item.id).views for item in
+                self.items]
+
+    def test_flush(self):
+        first, second, _ = self.items
+        for item in (first, first, first, second):
+            self.counter.add(item.id, self.user.id)
+        self.counter.add(second.id)
+        self.assertEqual(self.counter.pending(first.id), 3)
+        self.assertEqual(self.views(), [0, 0, 0])
+        self.assertEqual(self.counter.flush(), 2)
+        self.assertEqual(self.views(), [3, 2, 0])
+        self.assertEqual(self.counter.pending(first.id), 0)
+        self.assertEqual(sorted(self.user.shareditem_set.values_list(
+            'name', flat=True)), ['0.mp3', '1.mp3'])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertGreater(first.score, second.score)
+        # Views add up, users are only recorded once
+        self.counter.add(first.id, self.user.id)
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(self.views(), [4, 2, 0])
+        self.assertEqual(self.user.shareditem_set.count(), 2)
+        self.assertEqual(self.counter.flush(), 0)
+
+    def test_deleted_item(self):
+        self.counter.add(self.items[0].id, self.user.id)
+        self.items[0].delete()
+        self.counter.flush()
+        self.assertEqual(self.user.shareditem_set.count(), 0)
+
+    def test_failed_flush_keeps_counts(self):
+        self.counter.add(self.items[0].id, self.user.id)
+        with mock.patch.object(counters, 'update_scores',
+                               side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.counter.flush()
+        self.counter.add(self.items[0].id)
+        self.assertEqual(self.counter.pending(self.items[0].id), 2)
+        self.assertEqual(self.views(), [0, 0, 0])
+        self.counter.flush()
+        self.assertEqual(self.views(), [2, 0, 0])
+        self.assertEqual(self.user.shareditem_set.count(), 1)
+
+
+class DownloadTests(TransactionTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        source = os.path.join(self.root, 'source.mp3')
+        make_files(self.root, ['source.mp3'])
+        downloads.set_downloader(downloads.LocalDownloader(source))
+        self.addCleanup(downloads.set_downloader, None)
+        self.user = User.objects.create_user('user')
+
+    def test_enqueue_and_ingest(self):
+        directory = os.path.join(self.root, 'downloads')
+        copy = downloads.get_downloader().download
+        again = threading.Event()
+
+        def download(*args):
+            # Hold the download until it was asked for again
+            again.wait(10)
+            return copy(*args)
+
+        with override_settings(DOWNLOAD_DIR=directory), \
+                mock.patch('web.extraction.extract_in_background'), \
+                mock.patch.object(downloads.get_downloader(), 'download',
+                                  download):
+            task = downloads.enqueue('abcdefghijk', False, self.user)
+            self.assertEqual(
+                downloads.enqueue('abcdefghijk', False, self.user).id,
+                task.id)
+            again.set()
+            task = finished(task)
+            self.assertEqual(task.state, DONE, task.result)
+            audio = finished(downloads.enqueue('abcdefghijk', True,
+                                               self.user))
+            self.assertEqual(audio.state, DONE, audio.result)
+        item = SharedItem.objects.get(
+            path=os.path.join(directory, 'video-abcdefghijk.mp3'))
+        parent = SharedItem.objects.get(path=directory)
+        self.assertTrue(item.tree_path.startswith(parent.tree_path))
+        self.assertTrue(SharedItem.objects.filter(
+            path=os.path.join(directory, 'audio-abcdefghijk.mp3')).exists())
+        self.assertEqual(Task.objects.filter(kind=downloads.KIND).count(), 2)
+
+    def test_invalid_video_id(self):
+        for video_id in ('../../etc/passwd', 'abcdefghijk\n', 'abcdefghij'):
+            with self.assertRaises(ValueError):
+                downloads.enqueue(video_id)
+
+    def test_key_is_queued_once(self):
+        queued = Task.objects.create(kind='test', description='queued',
+                                     key='test:1', active_key='test:1')
+        task = tasks.submit('test', 'again', lambda progress: 0,
+                            key='test:1')
+        self.assertEqual(task.id, queued.id)
+        self.assertEqual(Task.objects.count(), 1)
+        Task.objects.filter(id=queued.id).update(state=DONE,
+                                                 active_key=None)
+        task = finished(tasks.submit('test', 'again',
+                                     lambda progress: 0, key='test:1'))
+        self.assertNotEqual(task.id, queued.id)
+        self.assertEqual(task.state, DONE)
+        self.assertIsNone(task.active_key)
+
+    def test_resume_interrupted_downloads(self):
+        interrupted = Task.objects.create(
+            kind=downloads.KIND, description='interrupted', user=self.user,
+            key='download:audio:qqqqqqqqqqq', state=FAILED,
+            result=tasks.INTERRUPTED)
+        with override_settings(
+                DOWNLOAD_DIR=os.path.join(self.root, 'downloads')), \
+                mock.patch('web.extraction.extract_in_background'):
+            self.assertEqual(downloads.resume(), 1)
+            self.assertEqual(downloads.resume(), 0)
+            task = finished(Task.objects.exclude(
+                id=interrupted.id).get(key=interrupted.key))
+        self.assertEqual(task.state, DONE, task.result)
+        interrupted.refresh_from_db()
+        self.assertEqual(interrupted.result, downloads.RESUMED)
+
+
+def serve(application, method='GET', path='/', disconnect=False):
+    """
+    Run a request through an ASGI `application`.
+    :param disconnect: Whether the client leaves after the first chunk
+    :return: List of the messages sent by the application
+    """
+    sent = []
+
+    async def run():
+        gone = asyncio.Event()
+        requests = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if disconnect and message['type'] == 'http.response.body':
+                gone.set()
+                await asyncio.sleep(0.05)
+
+        await application({'type': 'http', 'method': method, 'path': path,
+                           'query_string': b'a=1', 'headers': [
+                               (b'content-type', b'text/plain'),
+                               (b'x-forwarded-for', b'10.0.0.1')]},
+                          receive, send)
+        gone.set()
+
+    asyncio.run(run())
+    return sent
+
+
+class ASGITests(SimpleTestCase):
+
+    def setUp(self):
+        self.threads = []
+        self.closed = []
+
+    def application(self, body):
+        def application(environ, start_response):
+            self.environ = environ
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return body(environ)
+        return ASGIHandler(application, threads=2, read_threads=2)
+
+    def stream(self, environ):
+        test = self
+
+        class Body(object):
+            streaming = True
+
+            def __iter__(self):
+                for chunk in (b'a', b'b', b'c'):
+                    test.threads.append(threading.get_ident())
+                    yield chunk
+
+            def close(self):
+                test.closed.append(threading.get_ident())
+        return Body()
+
+    def test_environ(self):
+        serve(self.application(lambda environ: [b'']))
+        self.assertEqual(self.environ['PATH_INFO'], '/')
+        self.assertEqual(self.environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(self.environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(self.environ['HTTP_X_FORWARDED_FOR'], '10.0.0.1')
+
+    def test_stream_is_iterated_and_closed_on_one_thread(self):
+        with mock.patch('web.asgi.connections') as connections:
+            sent = serve(self.application(self.stream))
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(b''.join(message.get('body', b'')
+                                  for message in sent), b'abc')
+        self.assertFalse(sent[-1].get('more_body', False))
+        self.assertEqual(len(set(self.threads + self.closed)), 1)
+        self.assertNotEqual(self.closed[0], threading.get_ident())
+        connections.close_all.assert_called_once_with()
+
+    def test_stream_stops_when_the_client_leaves(self):
+        serve(self.application(self.stream), disconnect=True)
+        self.assertLess(len(self.threads), 3)
+        self.assertEqual(len(self.closed), 1)
+
+    def test_head_sends_no_body(self):
+        sent = serve(self.application(self.stream), method='HEAD')
+        self.assertEqual(self.threads, [])
+        self.assertEqual(len(self.closed), 1)
+        self.assertEqual([message.get('body', b'') for message in sent[1:]],
+                         [b''])
+
+    def test_file_is_read_from_its_position(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'0123456789')
+            f.seek(2)
+
+            def body(environ):
+                return environ['wsgi.file_wrapper'](f, block_size=3)
+            sent = serve(self.application(body))
+            self.assertEqual(b''.join(message.get('body', b'')
+                                      for message in sent), b'23456789')
+
+
+@skipUnless(sys.platform.startswith('linux'), 'inotify is only on Linux')
+class WatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        make_files(self.root, ['a.mp3', 'sub/b.mp3', 'sub/deeper/c.mp3'])
+        self.backend = InotifyBackend(interval=0)
+        self.addCleanup(self.backend.close)
+
+    def test_changes_are_reported(self):
+        self.backend.watch(self.root)
+        self.assertEqual(len(self.backend.watches), 3)
+        make_files(self.root, ['sub/d.mp3'])
+        self.assertEqual(self.backend.wait(1),
+                         {os.path.join(self.root, 'sub')})
+
+    def test_tree_is_polled_when_out_of_watches(self):
+        add_watch = self.backend.add_watch_call
+
+        def limited(fd, path, mask):
+            if len(self.backend.watches) >= 1:
+                ctypes.set_errno(errno.ENOSPC)
+                return -1
+            return add_watch(fd, path, mask)
+        self.backend.add_watch_call = limited
+        with mock.patch('builtins.print') as log:
+            self.backend.watch(self.root)
+            self.backend.watch(os.path.join(self.root, 'sub'))
+        self.assertEqual(log.call_count, 1)
+        self.assertIn(os.strerror(errno.ENOSPC), log.call_args[0][0])
+        self.assertEqual(list(self.backend.polling.roots), [self.root])
+        make_files(self.root, ['sub/deeper/d.mp3'])
+        self.assertIn(os.path.join(self.root, 'sub', 'deeper'),
+                      self.backend.wait(0))
+
+
+class UserCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('viewer', password='secret12',
+                                             email='viewer@example.com')
+
+    def test_user_is_cached_without_its_password(self):
+        with self.assertNumQueries(1):
+            get_user('viewer')
+        self.assertEqual(cache.get(user_key('viewer')),
+                         {'id': self.user.id, 'is_active': True,
+                          'is_superuser': False})
+        with self.assertNumQueries(0):
+            user = get_user('viewer')
+            self.assertEqual((user.id, user.pk, user.username,
+                              user.is_superuser),
+                             (self.user.id, self.user.id, 'viewer', False))
+        self.assertIsNone(get_user('nobody'))
+
+    def test_user_is_loaded_when_needed(self):
+        user = get_user('viewer')
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'viewer@example.com')
+            self.assertTrue(user.check_password('secret12'))
+        self.assertIsInstance(user, User)
+        task = Task.objects.create(kind='test', user=user)
+        self.assertEqual(Task.objects.get(id=task.id).user, self.user)
+
+    def test_saved_user_is_forgotten(self):
+        get_user('viewer')
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertTrue(get_user('viewer').is_superuser)
+
+
+class DeliveryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        make_files(self.root, ['a.mp3'])
+        user = User.objects.create_user('viewer')
+        scan_library(self.root, user, 'all')
+        self.url = '/media-get/{0}'.format(
+            SharedItem.objects.get(name='a.mp3').id)
+        session = self.client.session
+        session['username'] = 'viewer'
+        session.save()
+
+    def test_sendfile_is_an_alias(self):
+        with override_settings(MEDIA_DELIVERY='sendfile'):
+            self.assertEqual(get_backend(), 'file-wrapper')
+        with override_settings(MEDIA_DELIVERY='carrier-pigeon'):
+            self.assertRaises(ValueError, get_backend)
+
+    @override_settings(MEDIA_DELIVERY='file-wrapper')
+    def test_file_wrapper_gets_the_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-12',
+                                   **{'wsgi.file_wrapper': FileStream})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response.file_to_stream.tell(), 3)
+        self.assertEqual(b''.join(response.streaming_content), b'\0' * 10)
+
+    @override_settings(MEDIA_DELIVERY='x-accel-redirect',
+                       MEDIA_ACCEL_LOCATION='/protected/')
+    def test_offload_has_no_length(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected' + os.path.join(self.root, 'a.mp3'))
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+
+def mp3_data(frames=100, xing=None):
+    """
+    MPEG-1 layer III at 128 kbit/s, 44.1 kHz, stereo, with an ID3v2.3 tag.
+    :param xing: Number of frames for a Xing header, if any
+    """
+    tag = b''.join(
+        name + struct.pack('>I', len(text) + 1) + b'\0\0\x03' + text for
+        name, text in ((b'TIT2', b'Song'), (b'TPE1', b'Singer'),
+                       (b'TALB', b'Album'), (b'TYER', b'2014')))
+    frame = struct.pack('>I', 0xFFFB9000) + b'\0' * 413
+    first = bytearray(frame)
+    if xing is not None:
+        first[36:48] = b'Xing' + struct.pack('>II', 1, xing)
+    return b'ID3\x03\0\0' + bytes([0, 0, len(tag) >> 7, len(tag) & 0x7F]) + \
+        tag + bytes(first) + frame * (frames - 1)
+
+
+def box(kind, data, version=None):
+    if version is not None:
+        data = bytes([version, 0, 0, 0]) + data
+    return struct.pack('>I', 8 + len(data)) + kind + data
+
+
+def mp4_data():
+    """
+    125.5 seconds of H.264 at 1920x1080 and 24 frames per second, and
+    stereo AAC at 44.1 kHz, with the movie box after the media data.
+    """
+    def trak(handler, entry, timescale, count):
+        mdhd = box(b'mdhd', struct.pack('>IIII', 0, 0, timescale,
+                                        timescale * 1255 // 10) + b'\0' * 4, 0)
+        hdlr = box(b'hdlr', b'\0' * 4 + handler + b'\0' * 12, 0)
+        stbl = box(b'stbl', box(b'stsd', struct.pack('>I', 1) + entry, 0) +
+                   box(b'stsz', struct.pack('>II', 1000, count), 0))
+        return box(b'trak', box(b'mdia', mdhd + hdlr +
+                                box(b'minf', stbl)))
+
+    video = box(b'avc1', b'\0' * 24 + struct.pack('>HH', 1920, 1080) +
+                b'\0' * 50)
+    audio = box(b'mp4a', b'\0' * 16 + struct.pack('>HH', 2, 16) + b'\0' * 4 +
+                struct.pack('>I', 44100 << 16))
+    tags = box(b'ilst', b''.join(
+        box(kind, box(b'data', struct.pack('>II', 1, 0) + text)) for
+        kind, text in ((b'\xa9nam', b'Movie'), (b'\xa9ART', b'Director'),
+                       (b'\xa9day', b'2011-03-01'))))
+    moov = box(b'moov', box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, 125500) +
+                            b'\0' * 80, 0) +
+               trak(b'vide', video, 25000, 3012) +
+               trak(b'soun', audio, 44100, 5000) +
+               box(b'udta', box(b'meta', box(b'hdlr', b'\0' * 20, 0) + tags,
+                                0)))
+    return box(b'ftyp', b'isom\0\0\0\0') + box(b'mdat', b'\0' * 1000) + moov
+
+
+def element(element_id, data):
+    if isinstance(data, int):
+        data = data.to_bytes(max(1, (data.bit_length() + 7) // 8), 'big')
+    elif isinstance(data, float):
+        data = struct.pack('>d', data)
+    elif isinstance(data, str):
+        data = data.encode()
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + \
+        (len(data) | 1 << 56).to_bytes(8, 'big') + data
+
+
+def matroska_data():
+    """
+    61.5 seconds of VP9 at 1280x720 and Opus, with the tags after the
+    clusters, found through the SeekHead.
+    """
+    info = element(0x1549A966, element(0x2AD7B1, 1000000) +
+                   element(0x4489, 61500.0) + element(0x7BA9, 'Clip'))
+    tracks = element(0x1654AE6B, element(0xAE, element(0x73C5, 11) +
+                     element(0x83, 1) + element(0x86, 'V_VP9') +
+                     element(0x23E383, 40000000) +
+                     element(0xE0, element(0xB0, 1280) +
+                             element(0xBA, 720))) +
+                     element(0xAE, element(0x73C5, 22) + element(0x83, 2) +
+                     element(0x86, 'A_OPUS') +
+                     element(0xE1, element(0xB5, 48000.0) +
+                             element(0x9F, 2))))
+    cluster = element(0x1F43B675, b'\0' * 5000)
+    tags = element(0x1254C367, element(0x7373, element(0x63C0, b'') +
+                   element(0x67C8, element(0x45A3, 'ARTIST') +
+                           element(0x4487, 'Band'))) +
+                   element(0x7373, element(0x63C0, element(0x63C5, 11)) +
+                   element(0x67C8, element(0x45A3, 'BPS') +
+                           element(0x4487, '1500000'))))
+
+    def seek_head(position):
+        return element(0x114D9B74, element(0x4DBB, element(
+            0x53AB, (0x1254C367).to_bytes(4, 'big')) + element(
+            0x53AC, position.to_bytes(8, 'big'))))
+
+    body = info + tracks + cluster
+    body = seek_head(len(seek_head(0)) + len(body)) + body + tags
+    return element(0x1A45DFA3, element(0x4282, 'webm')) + \
+        element(0x18538067, body)
+
+
+def ogg_page(serial, granule, packet, header_type=0):
+    lacing = [255] * (len(packet) // 255) + [len(packet) % 255]
+    return struct.pack('<4sBBqIIIB', b'OggS', 0, header_type, granule, serial,
+                       0, 0, len(lacing)) + bytes(lacing) + packet
+
+
+def vorbis_comments(*comments):
+    return struct.pack('<I', 0) + struct.pack('<I', len(comments)) + b''.join(
+        struct.pack('<I', len(comment)) + comment for comment in comments)
+
+
+def ogg_data():
+    """
+    30 seconds of stereo Vorbis at 44.1 kHz and 160 kbit/s.
+    """
+    return ogg_page(7, 0, b'\x01vorbis' + struct.pack(
+        '<IBIiIiB', 0, 2, 44100, 0, 160000, 0, 0xB8) + b'\x01', 2) + \
+        ogg_page(7, 0, b'\x03vorbis' + vorbis_comments(
+            b'TITLE=Ogg Song', b'ARTIST=X', b'ARTIST=Y', b'DATE=1999')) + \
+        ogg_page(7, 0, b'\0' * 3000) + \
+        ogg_page(7, 44100 * 30, b'\0' * 100, 4)
+
+
+def wav_data():
+    """
+    Half a second of 16 bit stereo PCM at 44.1 kHz, with a title.
+    """
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    info = b'INFO' + b'INAM' + struct.pack('<I', 6) + b'Pluck\0'
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + \
+        b'LIST' + struct.pack('<I', len(info)) + info + \
+        b'data' + struct.pack('<I', 44100 * 2) + b'\0' * 44100 * 2
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+class MetadataTests(SimpleTestCase):
+
+    def parse(self, data):
+        parser = find_parser(data[:12])
+        self.assertIsNotNone(parser)
+        return parser.parse(io.BytesIO(data), len(data))
+
+    def probe(self, data):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            return probe(f.name, use_ffprobe=False)
+
+    def assertMetadata(self, metadata, expected):
+        for key, value in expected.items():
+            if isinstance(value, float):
+                self.assertAlmostEqual(metadata[key], value, 2, key)
+            else:
+                self.assertEqual(metadata[key], value, key)
+
+    def test_mp3(self):
+        self.assertMetadata(self.parse(mp3_data()), {
+            'title': 'Song', 'artist': ['Singer'], 'album': 'Album',
+            'year': 2014, 'audio_codec': 'mp3', 'audio_channels': 2,
+            'audio_sample_rate': 44100, 'audio_bit_rate': 128000,
+            'duration': 41700 * 8 / 128000})
+        self.assertMetadata(self.parse(mp3_data(xing=1000)), {
+            'duration': 1000 * 1152 / 44100})
+
+    def test_mp4(self):
+        self.assertMetadata(self.parse(mp4_data()), {
+            'duration': 125.5, 'title': 'Movie', 'artist': ['Director'],
+            'year': 2011, 'video_codec': 'h264', 'width': 1920,
+            'height': 1080, 'video_frame_rate': 24.0,
+            'video_bit_rate': 3012 * 1000 * 8 / 125.5, 'audio_codec': 'aac',
+            'audio_channels': 2, 'audio_sample_rate': 44100})
+
+    def test_matroska(self):
+        self.assertMetadata(self.parse(matroska_data()), {
+            'duration': 61.5, 'title': 'Clip', 'artist': ['Band'],
+            'video_codec': 'vp9', 'width': 1280, 'height': 720,
+            'video_frame_rate': 25.0, 'video_bit_rate': 1500000,
+            'audio_codec': 'opus', 'audio_channels': 2,
+            'audio_sample_rate': 48000.0})
+
+    def test_ogg(self):
+        self.assertMetadata(self.parse(ogg_data()), {
+            'duration': 30.0, 'title': 'Ogg Song', 'artist': ['X', 'Y'],
+            'year': 1999, 'audio_codec': 'vorbis', 'audio_channels': 2,
+            'audio_sample_rate': 44100, 'audio_bit_rate': 160000})
+
+    def test_wav(self):
+        self.assertMetadata(self.parse(wav_data()), {
+            'duration': 0.5, 'title': 'Pluck', 'audio_codec': 'pcm_s16le',
+            'audio_channels': 2, 'audio_sample_rate': 44100,
+            'audio_bit_rate': 44100 * 32})
+
+    def test_probe_rounds_numbers(self):
+        # Half a second rounds to no duration
+        self.assertEqual(self.probe(wav_data()), {
+            'title': 'Pluck', 'audio_codec': 'pcm_s16le',
+            'audio_channels': 2, 'audio_sample_rate': 44100,
+            'audio_bit_rate': 44100 * 32})
+        self.assertEqual(self.probe(mp4_data())['duration'], 126)
+        self.assertIsNone(self.probe(b'not a media file'))
+
+    def test_truncated_files(self):
+        for data in (mp3_data(), mp4_data(), matroska_data(), ogg_data(),
+                     wav_data()):
+            for length in range(0, len(data), max(1, len(data) // 200)):
+                metadata = self.probe(data[:length])
+                self.assertTrue(metadata is None or
+                                isinstance(metadata, dict))
+        # What is left of the headers is still read
+        self.assertEqual(self.parse(matroska_data()[:-400])['duration'],
+                         61.5)
+        metadata = self.parse(mp4_data()[:-100])
+        self.assertNotIn('title', metadata)
+        self.assertEqual(metadata['video_codec'], 'h264')
+        # Up to the movie box
+        self.assertIsNone(self.parse(mp4_data()[:1024]))
+
+    def test_corrupt_files(self):
+        generator = random.Random(0)
+        for data in (mp3_data(), mp4_data(), matroska_data(), ogg_data(),
+                     wav_data()):
+            for _ in range(100):
+                corrupt = bytearray(data)
+                for _ in range(8):
+                    corrupt[generator.randrange(min(len(data), 2000))] = \
+                        generator.randrange(256)
+                metadata = self.probe(bytes(corrupt))
+                self.assertTrue(metadata is None or
+                                isinstance(metadata, dict))
+        # Boxes and elements claiming impossible sizes
+        self.assertEqual(self.parse(box(b'ftyp', b'isom') +
+                                    struct.pack('>I4s', 4, b'moov')), None)
+        self.assertIsNone(self.parse(b'\x1a\x45\xdf\xa3\x80' + b'\0' * 20))
+        self.assertIsNone(self.parse(b'ID3\x03\0\0\0\0\0\0' + b'\0' * 500))
+        self.assertIsNone(self.parse(wav_data()[:12] + b'data\0\0\0\0'))
+
+
+class ExtractionTests(TestCase):
+
+    def test_extractor_stores_metadata(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'pluck.wav'), 'wb') as f:
+            f.write(wav_data())
+        scan_library(root, User.objects.create_user('user'), 'all')
+        extractor = MetadataExtractor(workers=1, use_ffprobe=False)
+        self.assertEqual(extractor.run(), 1)
+        item = SharedItem.objects.get(name='pluck.wav')
+        self.assertEqual((item.title, item.audio_codec.codec,
+                          item.audio_sample_rate), ('Pluck', 'pcm_s16le',
+                                                    44100))
+        self.assertEqual(pending_items().count(), 0)
+
+
+class ConditionalTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        make_files(self.root, ['a.mp3'])
+        self.user = User.objects.create_user('viewer')
+        scan_library(self.root, self.user, 'all')
+        self.file = SharedItem.objects.get(name='a.mp3')
+        self.directory = SharedItem.objects.get(is_root=True)
+        session = self.client.session
+        session['username'] = 'viewer'
+        session.save()
+
+    def status(self, url, **headers):
+        return self.client.get(url, **headers).status_code
+
+    def test_media_validators(self):
+        url = '/media-get/{0}'.format(self.file.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.status(url, HTTP_IF_NONE_MATCH=etag), 304)
+        self.assertEqual(self.status(
+            url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']), 304)
+        os.utime(self.file.path, (0, 0))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_range(self):
+        url = '/media-get/{0}'.format(self.file.id)
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 0-9/103')
+        # A stale copy gets the whole file
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9',
+                                   HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '103')
+
+    def test_listing_etag(self):
+        url = '/explore/{0}'.format(self.directory.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(self.status(url, HTTP_IF_NONE_MATCH=etag), 304)
+        # New children change the listing
+        make_files(self.root, ['b.mp3'])
+        LibraryScanner(None, 'inherit').sync([self.root])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # And so do changes of access
+        set_grant(self.file.id, self.user.id, False)
+        bump_generation(access.GENERATION)
+        self.assertEqual(self.status(url, HTTP_IF_NONE_MATCH=response['ETag']),
+                         200)
+
+
+class ListingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        make_files(self.root, ['a.mp3', 'b.mp3'])
+        self.users = [User.objects.create_user(name) for name in
+                      ('first', 'second', 'third')]
+        scan_library(self.root, self.users[0], 'all')
+        self.directory = SharedItem.objects.get(is_root=True)
+        render = mock.patch.object(listings, 'render_items',
+                                   wraps=listings.render_items)
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    def listing(self, user):
+        self.directory.refresh_from_db()
+        return explore_listing(user, self.directory)
+
+    def test_rendered_once(self):
+        html = self.listing(self.users[0])
+        self.assertIn('a.mp3', html)
+        self.assertEqual(self.listing(self.users[0]), html)
+        # Users without grants of their own share the listing
+        self.assertEqual(self.listing(self.users[1]), html)
+        self.assertEqual(self.render.call_count, 1)
+        self.assertIn(self.directory.name, explore_listing(self.users[0]))
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_new_children(self):
+        self.listing(self.users[0])
+        make_files(self.root, ['c.mp3'])
+        LibraryScanner(None, 'inherit').sync([self.root])
+        self.assertIn('c.mp3', self.listing(self.users[0]))
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_access_changes(self):
+        html = self.listing(self.users[0])
+        set_grant(SharedItem.objects.get(name='a.mp3').id, self.users[1].id,
+                  False)
+        bump_generation(access.GENERATION)
+        self.assertNotIn('a.mp3', self.listing(self.users[1]))
+        self.assertEqual(self.listing(self.users[0]), html)
+        self.assertEqual(self.listing(self.users[2]), html)
+        self.assertEqual(self.render.call_count, 3)
+
+    def test_manage_listing(self):
+        items = self.directory.children.all()
+        self.assertIn('/shared-items/', manage_listing(items, self.directory))
+        manage_listing(items, self.directory)
+        self.assertEqual(self.render.call_count, 1)
+        SharedItem.objects.filter(name='b.mp3').update(name='renamed.mp3')
+        touch_listing(SharedItem.objects.get(name='renamed.mp3'))
+        self.directory.refresh_from_db()
+        self.assertIn('renamed.mp3', manage_listing(items, self.directory))
+        self.assertEqual(self.render.call_count, 2)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.tracks = ['track{0:02}.mp3'.format(i) for i in range(9)]
+        make_files(self.root, self.tracks + ['rain.mp3', 'rain/other.mp3'])
+        self.user = User.objects.create_user('user')
+        scan_library(self.root, self.user, 'all')
+        for name in ('track03.mp3', 'track04.mp3'):
+            set_grant(SharedItem.objects.get(name=name).id, self.user.id,
+                      False)
+        bump_generation(access.GENERATION)
+
+    def pages(self, query, limit):
+        pages = []
+        start = 0
+        while start is not None:
+            items, start = search.search(self.user, query, start, limit)
+            pages.append([item.name for item in items])
+        return pages
+
+    def test_ranking(self):
+        self.assertTrue(search.fts_available())
+        names = [item.name for item in search.search(self.user, 'RAI')[0]]
+        self.assertEqual(sorted(names), ['other.mp3', 'rain', 'rain.mp3'])
+        # Matches in the path only come last
+        self.assertEqual(names[-1], 'other.mp3')
+        self.assertEqual(search.search(self.user, 'rain other')[0][0].name,
+                         'other.mp3')
+        self.assertEqual(search.search(self.user, ' .. '), ([], None))
+
+    def test_pages(self):
+        visible = [name for name in self.tracks if
+                   name not in ('track03.mp3', 'track04.mp3')]
+        with mock.patch.object(search, 'BATCH_SIZE', 2):
+            pages = self.pages('track', 2)
+            self.assertEqual(sorted(sum(pages, [])), visible)
+            self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+            with mock.patch.object(search, 'fts_available',
+                                   return_value=False):
+                self.assertEqual(self.pages('TRACK', 3),
+                                 [visible[0:3], visible[3:6], visible[6:]])
+
+    def test_index_follows_changes(self):
+        item = SharedItem.objects.get(name='track00.mp3')
+        SharedItem.objects.filter(id=item.id).update(title='Nocturne')
+        search.index_items([item.id])
+        self.assertEqual(search.search(self.user, 'noct')[0], [item])
+        delete_items([item.id])
+        self.assertEqual(search.search(self.user, 'noct')[0], [])
+
+
+class ThumbnailTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache = ThumbnailCache(os.path.join(self.root, 'thumbs'), 3000)
+        self.renders = []
+
+    def item(self, name, media_type='image'):
+        return mock.Mock(path=os.path.join(self.root, name), mtime=1,
+                         duration=None,
+                         **{'media_type.return_value': media_type})
+
+    def render(self, item, target, box):
+        self.renders.append(item.path)
+        with open(target, 'wb') as f:
+            f.write(b'\0' * 1000)
+        return True
+
+    @skipUnless(thumbnails.Image is not None, 'Pillow is not installed')
+    def test_image_is_scaled_once(self):
+        item = self.item('picture.png')
+        thumbnails.Image.new('RGB', (800, 600)).save(item.path)
+        path = self.cache.get(item, 'small')
+        with thumbnails.Image.open(path) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (160, 120)))
+        with mock.patch('web.thumbnails.render') as render:
+            self.assertEqual(self.cache.get(item, 'small'), path)
+        render.assert_not_called()
+
+    def test_least_recently_used_are_evicted(self):
+        with mock.patch('web.thumbnails.render', self.render):
+            paths = {name: self.cache.get(self.item(name), 'small') for
+                     name in 'abc'}
+            for when, name in enumerate('abc'):
+                os.utime(paths[name], (when, 0))
+            # Reading a makes it the most recently used
+            self.cache.get(self.item('a'), 'small')
+            paths['d'] = self.cache.get(self.item('d'), 'small')
+        self.assertEqual({path for _, _, path in self.cache.entries()},
+                         {paths['a'], paths['d']})
+        self.assertEqual(self.cache.total, 2000)
+        self.assertEqual(self.renders, [self.item(name).path for name in
+                                        'abcd'])
+
+    def test_failures_are_not_retried(self):
+        with mock.patch('web.thumbnails.render',
+                        return_value=False) as render, \
+                mock.patch('web.thumbnails.MAX_FAILED', 2):
+            for name in ('a', 'a', 'b', 'b'):
+                self.assertIsNone(self.cache.get(self.item(name), 'small'))
+            self.assertEqual(render.call_count, 2)
+            # The failed set is cleared once it is full
+            self.cache.get(self.item('c'), 'small')
+            self.assertEqual(len(self.cache.failed), 1)
+            self.cache.get(self.item('a'), 'small')
+            self.assertEqual(render.call_count, 4)
+
+    def test_concurrent_requests_render_once(self):
+        def slow_render(item, target, box):
+            time.sleep(0.1)
+            return self.render(item, target, box)
+
+        with mock.patch('web.thumbnails.render', slow_render):
+            threads = [threading.Thread(target=self.cache.get,
+                                        args=(self.item('a'), 'large')) for
+                       _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.renders), 1)
+        self.assertEqual(self.cache.key_locks, {})
+
+
+class TaskTests(TransactionTestCase):
+
+    def test_result_and_progress(self):
+        def work(first, second, progress):
+            progress(5, 10)
+            return first, second
+
+        task = finished(tasks.submit('test', 'Work', work, 3, 4,
+                                     message='{0} of {1}', key='work'))
+        self.assertEqual((task.state, task.result, task.done, task.total,
+                          task.active_key), (DONE, '3 of 4', 5, 10, None))
+        self.assertIsNotNone(task.time_finished)
+
+    def test_failure(self):
+        def work(progress):
+            raise ValueError('No luck')
+
+        task = finished(tasks.submit('test', 'Work', work, key='work'))
+        self.assertEqual((task.state, task.active_key), (FAILED, None))
+        self.assertIn('No luck', task.result)
+
+    def test_reap_orphans(self):
+        stale = timezone.now() - timedelta(seconds=tasks.HEARTBEAT_TIMEOUT + 1)
+        orphan = Task.objects.create(kind='test', state=tasks.RUNNING,
+                                     key='work', active_key='work',
+                                     time_heartbeat=stale)
+        alive = Task.objects.create(kind='test', state=tasks.RUNNING)
+        self.assertEqual(tasks.reap_orphans(), 1)
+        orphan.refresh_from_db()
+        self.assertEqual((orphan.state, orphan.result, orphan.active_key),
+                         (FAILED, tasks.INTERRUPTED, None))
+        alive.refresh_from_db()
+        self.assertEqual(alive.state, tasks.RUNNING)
+        # The key of the orphan can be queued again
+        task = tasks.submit('test', 'Work', lambda progress: None, key='work')
+        self.assertNotEqual(task.id, orphan.id)
+        self.assertEqual(finished(task).state, DONE)
+
+
+def tile(video_id, title):
+    """
+    :return: Markup of a video on a YouTube results page
+    """
+    return ('<div class="yt-lockup-tile"><h3 class="yt-lockup-title">'
+            '<a href="/watch?v={0}" title="{1}">{1}</a></h3>'
+            '<span class="video-time">3:05</span>'
+            '<div class="yt-lockup-byline"><a href="/user/u">Someone</a>'
+            '</div><ul class="yt-lockup-meta-info"><li>2 years ago</li>'
+            '<li>1,234 views</li></ul>'
+            '<div class="yt-lockup-description">About {1}</div></div>'
+            ).format(video_id, title)
+
+
+class YouTubeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.page = '<html>{0}<div class="yt-lockup-tile">Ad</div>{1}' \
+            '</html>'.format(tile('abcdefghijk', 'First'),
+                             tile('bcdefghijkl', 'Second'))
+        self.session = mock.Mock()
+        self.session.get.return_value.text = self.page
+
+    def test_parse(self):
+        results = parse_results(self.page)
+        self.assertEqual([result['id'] for result in results],
+                         ['abcdefghijk', 'bcdefghijkl'])
+        self.assertEqual(results[0], {
+            'id': 'abcdefghijk', 'title': 'First', 'length': '3:05',
+            'uploader': 'Someone', 'time': '2 years ago', 'views': '1,234',
+            'thumb': 'http://img.youtube.com/vi/abcdefghijk/0.jpg',
+            'description': 'About First'})
+        self.assertEqual(parse_results('<html></html>'), [])
+
+    def test_cached_by_normalized_query(self):
+        client = YouTubeClient(self.session)
+        results = client.search('Some  Song')
+        self.assertEqual(len(results), 2)
+        results[0]['title'] = 'Changed'
+        self.assertEqual(client.search(' some song')[0]['title'], 'First')
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(self.session.get.call_args[1]['params'],
+                         {'search_query': 'some song'})
+        client.search('other song')
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_expiry_and_eviction(self):
+        client = YouTubeClient(self.session, cache_timeout=-1)
+        client.search('song')
+        client.search('song')
+        self.assertEqual(self.session.get.call_count, 2)
+        client = YouTubeClient(self.session, max_cached=2)
+        for query in ('first', 'second', 'first', 'third', 'first',
+                      'second'):
+            client.search(query)
+        # 'second' was the least recently used when 'third' came in
+        self.assertEqual(self.session.get.call_count, 2 + 4)
+        self.assertEqual(list(client.cache), ['first', 'second'])
+
+    def test_errors_are_not_cached(self):
+        self.session.get.return_value.raise_for_status.side_effect = \
+            HTTPError('503')
+        client = YouTubeClient(self.session)
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                client.search('song')
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_pooled_session(self):
+        client = YouTubeClient()
+        adapter = client.session.get_adapter('https://www.youtube.com/')
+        self.assertEqual(adapter._pool_maxsize, POOL_SIZE)
@@ -0,0 +1,272 @@
+"""
+Thumbnails of images and videos at a few fixed sizes.
+
+A thumbnail is generated on its first request - with Pillow for images and
+by grabbing a frame with ffmpeg for videos (and for images when Pillow is
+not installed) - and kept in a directory on disk. Concurrent requests for
+the same thumbnail wait for one generation. The directory is held under a
+byte budget by evicting the least recently used thumbnails; a hit refreshes
+the access time of the file, which the eviction goes by. The modification
+time is left alone as it is part of the ETag.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Errors of Pillow on images it cannot or will not read. Images past twice
+# its pixel limit raise DecompressionBombError, which older versions lack.
+IMAGE_ERRORS = (OSError, ValueError, MemoryError) + (
+    (Image.DecompressionBombError,)
+    if hasattr(Image, 'DecompressionBombError') else ())
+
+# Names of the sizes mapped to the box the thumbnail has to fit in
+SIZES = {
+    'small': 160,
+    'medium': 320,
+    'large': 640,
+}
+QUALITY = 80
+FFMPEG_TIMEOUT = 30
+# Fraction of the budget the cache is brought down to by an eviction
+LOW_WATER_MARK = 0.9
+# Keys of thumbnails that could not be made, remembered to not retry them
+MAX_FAILED = 10000
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def thumbnail_key(item, size):
+    """
+    Cache key of a thumbnail. It covers the modification time of the file
+    so a changed file gets a new thumbnail, the old one aging out.
+    """
+    source = '{0}\0{1}\0{2}'.format(item.path, item.mtime, size)
+    return hashlib.sha1(source.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def render_image(source, target, box):
+    """
+    Scale the image at `source` down to fit `box` and save it as JPEG at
+    `target` using Pillow.
+    :return: True if the thumbnail was written
+    """
+    if Image is None:
+        return False
+    try:
+        with Image.open(source) as image:
+            # Let the JPEG decoder skip detail that is thrown away anyway
+            image.draft('RGB', (box, box))
+            image.thumbnail((box, box))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(target, 'JPEG', quality=QUALITY)
+    except IMAGE_ERRORS:
+        return False
+    return True
+
+
+def render_frame(source, target, box, position=0):
+    """
+    Grab the frame at `position` seconds of the video (or the image) at
+    `source`, scaled to fit `box`, as JPEG at `target` using ffmpeg.
+    :return: True if the thumbnail was written
+    """
+    executable = shutil.which('ffmpeg')
+    if executable is None:
+        return False
+    command = [executable, '-v', 'quiet', '-y']
+    if position:
+        command += ['-ss', str(position)]
+    command += ['-i', source, '-frames:v', '1', '-vf',
+                'scale={0}:{0}:force_original_aspect_ratio=decrease'.format(
+                    box), '-f', 'image2', '-c:v', 'mjpeg', '-q:v', '4',
+                target]
+    try:
+        subprocess.run(command, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=FFMPEG_TIMEOUT, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return os.path.getsize(target) > 0
+
+
+def render(item, target, box):
+    media_t = item.media_type()
+    if media_t == 'image':
+        return render_image(item.path, target, box) or \
+            render_frame(item.path, target, box)
+    if media_t == 'video':
+        # A frame a little into the video is more telling than the first,
+        # which is often black.
+        position = min(item.duration / 10, 30) if item.duration else 0
+        return render_frame(item.path, target, box, position) or \
+            (position > 0 and render_frame(item.path, target, box))
+    return False
+
+
+class ThumbnailCache(object):
+    """
+    Directory of thumbnails with a byte budget and LRU eviction.
+    """
+
+    def __init__(self, root, max_bytes):
+        """
+        :param root: Directory the thumbnails are kept in
+        :param max_bytes: Budget of the total size of the thumbnails
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total = None
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.failed = set()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.jpg')
+
+    @staticmethod
+    def touch(path):
+        """
+        Mark the thumbnail at `path` as recently used.
+        :return: False if there is no such thumbnail
+        """
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(int(time.time() * 1e9), stat.st_mtime_ns))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextmanager
+    def key_lock(self, key):
+        """
+        Hold the lock of a single thumbnail, so that it is generated once
+        however many requests ask for it at the same time.
+        """
+        with self.lock:
+            entry = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.key_locks[key]
+
+    def get(self, item, size):
+        """
+        Path of the thumbnail of `item`, generating it if needed.
+        :param item: SharedItem of an image or a video
+        :param size: One of the names in SIZES
+        :return: Path of the JPEG file, or None if no thumbnail can be made
+        """
+        key = thumbnail_key(item, size)
+        path = self.path(key)
+        if self.touch(path):
+            return path
+        if key in self.failed:
+            return None
+        with self.key_lock(key):
+            if self.touch(path):
+                return path
+            if not self.generate(item, SIZES[size], path):
+                if len(self.failed) >= MAX_FAILED:
+                    self.failed.clear()
+                self.failed.add(key)
+                return None
+        self.added(os.path.getsize(path))
+        return path
+
+    def generate(self, item, box, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        os.close(fd)
+        try:
+            if not render(item, temporary, box):
+                return False
+            os.replace(temporary, path)
+            return True
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def entries(self):
+        """
+        :return: List of (last use, size, path) of the cached thumbnails
+        """
+        found = []
+        if not os.path.isdir(self.root):
+            return found
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.name.endswith('.jpg'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_atime, stat.st_size, entry.path))
+        return found
+
+    def added(self, size):
+        """
+        Account for a new thumbnail of `size` bytes and evict the least
+        recently used ones if the budget is exceeded.
+        """
+        with self.lock:
+            if self.total is None:
+                self.total = sum(size for _, size, _ in self.entries())
+            else:
+                self.total += size
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used thumbnails until the cache is under
+        LOW_WATER_MARK of its budget. The directory is listed again since
+        other processes share it.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * LOW_WATER_MARK
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        print('Evicted {0} thumbnails, {1} bytes cached'.format(removed,
+                                                                total))
+        self.total = total
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ThumbnailCache(settings.THUMBNAIL_ROOT,
+                                    settings.THUMBNAIL_CACHE_SIZE)
+        return _cache
@@ -0,0 +1,208 @@
+"""
+Materialized path index of the tree of shared items.
+
+Besides the links of the SharedItem.children relation, every item stores in
+`tree_path` the ids of the items from its root down to itself, as in
+'/4/17/230/', and in `depth` how far below its root it is (0 for root
+items). The items of a subtree are those whose tree_path starts with the
+one of its top, and the ancestors of an item are read off its own
+tree_path, so either takes a single query.
+
+The scanner keeps the index up to date as it adds and moves items, and the
+rebuild_tree command fills it from the links.
+"""
+from django.db.models import F, TextField, Value
+from django.db.models.functions import Cast, Concat, Substr
+from django.db.transaction import atomic
+
+from .models import SharedItem, prefixed
+
+SEPARATOR = '/'
+CHUNK_SIZE = 500
+
+
+def chunks(sequence, size=CHUNK_SIZE):
+    sequence = list(sequence)
+    for i in range(0, len(sequence), size):
+        yield sequence[i:i + size]
+
+
+def item_path(parent_path, item_id):
+    """
+    :param parent_path: tree_path of the parent, or None for a root item
+    :return: tree_path of the item
+    """
+    return '{0}{1}{2}'.format(parent_path or SEPARATOR, item_id, SEPARATOR)
+
+
+def path_ids(tree_path):
+    """
+    :return: List of ids of the items on `tree_path`, from the root down
+    """
+    return [int(part) for part in tree_path.split(SEPARATOR) if part]
+
+
+def checked_path(item):
+    if not item.tree_path:
+        raise ValueError('{0} is not in the tree index, run manage.py '
+                         'rebuild_tree'.format(item))
+    return item.tree_path
+
+
+def subtree(item):
+    """
+    :return: QuerySet of `item` and everything below it
+    """
+    return SharedItem.objects.filter(
+        prefixed('tree_path', checked_path(item)))
+
+
+def descendant_ids(item):
+    """
+    :return: List of ids of all items below `item`
+    """
+    return list(subtree(item).exclude(id=item.id).values_list('id',
+                                                              flat=True))
+
+
+def ancestor_ids(item):
+    """
+    :return: List of ids of the items above `item`, from its root down to
+    its parent
+    """
+    return path_ids(checked_path(item))[:-1]
+
+
+def ancestors(item):
+    """
+    :return: List of the items above `item`, from its root down to its
+    parent
+    """
+    ids = ancestor_ids(item)
+    found = SharedItem.objects.in_bulk(ids)
+    return [found[item_id] for item_id in ids if item_id in found]
+
+
+def breadcrumbs(item):
+    """
+    :return: List of the items from the root of `item` down to `item`
+    """
+    return ancestors(item) + [item]
+
+
+def root_id(item):
+    return path_ids(checked_path(item))[0]
+
+
+def lineages(item_ids):
+    """
+    :return: Dict of item id to the list of ids of the items from its root
+    down to it, for those of `item_ids` that exist
+    """
+    found = {}
+    for chunk in chunks(item_ids):
+        for item_id, tree_path in SharedItem.objects.filter(
+                id__in=chunk).values_list('id', 'tree_path'):
+            found[item_id] = path_ids(tree_path) or [item_id]
+    return found
+
+
+def place(item_ids, parent_path, depth):
+    """
+    Set the tree_path and depth of items directly below the same parent,
+    with one UPDATE per chunk of ids.
+    :param parent_path: tree_path of the parent, or None for root items
+    """
+    for chunk in chunks(item_ids):
+        SharedItem.objects.filter(id__in=chunk).update(
+            tree_path=Concat(Value(parent_path or SEPARATOR),
+                             Cast('id', TextField()), Value(SEPARATOR)),
+            depth=depth)
+
+
+def index(tops, links):
+    """
+    Index newly added items.
+    :param tops: Ids of new items without a parent
+    :param links: List of (parent id, item id) of the other new items,
+    parents before their children. Parents may be new or already indexed.
+    """
+    place(tops, None, 0)
+    paths = {item_id: (item_path(None, item_id), 0) for item_id in tops}
+    new = set(item_id for _, item_id in links)
+    known = set(parent_id for parent_id, _ in links if parent_id not in new)
+    for chunk in chunks(known):
+        paths.update((item_id, (tree_path, depth)) for
+                     item_id, tree_path, depth in SharedItem.objects.filter(
+                         id__in=chunk).values_list('id', 'tree_path', 'depth'))
+    children = {}
+    for parent_id, item_id in links:
+        children.setdefault(parent_id, []).append(item_id)
+    # New items below new parents are placed along with their parents
+    for parent_id in list(known) + list(tops):
+        if parent_id in children:
+            place_below(parent_id, children[parent_id], children, paths)
+
+
+def place_below(parent_id, item_ids, children, paths):
+    parent_path, parent_depth = paths[parent_id]
+    place(item_ids, parent_path, parent_depth + 1)
+    for item_id in item_ids:
+        paths[item_id] = (item_path(parent_path, item_id), parent_depth + 1)
+        if item_id in children:
+            place_below(item_id, children[item_id], children, paths)
+
+
+def move(item_id, parent_id):
+    """
+    Move the subtree of an item below another item in the index, once the
+    links are changed.
+    :param parent_id: Id of the new parent, or None to make it a root item
+    """
+    item = SharedItem.objects.get(id=item_id)
+    old_path, old_depth = checked_path(item), item.depth
+    if parent_id is None:
+        path, depth = item_path(None, item_id), 0
+    else:
+        parent_path, parent_depth = SharedItem.objects.filter(
+            id=parent_id).values_list('tree_path', 'depth')[0]
+        path, depth = item_path(parent_path, item_id), parent_depth + 1
+    SharedItem.objects.filter(prefixed('tree_path', old_path)).update(
+        tree_path=Concat(Value(path), Substr('tree_path', len(old_path) + 1)),
+        depth=F('depth') + (depth - old_depth))
+
+
+def rebuild():
+    """
+    Fill the index of all items from the links, a level of the tree at a
+    time.
+    :return: Number of items indexed
+    """
+    through = SharedItem.children.through
+    children = {}
+    for parent_id, item_id in through.objects.values_list(
+            'from_shareditem_id', 'to_shareditem_id'):
+        children.setdefault(parent_id, []).append(item_id)
+    below = set(item_id for item_ids in children.values() for item_id in
+                item_ids)
+    tops = [item_id for item_id in SharedItem.objects.values_list(
+        'id', flat=True) if item_id not in below]
+    seen = set(tops)
+    count = 0
+    with atomic():
+        place(tops, None, 0)
+        level = [(item_id, item_path(None, item_id)) for item_id in tops]
+        depth = 0
+        while level:
+            count += len(level)
+            depth += 1
+            next_level = []
+            for parent_id, parent_path in level:
+                item_ids = [item_id for item_id in children.get(parent_id, ())
+                            if item_id not in seen]
+                seen.update(item_ids)
+                place(item_ids, parent_path, depth)
+                next_level.extend((item_id, item_path(parent_path, item_id))
+                                  for item_id in item_ids)
+            level = next_level
+    return count
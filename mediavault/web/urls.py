@@ -16,8 +16,11 @@ urlpatterns = [
     url(r'^media/?$', views.media, name='media'),
     url(r'^media/(?P<id>[0-9]+)/?$', views.media_page, name='media-page'),
     url(r'^media-get/(?P<id>[0-9]+)/?$', views.media_get, name='media-get'),
+    url(r'^thumb/(?P<id>[0-9]+)/(?P<size>small|medium|large)/?$',
+        views.thumbnail, name='thumbnail'),
     url(r'^explore/?$', views.explore_root, name='explore-root'),
     url(r'^explore/(?P<id>[0-9]+)/?$', views.explore, name='explore'),
+    url(r'^search/?$', views.library_search, name='search'),
     url(r'^master/user/?$', views.master_user, name='master-user'),
     url(r'^master/user/add/?$', views.master_user_add, name='master-user-add'),
     url(r'^master/user/modify/?$', views.master_user_modify,
@@ -1,29 +1,50 @@
 """
 Views for 'web' app
 """
+import mimetypes
 import traceback
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.messages import SUCCESS, add_message, get_messages
+from django.core.exceptions import SuspiciousFileOperation
+from django.db.models import Sum
 from django.http import HttpResponse
 from django.shortcuts import redirect, render
+from django.utils._os import safe_join
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from requests import RequestException
 from rest_framework.authtoken.models import Token
 
 from . import youtube_search, download_video, download_audio
+from .access import users_by_access
+from .counters import count_view, get_counter
+from .delivery import deliver_file
+from .downloads import user_downloads
+from .extraction import extract_in_background
 from .forms import LoginForm
+from .listings import explore_listing, manage_listing
 from .models import get_suggested_items, \
-    add_item_recursive, remove_item_recursive, SharedItem, \
-    grant_permission_recursive, remove_permission_recursive, ItemAccessibility, \
-    get_root_items, Suggestion, ItemRating, get_latest_items
+    remove_item_recursive, SharedItem, \
+    grant_permission_recursive, remove_permission_recursive, \
+    get_root_items, Suggestion, ItemRating, get_latest_items, listing_version, \
+    rate_item, remove_ratings, get_generation
+from .scanner import scan_library
+from .search import search
+from .tasks import item_tasks, submit, PENDING, RUNNING
+from .thumbnails import get_cache
+from .tree import breadcrumbs, descendant_ids, path_ids
 
 
 def home(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     # item_tree = get_root_items_recursive(user)
     suggested_items = get_suggested_items(user)
     latest_items = get_latest_items(user)
@@ -72,14 +93,15 @@ def shared_items(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     errors = []
     messages = []
     if not user.is_superuser:
         return redirect('/')
+    # Left by views redirecting here, such as the removal of an item
+    messages.extend(message.message for message in get_messages(request))
     if request.POST.get('add', None):
         print('Requested to add items')
         location = request.POST.get('location')
@@ -92,7 +114,8 @@ def shared_items(request):
         if permission not in ('all', 'admin', 'self'):
             permission = 'all'
         try:
-            item_count = add_item_recursive(location, user, permission)
+            item_count = scan_library(location, user, permission)
+            extract_in_background()
             messages.append('Successfully added {0} items'.format(item_count))
         except Exception:
             errors.append('Problem adding item(s)')
@@ -107,21 +130,47 @@ def shared_items(request):
             'number_of_mesages': len(messages),
             'errors': errors,
             'messages': messages,
-            'items': get_root_items(user),
+            'listing': manage_listing(get_root_items(user)),
             'user': user,
             'title': 'Manage Shared Items | Root'
         }
     )
 
 
+def change_access(item, user, allow, by):
+    """
+    Give or take away access of `user` to `item` and everything below it,
+    in a background task if there are more than SUBTREE_TASK_THRESHOLD
+    items.
+    :param by: User making the change
+    :return: Message describing the change
+    """
+    below = descendant_ids(item)
+    if allow:
+        function = grant_permission_recursive
+        args = (item, user, False, below)
+        verb = 'granted to'
+    else:
+        function = remove_permission_recursive
+        args = (item, user, below)
+        verb = 'removed from'
+    message = 'Access {0} {1} on {{0}} items, {{1}} grants changed'.format(
+        verb, user)
+    if len(below) < settings.SUBTREE_TASK_THRESHOLD:
+        return message.format(*function(*args))
+    submit('access', 'Access {0} {1}'.format(verb, user), function, *args,
+           item=item, user=by, message=message)
+    return 'Changing access of {0} to {1} items in the background'.format(
+        user, len(below) + 1)
+
+
 def single_shared_item(request, id):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     if not user.is_superuser:
         return redirect('/')
     errors = []
@@ -133,33 +182,34 @@ def single_shared_item(request, id):
     item = item[0]
     if request.POST.get('remove', None):
         print("Request to remove items")
-        item_count = remove_item_recursive(item)
-        messages.append('Successfully deleted {0} items'.format(item_count))
+        counts = remove_item_recursive(item)
+        items = counts.pop('web.SharedItem', 0)
+        message = 'Successfully deleted {0} items'.format(items)
+        # Links of many to many relations are left out
+        related = ['{0} {1}'.format(count, label.split('.')[-1]) for
+                   label, count in sorted(counts.items()) if
+                   count and '_' not in label]
+        if related:
+            message += ' ({0})'.format(', '.join(related))
+        add_message(request, SUCCESS, message)
         return redirect('/shared-items/')
     if request.POST.get('add-permission', None):
         user_id = int(request.POST.get('user_add_id'))
         print("Request to add permission -- {0} -- {1}".format(id, user_id))
         _user = User.objects.filter(id=user_id)
         if len(_user) == 1:
-            grant_permission_recursive(item, _user, False)
-            messages.append('Access granted to {0}'.format(_user))
+            messages.append(change_access(item, _user[0], True, user))
         else:
             errors.append('No such user found')
     if request.POST.get('remove-permission', None):
         user_id = int(request.POST.get('user_remove_id'))
         _user = User.objects.filter(id=user_id)
         if len(_user) == 1:
-            remove_permission_recursive(item, _user)
-            messages.append('Access removed from {0}'.format(_user))
+            messages.append(change_access(item, _user[0], False, user))
         else:
             errors.append('No such user found')
-    allowed_users = [inst.user for inst in
-                     ItemAccessibility.objects.filter(item=item,
-                                                      accessible=True)]
-    other_users = [inst.user for inst in
-                   ItemAccessibility.objects.filter(item=item,
-                                                    accessible=False)]
-    children = item.children.all()
+    allowed_users, other_users = users_by_access(item)
+    tasks = item_tasks(item)
     return render(request, 'single_item.html', {
         'number_of_errors': len(errors),
         'number_of_messages': len(messages),
@@ -168,7 +218,10 @@ def single_shared_item(request, id):
         'allowed_users': allowed_users,
         'other_users': other_users,
         'item': item,
-        'children': children,
+        'children': manage_listing(item.children.all(), item),
+        'tasks': tasks,
+        'tasks_running': any(task.state in (PENDING, RUNNING) for task in
+                             tasks),
         'title': 'Manage Shared Items | {0}'.format(item.name)
     })
 
@@ -177,10 +230,9 @@ def media_page(request, id):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     item = SharedItem.objects.filter(id=id)
     if len(item) == 0:
         return render(request, 'notfound.html', {
@@ -214,34 +266,21 @@ def media_page(request, id):
                     rating = 10
                 elif rating < 0:
                     rating = 0
-                rating_instance = ItemRating.objects.filter(item=item,
-                                                            user=user)
-                if len(rating_instance) == 0:
-                    rating_instance = ItemRating(item=item, user=user,
-                                                 rating=rating)
-                else:
-                    rating_instance = rating_instance[0]
-                    rating_instance.rating = rating
-                rating_instance.save()
+                rate_item(item, user, rating)
         except Exception:
             traceback.print_exc()
         increment = False
     if media_type == 'directory':
         return redirect('/explore/{0}'.format(id))
-    ratings = [rating_instance.rating for rating_instance in
-               ItemRating.objects.filter(item=item)]
-    number_of_ratings = len(ratings)
-    if number_of_ratings > 0:
-        average_rating = sum(ratings) / number_of_ratings
+    number_of_ratings = item.rating_count
+    average_rating = item.average_rating()
+    if average_rating is not None:
         average_rating = '%.1f' % round(average_rating, 1)
-    else:
-        average_rating = None
-    allowed_users = [acc.user for acc in
-                     ItemAccessibility.objects.filter(item=item,
-                                                      accessible=True)]
+    allowed_users = users_by_access(item)[0]
     if increment:
-        item.views += 1
-        item.save()
+        count_view(item, user)
+    # Views not written yet are shown already
+    item.views += get_counter().pending(item.id)
     return render(request, 'media.html',
                   {'type': media_type, 'item': item, 'users': allowed_users,
                    'number_of_ratings': number_of_ratings, 'user': user,
@@ -252,10 +291,9 @@ def media_get(request, id):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     item = SharedItem.objects.filter(id=id)
     if len(item) == 0:
         return HttpResponse('', status=404)
@@ -266,37 +304,104 @@ def media_get(request, id):
     if not item.exists():
         remove_item_recursive(item)
         return HttpResponse('', status=404)
-    f = open(item.path, 'rb')
-    response = HttpResponse(f)
+    if item.type.type == 'Directory':
+        return HttpResponse('', status=404)
+    response = deliver_file(request, item.path, item.type.type)
     response['Content-Description'] = 'attachment; filename=%s' % item.name
-    response['Content-Type'] = item.type.type
-    f = open(item.path, 'rb')
-    response['Content-Length'] = str(len(f.read()))
     return response
 
 
+def thumbnail(request, id, size):
+    username = request.session.get('username', None)
+    if not username:
+        return redirect('/login?err=Login required')
+    user = request.vault_user
+    if user is None:
+        return redirect('/login?err=No such user')
+    item = SharedItem.objects.filter(id=id)
+    if len(item) == 0:
+        return HttpResponse('', status=404)
+    else:
+        item = item[0]
+        if not item.accessible(user):
+            return HttpResponse('', status=503)
+    path = get_cache().get(item, size)
+    if path is None:
+        return HttpResponse('', status=404)
+    try:
+        return deliver_file(request, path, 'image/jpeg',
+                            max_age=settings.THUMBNAIL_MAX_AGE)
+    except FileNotFoundError:
+        # Evicted by another process in the meantime
+        return HttpResponse('', status=404)
+
+
+def static_file(request, path):
+    """
+    Send a file collected into STATIC_ROOT, when no web server in front of
+    the application does.
+    """
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+        return deliver_file(request, full_path,
+                            mimetypes.guess_type(full_path)[0] or
+                            'application/octet-stream',
+                            max_age=settings.STATIC_MAX_AGE)
+    except (ValueError, SuspiciousFileOperation, FileNotFoundError,
+            IsADirectoryError):
+        return HttpResponse('', status=404)
+
+
+def explore_etag(request, id=None):
+    """
+    Weak ETag of an explore page, tied to the version of the directory
+    listing, to the versions of the directories above it shown in the
+    breadcrumbs, to the access of users and to the user viewing it. View
+    counts shown in the listing do not change it.
+    """
+    username = request.session.get('username', None)
+    if not username:
+        return None
+    if request.vault_user is None:
+        return None
+    version = listing_version(id)
+    if version is None:
+        return None
+    if id is not None:
+        tree_path = SharedItem.objects.filter(id=id).values_list('tree_path',
+                                                                 flat=True)
+        ancestors = path_ids(tree_path[0])[:-1] if len(tree_path) == 1 else []
+        if ancestors:
+            version += '.{0}'.format(SharedItem.objects.filter(
+                id__in=ancestors).aggregate(version=Sum('version'))[
+                'version'])
+    return 'W/"{0}.{1}.{2}"'.format(version, get_generation('acl'),
+                                    request.vault_user.id)
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=explore_etag)
 def explore_root(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
-    items = get_root_items(user)
-    return render(request, 'explore.html', {'items': items, 'user': user,
-                                            'title': 'Explore'})
+    return render(request, 'explore.html', {'listing': explore_listing(user),
+                                            'user': user, 'title': 'Explore'})
 
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=explore_etag)
 def explore(request, id):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
-    item = SharedItem.objects.filter(id=id)
+    item = SharedItem.objects.filter(id=id).select_related('type')
     if len(item) == 0:
         return HttpResponse('', status=404)
     else:
@@ -309,7 +414,8 @@ def explore(request, id):
     if item.type.type != 'Directory':
         return redirect('/media/{0}'.format(id))
     return render(request, 'explore.html',
-                  {'items': item.children.all().order_by('name'),
+                  {'listing': explore_listing(user, item),
+                   'breadcrumbs': breadcrumbs(item),
                    'user': user, 'title': item.name})
 
 
@@ -317,10 +423,9 @@ def master_user(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     if not user.is_superuser:
         return redirect('/')
     return render(request, 'master_user.html', {'current_user': user})
@@ -330,10 +435,9 @@ def master_user_add(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     errors = []
     messages = []
     if not user.is_superuser:
@@ -385,10 +489,9 @@ def master_user_modify(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     errors = []
     messages = []
     if not user.is_superuser:
@@ -410,6 +513,7 @@ def master_user_modify(request):
         id_ = request.POST.get('id_remove')
         user_ = User.objects.get(id=id_)
         uname = user_.username
+        remove_ratings(ItemRating.objects.filter(user=user_))
         user_.delete()
         messages.append('Deleted user {0}'.format(uname))
     all_users = User.objects.all()
@@ -426,15 +530,35 @@ def show_suggestions(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     suggestions = Suggestion.objects.filter(to_user=user).order_by('-time')[:15]
     return render(request, 'suggestions.html',
                   {'suggestions': suggestions, 'current_user': user})
 
 
+def library_search(request):
+    username = request.session.get('username', None)
+    if not username:
+        return redirect('/login?err=Login required')
+    user = request.vault_user
+    if user is None:
+        return redirect('/login?err=No such user')
+    query = request.GET.get('q', '')
+    try:
+        start = max(0, int(request.GET.get('start', 0)))
+    except ValueError:
+        start = 0
+    items, next_start = search(user, query, start)
+    next_url = None
+    if next_start is not None:
+        next_url = '/search?' + urlencode({'q': query, 'start': next_start})
+    return render(request, 'library_search.html',
+                  {'query': query, 'items': items, 'next_url': next_url,
+                   'user': user, 'title': 'Search'})
+
+
 def media(request):
     return redirect('/explore')
 
@@ -451,10 +575,9 @@ def change_password(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     errors = []
     messages = []
     if request.POST.get('change', None):
@@ -489,10 +612,9 @@ def reset_password(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     if not user.is_superuser:
         return redirect('/')
     messages = []
@@ -512,15 +634,17 @@ def online(request):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     results = []
     if request.POST.get('search', None):
         param = request.POST.get('param')
         if len(param) > 0:
-            results = youtube_search(param)
+            try:
+                results = youtube_search(param)
+            except RequestException as e:
+                print('Searching YouTube failed - {0!r}'.format(e))
     return render(request, 'search.html',
                   {'results': results, 'number': len(results),
                    'current_user': user})
@@ -530,23 +654,30 @@ def online_single(request, id):
     username = request.session.get('username', None)
     if not username:
         return redirect('/login?err=Login required')
-    user = User.objects.filter(username=username)
-    if len(user) == 0:
+    user = request.vault_user
+    if user is None:
         return redirect('/login?err=No such user')
-    user = user[0]
     if len(id) != 11:
         return render(request, 'notfound.html', {'error': 'Invalid video id'})
     messages = []
-    if request.POST.get('video', None):
-        download_video(id)
-        messages.append(
-            'Request to download video has been added and will be processed.')
-    elif request.POST.get('audio', None):
-        download_audio(id)
-        messages.append(
-            'Request to download audio has been added and will be processed.')
+    try:
+        if request.POST.get('video', None):
+            download_video(id, user)
+            messages.append('Request to download video has been added and '
+                            'will be processed.')
+        elif request.POST.get('audio', None):
+            download_audio(id, user)
+            messages.append('Request to download audio has been added and '
+                            'will be processed.')
+    except ValueError:
+        return render(request, 'notfound.html', {'error': 'Invalid video id'})
+    downloads = user_downloads(user)
     return render(request, 'online_single.html',
-                  {'messages': messages, 'current_user': user})
+                  {'messages': messages, 'current_user': user,
+                   'downloads': downloads,
+                   'downloads_running': any(
+                       task.state in (PENDING, RUNNING) for task in
+                       downloads)})
 
 
 def test(request):
@@ -0,0 +1,254 @@
+"""
+Watcher keeping the shared items in line with the disk as files come and go.
+
+Every shared root directory is watched with inotify on Linux, or polled for
+changes elsewhere. A tree inotify fails to watch, e.g. once
+fs.inotify.max_user_watches is reached, is polled instead. Events are collected into a set of changed directories
+and, once they have been quiet for a moment, the directories are synced in
+one batch with LibraryScanner.sync(), which also recognises renames and
+moves by inode.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from django.db import close_old_connections
+
+from .extraction import extract_in_background
+from .models import SharedItem
+from .scanner import LibraryScanner, fingerprint, walk
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyBackend(object):
+    """
+    Reports changed directories using Linux inotify, and those of the trees
+    it could not watch by polling them every `interval` seconds.
+    """
+
+    def __init__(self, interval=5.0):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch_call = libc.inotify_add_watch
+        self.add_watch_call.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                        ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.overflowed = False
+        self.polling = PollingBackend(interval)
+        self.polled = 0
+
+    def add_watch(self, path):
+        """
+        :return: Error number if inotify could not watch `path`, else None
+        """
+        wd = self.add_watch_call(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            return ctypes.get_errno()
+        self.watches[wd] = path
+
+    def watch(self, root):
+        if any(root == polled or root.startswith(polled + '/') for
+               polled in self.polling.roots):
+            return
+        directories = walk(root)[0]
+        for path, _, _ in directories:
+            error = self.add_watch(path)
+            if error is not None:
+                break
+        else:
+            return
+        print('Could not watch {0}: {1}, polling {2} every {3} seconds '
+              'instead'.format(path, os.strerror(error), root,
+                               self.polling.interval))
+        self.polling.watch(root)
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for events.
+        :return: Set of paths of directories whose entries changed
+        """
+        changed = set()
+        if self.polling.roots and \
+                time.time() - self.polled >= self.polling.interval:
+            changed.update(self.polling.changes())
+            self.polled = time.time()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(os.path.dirname(directory))
+                continue
+            changed.add(directory)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Watch the new directory (and update the paths of watches
+                # inside a moved one).
+                self.watch(directory + '/' + name)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend(object):
+    """
+    Reports changed directories by walking the watched trees periodically
+    and comparing stat fingerprints.
+    """
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.roots = {}
+        self.overflowed = False
+
+    def snapshot(self, root):
+        directories, files, _ = walk(root)
+        return {path: (parent_path, fingerprint(stat)) for
+                path, parent_path, stat in directories + files}
+
+    def watch(self, root):
+        self.roots[root] = self.snapshot(root)
+
+    def wait(self, timeout):
+        time.sleep(max(timeout, self.interval))
+        return self.changes()
+
+    def changes(self):
+        """
+        :return: Set of paths of directories whose entries changed since
+        the last call
+        """
+        changed = set()
+        for root, previous in self.roots.items():
+            current = self.snapshot(root)
+            for path in set(previous) | set(current):
+                before = previous.get(path)
+                after = current.get(path)
+                if before == after:
+                    continue
+                for entry in (before, after):
+                    if entry is not None and entry[0] is not None:
+                        changed.add(entry[0])
+                if after is not None and after[0] is None:
+                    changed.add(root)
+            self.roots[root] = current
+        return changed
+
+    def close(self):
+        pass
+
+
+def get_backend(polling=False, interval=5.0):
+    if not polling:
+        try:
+            return InotifyBackend(interval)
+        except (OSError, AttributeError, TypeError):
+            print('inotify is not available, polling for changes instead')
+    return PollingBackend(interval)
+
+
+class LibraryWatcher(object):
+    """
+    Applies changes under the shared root directories as they happen.
+    """
+
+    def __init__(self, backend, debounce=0.5, max_delay=2.0,
+                 refresh=30.0):
+        """
+        :param backend: InotifyBackend or PollingBackend
+        :param debounce: Seconds without events after which a batch of
+        changes is applied
+        :param max_delay: Most seconds a change waits in a busy burst
+        :param refresh: Seconds after which new root items are picked up
+        """
+        self.backend = backend
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.refresh = refresh
+        self.roots = set()
+        self.scanner = LibraryScanner(None, 'inherit')
+
+    def watch_roots(self):
+        roots = set(SharedItem.objects.filter(
+            is_root=True, type__type='Directory').values_list('path',
+                                                              flat=True))
+        for root in roots - self.roots:
+            print('Watching {0}'.format(root))
+            self.backend.watch(root)
+        self.roots = roots
+
+    def apply(self, changed):
+        close_old_connections()
+        if self.backend.overflowed:
+            self.backend.overflowed = False
+            self.scanner.sync(self.roots)
+        else:
+            self.scanner.sync(changed, recursive=False)
+        extract_in_background()
+
+    def run(self):
+        self.watch_roots()
+        refreshed = time.time()
+        changed = set()
+        first = last = None
+        try:
+            while True:
+                events = self.backend.wait(self.debounce)
+                now = time.time()
+                if events or self.backend.overflowed:
+                    changed.update(events)
+                    first = first or now
+                    last = now
+                if first and (now - last >= self.debounce or
+                              now - first >= self.max_delay):
+                    self.apply(changed)
+                    changed = set()
+                    first = last = None
+                if now - refreshed >= self.refresh:
+                    close_old_connections()
+                    self.watch_roots()
+                    refreshed = now
+        finally:
+            self.backend.close()
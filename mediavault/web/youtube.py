@@ -0,0 +1,169 @@
+"""
+Client searching videos on YouTube.
+
+Searches go through one requests.Session per process, whose pool of
+connections is reused between searches, with a timeout on connecting and
+on reading. Results are cached in memory for YOUTUBE_CACHE_TIMEOUT seconds
+under the normalized query, so that the same search by many users, or
+again by one, costs a single request.
+
+The results page is cut into tiles in a single pass and every attribute of
+a tile is read with a precompiled pattern stopping at its first match.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+SEARCH_URL = 'https://www.youtube.com/results'
+THUMBNAIL_URL = 'http://img.youtube.com/vi/{0}/0.jpg'
+# Seconds to connect and to wait for data
+TIMEOUT = (3.05, 10)
+CACHE_TIMEOUT = 600
+MAX_CACHED_QUERIES = 256
+POOL_SIZE = 10
+
+TILE = re.compile(r'yt-lockup-tile')
+TITLE = re.compile(r'yt-lockup-title.*?href.*?watch\?v=(.*?[^"]+)'
+                   r'.*? title="(.*?[^"]+)')
+LENGTH = re.compile(r'video-time.*?>([^<]+)')
+UPLOADER = re.compile(r'yt-lockup-byline.*?>.*?>([^<]+)')
+META = re.compile(r'yt-lockup-meta-info.*?>.*?>([^<]+).*?([0-9,]+)')
+DESCRIPTION = re.compile(r'yt-lockup-description.*?>(.*?)<')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def normalize(query):
+    """
+    :return: `query` lower cased with runs of white space made single
+    spaces, the key of its results in the cache
+    """
+    return ' '.join(query.lower().split())
+
+
+def split_tiles(html):
+    """
+    :return: List of the parts of a results page holding a video each
+    """
+    starts = [match.start() for match in TILE.finditer(html)]
+    return [html[start:end] for start, end in
+            zip(starts, starts[1:] + [len(html)])]
+
+
+def first(pattern, text):
+    match = pattern.search(text)
+    return match.groups() if match else None
+
+
+def parse_tile(html):
+    """
+    :return: Dictionary of the id, title, length, uploader, time, views,
+    thumbnail and description of the video in a tile, or None if it has no
+    video
+    """
+    found = first(TITLE, html)
+    if found is None:
+        return None
+    result = {'id': found[0], 'title': found[1]}
+    found = first(LENGTH, html)
+    if found:
+        result['length'] = found[0].strip()
+    found = first(UPLOADER, html)
+    if found:
+        result['uploader'] = found[0].strip()
+    found = first(META, html)
+    if found:
+        result['time'], result['views'] = found
+    result['thumb'] = THUMBNAIL_URL.format(result['id'])
+    found = first(DESCRIPTION, html)
+    result['description'] = found[0] if found else ''
+    return result
+
+
+def parse_results(html):
+    """
+    :return: List of parse_tile() of the videos on a results page
+    """
+    return [result for result in map(parse_tile, split_tiles(html)) if
+            result is not None]
+
+
+class YouTubeClient(object):
+    """
+    Searches YouTube, caching the results of every query for a while.
+    """
+
+    def __init__(self, session=None, timeout=TIMEOUT,
+                 cache_timeout=CACHE_TIMEOUT, max_cached=MAX_CACHED_QUERIES):
+        """
+        :param session: requests.Session to search with, a pooled one if
+        None
+        :param timeout: Timeout of requests, see requests.request()
+        :param cache_timeout: Seconds for which results are reused
+        :param max_cached: Number of queries whose results are kept
+        """
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                                  pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+        self.timeout = timeout
+        self.cache_timeout = cache_timeout
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def store(self, key, results):
+        with self.lock:
+            self.cache[key] = (time.monotonic() + self.cache_timeout,
+                               results)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+
+    def search(self, query):
+        """
+        :return: List of dictionaries describing the videos found, see
+        parse_tile()
+        :raise requests.RequestException: If YouTube cannot be reached
+        """
+        key = normalize(query)
+        results = self.cached(key)
+        if results is None:
+            response = self.session.get(SEARCH_URL,
+                                        params={'search_query': key},
+                                        timeout=self.timeout)
+            response.raise_for_status()
+            results = parse_results(response.text)
+            self.store(key, results)
+        return [dict(result) for result in results]
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = YouTubeClient(
+                timeout=getattr(settings, 'YOUTUBE_TIMEOUT', TIMEOUT),
+                cache_timeout=getattr(settings, 'YOUTUBE_CACHE_TIMEOUT',
+                                      CACHE_TIMEOUT))
+        return _client
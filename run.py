@@ -1,9 +1,159 @@
 #!/usr/bin/python3
+"""
+Start the MediaVault server.
+
+By default the site is served with the production settings by gunicorn,
+configured in mediavault/gunicorn.conf.py - pre-forked worker processes
+with a pool of threads each. Options given here override that
+configuration. Static files are collected first.
+
+With --asgi the ASGI application of mediavault/asgi.py is served by
+uvicorn instead, streaming media from an event loop so that a process can
+hold thousands of slow streams.
+
+    $ python3 run.py --workers 4 --threads 32
+    $ python3 run.py --reload       # restart the workers of a running server
+    $ python3 run.py --asgi --workers 2
+    $ python3 run.py --dev          # Django's development server
+"""
+import argparse
+import os
+import signal
+import socket
 import subprocess
+import sys
 
-if __name__ == '__main__':
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'mediavault')
+PIDFILE = os.environ.get('MEDIAVAULT_PIDFILE',
+                         os.path.join(DIRECTORY, 'mediavault.pid'))
+BIND = '0.0.0.0:8000'
+
+
+def addresses():
+    """
+    :return: List of the IP addresses of this host
+    """
+    try:
+        found = socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)
+    except socket.gaierror:
+        return ['127.0.0.1']
+    return sorted(set(info[4][0] for info in found))
+
+
+def running_server():
+    """
+    :return: Tuple of the process id of the running server and whether it
+    restarts its workers on SIGHUP, or None if no server is running
+    """
+    try:
+        with open(PIDFILE) as file:
+            lines = file.read().split()
+        pid = int(lines[0])
+        os.kill(pid, 0)
+    except (OSError, ValueError, IndexError):
+        return None
+    # A single uvicorn process exits on SIGHUP instead
+    return pid, lines[1:] != ['single']
+
+
+def write_pidfile(restartable):
+    """
+    Write the process id for --reload and --stop, for servers that do not
+    write it themselves. The process keeps its id across exec.
+    """
+    with open(PIDFILE, 'w') as file:
+        file.write('{0}\n{1}'.format(os.getpid(),
+                                     '' if restartable else 'single\n'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--bind',
+                        help='Address and port to listen on, {0} or '
+                             'MEDIAVAULT_BIND by default'.format(BIND))
+    parser.add_argument('--workers', type=int,
+                        help='Worker processes, one per CPU by default')
+    parser.add_argument('--threads', type=int,
+                        help='Threads of each worker, i.e. requests it '
+                             'serves at once')
+    parser.add_argument('--timeout', type=int,
+                        help='Seconds before an unresponsive worker is '
+                             'restarted')
+    parser.add_argument('--graceful-timeout', type=int,
+                        help='Seconds workers get to finish their requests '
+                             'when restarted or stopped')
+    parser.add_argument('--no-preload', action='store_true',
+                        help='Load the application in every worker instead '
+                             'of once before forking them')
+    parser.add_argument('--reload', action='store_true',
+                        help='Gracefully restart the workers of the running '
+                             'server')
+    parser.add_argument('--stop', action='store_true',
+                        help='Gracefully stop the running server')
+    parser.add_argument('--asgi', action='store_true',
+                        help='Serve the ASGI application with uvicorn')
+    parser.add_argument('--dev', action='store_true',
+                        help='Run the Django development server instead')
+    args = parser.parse_args()
+
+    if args.reload or args.stop:
+        server = running_server()
+        if server is None:
+            sys.exit('No server running ({0} not found)'.format(PIDFILE))
+        pid, restartable = server
+        if args.reload and not restartable:
+            sys.exit('A single uvicorn process cannot restart, stop it and '
+                     'start it again, or serve with --workers 2 or more')
+        os.kill(pid, signal.SIGHUP if args.reload else signal.SIGTERM)
+        return
+
+    # gunicorn reads MEDIAVAULT_BIND from its configuration itself
+    bind = args.bind or os.environ.get('MEDIAVAULT_BIND', BIND)
     print('The server may run on following IPs - ')
-    subprocess.call('ifconfig | grep inet\ addr', shell=True)
-    print('on port 8000')
-    subprocess.call('cd mediavault && python3 manage.py runserver 0.0.0.0:8000',
-                    shell=True)
+    for address in addresses():
+        print('\t' + address)
+    print('on port {0}'.format(bind.rsplit(':', 1)[-1]))
+    os.chdir(DIRECTORY)
+    if args.dev:
+        os.execvp(sys.executable, [sys.executable, 'manage.py', 'runserver',
+                                   bind])
+    server = 'uvicorn' if args.asgi else 'gunicorn'
+    try:
+        __import__(server)
+    except ImportError:
+        sys.exit('{0} is not installed, install it with\n'
+                 '\tpip3 install {0}\nor run the development server '
+                 'with --dev'.format(server))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mediavault.production')
+    subprocess.check_call([sys.executable, 'manage.py', 'collectstatic',
+                           '--noinput', '-v', '0'])
+    if args.asgi:
+        host, _, port = bind.rpartition(':')
+        workers = args.workers or 1
+        command = [sys.executable, '-m', 'uvicorn', '--host', host, '--port',
+                   port, '--workers', str(workers),
+                   '--timeout-graceful-shutdown',
+                   str(args.graceful_timeout or 30),
+                   'mediavault.asgi:application']
+        # Several uvicorn workers run under a supervisor restarting them on
+        # SIGHUP
+        write_pidfile(workers > 1)
+        os.execvp(sys.executable, command)
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+               '--env', 'DJANGO_SETTINGS_MODULE=' + os.environ[
+                   'DJANGO_SETTINGS_MODULE']]
+    if args.bind:
+        command.extend(['--bind', args.bind])
+    for option in ('workers', 'threads', 'timeout', 'graceful_timeout'):
+        if getattr(args, option) is not None:
+            command.extend(['--' + option.replace('_', '-'),
+                            str(getattr(args, option))])
+    if args.no_preload:
+        os.environ['MEDIAVAULT_PRELOAD'] = '0'
+    command.append('mediavault.wsgi:application')
+    os.execvp(sys.executable, command)
+
+
+if __name__ == '__main__':
+    main()